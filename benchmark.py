@@ -0,0 +1,395 @@
+""" Benchmarks the Slippstream -> event parsing -> music hot path
+Starts a stand-in Slippstream server (melee/slippstreamserver.py) in a separate process,
+connects a Console to it under SDL's dummy audio driver and reports:
+    events/sec parsed, per-packet latency percentiles (server send -> parsed),
+    GAME_START -> mixer play latency, and CPU usage while idle on the menu.
+With --parser, it times the event parser on its own instead, against the old parser that
+sliced the buffer after every event. With --packets, it pushes that many packets through
+the stand-in server into a bare SlippstreamClient and reports packets/sec read with
+dispatch() (one packet per call) and with dispatch_batch().
+The synthetic games are the same on every run, so the numbers can be compared across
+versions. Run "python benchmark.py --help" for the options.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+from melee.slippstream import EventType
+
+def serve(port, commands, results):
+    """ Server process: runs commands from the benchmark until told to stop """
+    from melee.slippstreamserver import SlippstreamServer, synthetic_game, replay_payloads
+    server = SlippstreamServer(port=port)
+    results.put("ready")
+    while True:
+        try:
+            command, args = commands.get_nowait()
+        except queue.Empty:
+            server.service(10)
+            continue
+        if command == "game":
+            if args["replay"]:
+                payloads = replay_payloads(args["replay"])
+            else:
+                payloads = synthetic_game(args["stage"], args["frames"])
+            results.put(server.send_game(payloads, args["fps"], args["burst"]))
+        elif command == "stop":
+            return
+
+class Probe():
+    """ Timestamps every payload a Console parses and every track it starts playing """
+
+    def __init__(self, console):
+        self.parsed = []
+        self.plays = []
+        handler = console._Console__handle_slippstream_events
+        play = console._player.play
+        def handle(payload):
+            result = handler(payload)
+            self.parsed.append(time.monotonic())
+            return result
+        def play_and_record(intro, loop):
+            play(intro, loop)
+            self.plays.append(time.monotonic())
+        console._Console__handle_slippstream_events = handle
+        console._player.play = play_and_record
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def pick(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000
+    return {"p50_ms": pick(50), "p90_ms": pick(90), "p99_ms": pick(99), "max_ms": values[-1] * 1000}
+
+def run_games(name, args, commands, results, probe, fps, burst, games):
+    """ Send games and measure how fast and how late the Console handles them """
+    from melee.slippstreamserver import synthetic_game, replay_payloads, count_events
+    payloads = replay_payloads(args.replay) if args.replay else synthetic_game(31, args.frames)
+    eventsize = [0] * 0x100
+    events = sum(count_events(payload, eventsize) for payload in payloads)
+    latencies = []
+    starts = []
+    busy = 0.0
+    for game in range(games):
+        probe.parsed.clear()
+        probe.plays.clear()
+        commands.put(("game", {"replay": args.replay, "stage": 31, "frames": args.frames,
+                               "fps": fps, "burst": burst}))
+        sent = results.get()
+        deadline = time.monotonic() + 30
+        while len(probe.parsed) < len(sent) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if len(probe.parsed) < len(sent):
+            print(name + ": only " + str(len(probe.parsed)) + " of " + str(len(sent)) + " packets were parsed", file=sys.stderr)
+        latencies += [parsed - sent_at for parsed, sent_at in zip(probe.parsed, sent)]
+        busy += probe.parsed[-1] - sent[0] if probe.parsed else 0
+        game_start = [play - sent[0] for play in probe.plays if play >= sent[0]]
+        if game_start:
+            starts.append(game_start[0])
+        time.sleep(0.2) # let the game end settle before the next one
+    report = {"packets": len(latencies),
+              "events_per_sec": events * games / busy if busy else 0.0,
+              "packet_latency": percentiles(latencies),
+              "game_start_to_play": percentiles(starts)}
+    return report
+
+def rss_mb():
+    """ Resident memory of this process in megabytes, or None where it can't be read """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, AttributeError, ValueError):
+        return None
+
+def measure_idle(seconds):
+    """ CPU used by this process (Console threads included) while nothing is happening """
+    wall = time.monotonic()
+    cpu = time.process_time()
+    time.sleep(seconds)
+    return {"cpu_percent": (time.process_time() - cpu) / (time.monotonic() - wall) * 100}
+
+def measure_cpu(action):
+    """ Run action() and return the CPU usage of this process while it ran, in percent """
+    wall = time.monotonic()
+    cpu = time.process_time()
+    action()
+    return (time.process_time() - cpu) / (time.monotonic() - wall) * 100
+
+def scaling(args):
+    """ Add stations one at a time, each with its own stand-in server, and measure memory
+    and CPU (idle, and with a game running on every station at once) after each one
+    """
+    from melee.stations import Stations
+    servers = []
+    for i in range(args.stations):
+        commands = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=serve, args=(args.port + i, commands, results), daemon=True)
+        process.start()
+        results.get()
+        servers.append((process, commands, results))
+
+    rows = []
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        stations = Stations(menu=True)
+        for count in range(1, args.stations + 1):
+            console = stations.add(args.port + count - 1)
+            console.wait_ready()
+            if count == 1:
+                console.tracks._thread.join()
+            stations.start()
+            deadline = time.monotonic() + 10
+            while not all(console._connected for console in stations.consoles) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            time.sleep(1)
+            row = {"stations": count, "rss_mb": rss_mb(), "idle_cpu_percent": measure_idle(args.idle)["cpu_percent"]}
+            def play_games():
+                for process, commands, results in servers[:count]:
+                    commands.put(("game", {"replay": args.replay, "stage": 31, "frames": args.frames, "fps": 60, "burst": 1}))
+                for process, commands, results in servers[:count]:
+                    results.get()
+            row["game_cpu_percent"] = measure_cpu(play_games)
+            time.sleep(0.5)
+            row["received"] = [console._receiver.received for console in stations.consoles]
+            rows.append(row)
+            time.sleep(2.5) #let the menu music start again
+        stations.stop()
+    for process, commands, results in servers:
+        commands.put(("stop", None))
+        process.join(timeout=5)
+
+    per_station = {}
+    if len(rows) > 1:
+        for key in ("rss_mb", "idle_cpu_percent", "game_cpu_percent"):
+            if rows[0][key] is not None:
+                per_station[key] = (rows[-1][key] - rows[0][key]) / (len(rows) - 1)
+    return {"stations": rows, "per_added_station": per_station}
+
+def receive_packets(receive, total, timeout=60):
+    """ Call receive() until total game_event messages have come in
+    Returns:
+        time.monotonic() when the last one arrived, or None if they didn't all arrive in time
+    """
+    received = 0
+    deadline = time.monotonic() + timeout
+    while received < total:
+        if time.monotonic() > deadline:
+            return None
+        messages = receive()
+        received += sum(1 for message in messages if message.get("type") == "game_event")
+    return time.monotonic()
+
+def packet_rates(args):
+    """ Packets/sec a SlippstreamClient reads from the stand-in server, one packet per
+    dispatch() call against everything buffered per dispatch_batch() call. The server sends
+    as fast as it can, and the best of --games runs is kept for each
+    """
+    from melee.slippstream import SlippstreamClient
+    commands = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(args.port, commands, results), daemon=True)
+    server.start()
+    results.get()
+    client = SlippstreamClient(port=args.port)
+    if not client.connect():
+        sys.exit("Couldn't connect to the stand-in server")
+    def dispatch():
+        message = client.dispatch()
+        return [message] if message is not None else []
+    paths = (("dispatch", dispatch), ("dispatch_batch", client.dispatch_batch))
+    best = {name: None for name, receive in paths}
+    for game in range(args.games):
+        for name, receive in paths:
+            commands.put(("game", {"replay": None, "stage": 31, "frames": args.packets - 1,
+                                   "fps": 0, "burst": args.burst}))
+            done = receive_packets(receive, args.packets)
+            sent = results.get()
+            if done is None:
+                print(name + ": not every packet arrived", file=sys.stderr)
+                continue
+            seconds = done - sent[0]
+            best[name] = seconds if best[name] is None else min(best[name], seconds)
+            client.dispatch_batch(timeout=200) #anything left over, like the end of game packet
+    client.shutdown()
+    commands.put(("stop", None))
+    server.join(timeout=5)
+    report = {"packets": args.packets}
+    for name, seconds in best.items():
+        report[name] = {"seconds": seconds, "packets_per_sec": args.packets / seconds if seconds else None}
+    if best["dispatch"] and best["dispatch_batch"]:
+        report["speedup"] = best["dispatch"] / best["dispatch_batch"]
+    return report
+
+def legacy_handle(state, event_bytes):
+    """ The event parser as it was before it walked a memoryview: the rest of the buffer is
+    copied after every event, and the command is looked up as an EventType up to six times
+    per event. Game start and end only record the stage and stocks, like the Console below
+    with its music actions switched off, so only the parsing is compared
+    Returns:
+        True if a frame ended, False otherwise
+    """
+    while len(event_bytes) > 0:
+        event_size = state.eventsize[event_bytes[0]]
+        if len(event_bytes) < event_size:
+            return False
+        if EventType(event_bytes[0]) == EventType.PAYLOADS:
+            cursor = 0x2
+            payload_size = event_bytes[1]
+            num_commands = (payload_size - 1) // 3
+            for i in range(0, num_commands):
+                command = int(event_bytes[cursor])
+                command_len = (int(event_bytes[cursor + 0x1]) << 8) + int(event_bytes[cursor + 0x2])
+                state.eventsize[command] = command_len+1
+                cursor += 3
+            event_bytes = event_bytes[payload_size + 1:]
+        elif EventType(event_bytes[0]) == EventType.FRAME_START:
+            event_bytes = event_bytes[event_size:]
+        elif EventType(event_bytes[0]) == EventType.GAME_START:
+            state.stocks = [-1]*4
+            state.stage = (int(event_bytes[0x13]) << 8) + int(event_bytes[0x14])
+            event_bytes = event_bytes[event_size:]
+        elif EventType(event_bytes[0]) == EventType.GAME_END:
+            event_bytes = event_bytes[event_size:]
+            state.stage = None
+            return False
+        elif(EventType(event_bytes[0]) in [EventType.PRE_FRAME, EventType.GECKO_CODES, EventType.ITEM_UPDATE]):
+            event_bytes = event_bytes[event_size:]
+        elif EventType(event_bytes[0]) == EventType.POST_FRAME:
+            state.stocks[event_bytes[0x5]] = event_bytes[0x21]
+            event_bytes = event_bytes[event_size:]
+        elif EventType(event_bytes[0]) == EventType.FRAME_BOOKEND:
+            event_bytes = event_bytes[event_size:]
+            return True
+        else:
+            return False
+    return False
+
+class LegacyState():
+    """ What legacy_handle keeps between calls """
+
+    def __init__(self):
+        self.eventsize = [0] * 0x100
+        self.stocks = [-1] * 4
+        self.stage = None
+
+def time_parser(handle, payloads, repeats):
+    """ Best time of repeats runs of handle over every payload, in seconds """
+    best = None
+    for i in range(repeats):
+        started = time.perf_counter()
+        for payload in payloads:
+            handle(payload)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def time_parsers(args):
+    """ Time Console.__handle_slippstream_events against legacy_handle on the same payloads """
+    import melee
+    from melee.slippstreamserver import synthetic_game, replay_payloads, count_events
+    payloads = replay_payloads(args.replay) if args.replay else [bytes(payload) for payload in synthetic_game(31, args.frames)]
+    eventsize = [0] * 0x100
+    events = sum(count_events(payload, eventsize) for payload in payloads)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        console = melee.Console(menu=False, cache_mb=0, pcm_cache=False, watch=False)
+        console.wait_ready()
+        if console.tracks is not None and console.tracks._thread is not None:
+            console.tracks._thread.join()
+        console._audio.post = lambda *args: None #no music, just the parsing
+        current = time_parser(console._Console__handle_slippstream_events, payloads, args.games)
+        state = LegacyState()
+        legacy = time_parser(lambda payload: legacy_handle(state, payload), payloads, args.games)
+    report = {"payloads": len(payloads), "events": events}
+    for name, seconds in (("current", current), ("legacy", legacy)):
+        report[name] = {"seconds": seconds, "events_per_sec": events / seconds,
+                        "us_per_payload": seconds / len(payloads) * 1e6}
+    report["speedup"] = legacy / current
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SlippiMusic against a stand-in Slippstream server")
+    parser.add_argument("--port", type=int, default=51499, help="UDP port for the stand-in server")
+    parser.add_argument("--frames", type=int, default=600, help="frames per synthetic game")
+    parser.add_argument("--games", type=int, default=5, help="games per scenario")
+    parser.add_argument("--burst", type=int, default=8, help="frames per burst in the rollback scenario")
+    parser.add_argument("--idle", type=float, default=10, help="seconds to measure idle CPU for")
+    parser.add_argument("--replay", default=None, help="send this .slp file (or folder) instead of synthetic games")
+    parser.add_argument("--no-pcm-cache", action="store_true", help="decode music in memory instead of using melee/pcmcache")
+    parser.add_argument("--stations", type=int, default=0, help="instead of the usual scenarios, measure how CPU and memory scale with this many stations")
+    parser.add_argument("--parser", action="store_true", help="instead of the usual scenarios, time the event parser against the old slicing parser (best of --games runs)")
+    parser.add_argument("--packets", type=int, default=0, help="instead of the usual scenarios, push this many packets through the stand-in server and report packets/sec for dispatch() and dispatch_batch()")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    random.seed(0)
+    if args.stations or args.parser or args.packets:
+        if args.stations:
+            report = scaling(args)
+        elif args.parser:
+            report = time_parsers(args)
+        else:
+            report = packet_rates(args)
+        print(json.dumps(report, indent=2))
+        if args.json:
+            with open(args.json, "w") as out:
+                json.dump(report, out, indent=2)
+        return
+    commands = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(args.port, commands, results), daemon=True)
+    server.start()
+    results.get()
+
+    import melee
+    from melee.metrics import METRICS, STARTUP
+    METRICS.enable()
+    report = {}
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        started = time.monotonic()
+        console = melee.Console(slippi_port=args.port, menu=True, pcm_cache=not args.no_pcm_cache)
+        report["construct_s"] = time.monotonic() - started
+        console.wait_ready()
+        console.tracks._thread.join()
+        report["preload_s"] = time.monotonic() - started
+        report["rss_mb"] = rss_mb()
+        probe = Probe(console)
+        if not console.connect():
+            sys.exit("Couldn't connect to the stand-in server")
+        def step_forever():
+            while True:
+                console.step()
+        threading.Thread(target=step_forever, daemon=True).start()
+        time.sleep(1)
+        report["idle_menu"] = measure_idle(args.idle)
+        report["unthrottled"] = run_games("unthrottled", args, commands, results, probe, 0, args.burst, args.games)
+        report["realtime"] = run_games("realtime", args, commands, results, probe, 60, 1, 1)
+        report["rollback"] = run_games("rollback", args, commands, results, probe, 120, args.burst, args.games)
+        report["stats"] = console.stats()
+        report["startup"] = STARTUP.to_dict()
+        report["histograms"] = json.loads(METRICS.to_json())
+    commands.put(("stop", None))
+    server.join(timeout=5)
+
+    print(json.dumps(report, indent=2))
+    print(METRICS.summary())
+    print(STARTUP.report())
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(report, out, indent=2)
+
+if __name__ == "__main__":
+    main()
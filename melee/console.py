@@ -10,16 +10,23 @@ import os
 import configparser
 import subprocess
 import platform
-import base64
 import sys
-import random
+import queue
+import threading
 from pathlib import Path
-from pygame import mixer
-from pygame import error as pg_error
 
 from melee.slippstream import SlippstreamClient, EventType
+from melee.slpfilestreamer import SLPFileStreamer
+from melee.scheduler import Scheduler
+from melee.workers import Receiver, Worker
+from melee.metrics import METRICS, STARTUP
+from melee.library import Library, MENU
+from melee.framebuffer import FrameBuffer
+from melee.watcher import DirectoryWatcher
+
+_PAYLOADS = EventType.PAYLOADS.value
+RECENT_STAGES = 6 #how many of the stages played last have their next song prefetched first
 
-MENU = 0 #"Stage ID" for the menu music. In reality, 0 is a DUMMY stage which crashes the game. 
 #Gets the config file's path, which doesn't work in slippiMusic.py for some reason
 def get_slippiMusic_config_path():
     return os.path.join(os.path.dirname(__file__), 'config.txt')
@@ -33,7 +40,19 @@ class Console:
                  slippi_address="127.0.0.1",
                  slippi_port=51441,
                  volume = 70,
-                 menu = False):
+                 menu = False,
+                 cache_mb = 256,
+                 stream_mb = 32,
+                 pcm_cache = True,
+                 watch = True,
+                 crossfade_ms = 0,
+                 fadeout_ms = 0,
+                 replay = None,
+                 realtime = True,
+                 client = None,
+                 output = None,
+                 channel = 0,
+                 shared = None):
         """Create a Console object
         Args:
             path (str): Path to your dolphin executable.
@@ -42,57 +61,73 @@ class Console:
             slippi_port (int): UDP port that slippi will listen on
             volume (int) the volume music should play at, between 0 and 100
             menu (boolean) True if you want menu music to play, false otherwise. 
+            cache_mb (int) how many megabytes of decoded music to keep in memory
+            stream_mb (int) stream tracks over this many megabytes of decoded music from disk
+                as they play instead of keeping them in memory, 0 to never stream
+            pcm_cache (boolean) keep decoded music on disk in melee/pcmcache between runs and
+                play it from there, instead of decoding every file on every run
+            watch (boolean) reload the music library when musicConfig.txt or the music folder changes
+            crossfade_ms (int) length of the crossfade at loop points, 0 to cut exactly at the loop point
+            fadeout_ms (int) how long music takes to fade out when it's stopped
+            replay (str) an SLP file, or a folder of them, to play back instead of connecting
+                to Dolphin / Wii. Dolphin won't be configured or launched.
+            realtime (boolean) play the replay back at game speed. If False, it runs as fast as possible
+            client (MuxedClient) the connection to use instead of a SlippstreamClient of its own
+            output (str) name of the audio device to play on, or None for the mixer's output
+            channel (int) mixer channel to play on when output is None. Consoles playing at the
+                same time need different channels
+            shared (Console) another Console whose music library, decoded tracks and timers
+                this one shares, rather than loading its own. That Console's watcher keeps
+                both libraries up to date
         """
         self.path = path
+        self.replay = replay
         self.slippi_address = slippi_address
         """(str): IP address of the Dolphin / Wii to connect to."""
         self.slippi_port = slippi_port
         """(int): UDP port of slippi server. Default 51441"""
         self.eventsize = [0] * 0x100
+        # Handler per command byte, filled in as PAYLOADS announces event sizes. Events that
+        # have a size but no handler (frame start, pre-frame, items, gecko codes...) are skipped
+        self._handlers = [None] * 0x100
+        self._event_handlers = {
+            EventType.GAME_START.value: self.__on_game_start,
+            EventType.GAME_END.value: self.__on_game_end,
+            EventType.POST_FRAME.value: self.__on_post_frame,
+            EventType.FRAME_BOOKEND.value: self.__on_frame_bookend,
+        }
         self.cursor = 0
         self._frame = 0
         self._process = None
-        self._stocks = [-1]*4
-        self._current_loop = None
-        
-        try:
-            mixer.init()
-        except pg_error:
-            print("Failed to initialize the mixer! Check that your audio devices are working properly")
-        else:
-            mixer.music.set_volume(volume/100.0)
+        self._dolphin_closed = threading.Event()
+        self.frames = FrameBuffer()
+        """(FrameBuffer): Stocks, percents and action states of the recent frames of the game in progress"""
+        self._stage = None #stage of the game in progress, None when not in a game
+        self._connected = False
+        self._received_at = None #when the packet being parsed arrived, if metrics are enabled
+        self._resyncing = False #set after a reconnect until the replayed events catch up
+        self._player = None
+        self.fadeout_ms = fadeout_ms
+        self._games = 0 #bumped on every game start, so stale menu music knows not to play
+        self._menu_timer = None
+        self._playing = None #(stage ID, entry) of the song that's playing
+        self._next = {} #stage ID -> entry already picked for the next time that stage comes up
+        self._recent = [] #stages played this session, most recent last
+        self._followers = [] #Consoles sharing this one's library
+        self._scheduler = shared._scheduler if shared is not None else Scheduler()
+        self._audio = Worker("Audio")
+        self.library = Library(os.path.join(os.path.dirname(__file__), 'music')) #empty until it's loaded
+        self.tracks = None
+        self._watcher = None
+        self._ready = threading.Event() #set once the music can play (or couldn't be loaded)
+        self._music_failed = False
         
         self.menu = menu
         
-        self.fileNames = [None]*33
-        configPath = os.path.normpath(os.path.join(os.path.dirname(__file__), 'music/musicConfig.txt'))
-        try:
-            configFile = open(configPath)
-        except FileNotFoundError:
-            input("No music config file found at " + configPath + "! Press enter to exit...")
-            sys.exit(1)
-        else:
-            for line in configFile:
-                split = line.split(":")
-                if(len(split) < 2):
-                    continue
-                for i in range(len(split)):
-                    split[i] = split[i].strip()
-                try:
-                    stageID = int(split[0])
-                except ValueError:
-                    if(split[0].lower() == "menu"):
-                        stageID = MENU
-                    else:
-                        continue
-                if(stageID > 32):
-                    continue #skip invalid
-                if(self.fileNames[stageID] is None):
-                    self.fileNames[stageID] = []
-                self.fileNames[stageID].append(split[1:])
         #self._slippstream = SlippstreamClient(self.slippi_address, self.slippi_port)        
-        if self.path:
+        if self.path and not self.replay:
             # Setup some dolphin config options
+            started = time.perf_counter()
             dolphin_config_path = self._get_dolphin_config_path()
             config = configparser.SafeConfigParser()
             config.read(dolphin_config_path)
@@ -109,20 +144,117 @@ class Console:
                             print("Access denied to your Dolphin.ini file at " + dolphin_config_path + "! Means I can't automatically configure Dolphin. Run as administrator or make open that config file and make sure that \"SlippiEnableSpectator\" is set to True.")
             except (configparser.NoSectionError, KeyError):
                 print("Invalid Dolphin.ini file! Usually means your Dolphin path is wrong.")
-        self._slippstream = SlippstreamClient(self.slippi_address, self.slippi_port)
-        #else:
-            #self._slippstream = SLPFileStreamer(self.path)  
+            STARTUP.record("dolphin_ini", started)
+        if client is not None:
+            self._slippstream = client
+        elif self.replay:
+            self._slippstream = SLPFileStreamer(self.replay, realtime)
+        else:
+            self._slippstream = SlippstreamClient(self.slippi_address, self.slippi_port)
+        self._receiver = Receiver(self._slippstream)
+        self._batch = []
+        self._batch_index = 0
+
+        # pygame, the mixer and the music library take a while to get going, so they start
+        # on the audio thread and the music actions queue up behind them. Meanwhile Dolphin
+        # can be launched and connected to. __init_audio can wake step() through the
+        # receiver's queue, so it's posted once that exists
+        self._audio.post(self.__init_audio, volume, output, channel, crossfade_ms, cache_mb, stream_mb,
+                         pcm_cache, watch, shared)
+
+    def wait_ready(self, timeout=None):
+        """ Wait for the mixer and the music library to be loaded
+        Returns:
+            True if they're ready, False if timeout seconds went by first
+        """
+        return self._ready.wait(timeout)
+
+    def __init_audio(self, volume, output, channel, crossfade_ms, cache_mb, stream_mb, pcm_cache, watch, shared):
+        """ Runs first on the audio thread: import pygame, start the mixer and load the music """
+        try:
+            if shared is not None:
+                shared._ready.wait() #it starts the mixer and loads the music for both
+            started = time.perf_counter()
+            from pygame import mixer
+            from pygame import error as pg_error
+            from melee.player import MusicPlayer, DevicePlayer
+            from melee.trackcache import TrackCache
+            STARTUP.record("import", started)
+
+            started = time.perf_counter()
+            try:
+                mixer.init()
+            except pg_error:
+                print("Failed to initialize the mixer! Check that your audio devices are working properly")
+            else:
+                if output is not None:
+                    try:
+                        self._player = DevicePlayer(output, crossfade_ms = crossfade_ms)
+                    except (ImportError, RuntimeError) as e: #pygame.error and SDL errors are RuntimeErrors
+                        print("Couldn't open the audio device \"" + output + "\" (" + str(e) + "), using the default output")
+                if self._player is None:
+                    if mixer.get_num_channels() <= channel:
+                        mixer.set_num_channels(channel + 1)
+                    mixer.set_reserved(channel + 1) #keep sound effects, if any, off the music channels
+                    self._player = MusicPlayer(mixer.Channel(channel), crossfade_ms = crossfade_ms)
+                self._player.set_volume(volume/100.0)
+            STARTUP.record("mixer", started)
+
+            musicPath = os.path.join(os.path.dirname(__file__), 'music')
+            if shared is not None:
+                if shared._music_failed:
+                    self.__fail()
+                    return
+                self.library = shared.library
+                self.tracks = shared.tracks
+                shared._followers.append(self)
+                return
+            started = time.perf_counter()
+            self.library = Library(musicPath, index_path=os.path.join(os.path.dirname(__file__), 'library.json'))
+            try:
+                self.library.load()
+            except FileNotFoundError:
+                print("No music config file found at " + os.path.normpath(self.library.config_path) + "!")
+                self.__fail()
+                return
+            except (OSError, ValueError) as e: #can't be opened, or isn't text
+                print("Couldn't read the music config file at " + os.path.normpath(self.library.config_path) + " (" + str(e) + ")!")
+                self.__fail()
+                return
+            STARTUP.record("library", started)
+            print("Indexed %d music files in %.0f ms (%d probed)" % (len(self.library.info), (time.perf_counter() - started) * 1000,
+                                                                    self.library.probed))
+            self.tracks = TrackCache(musicPath, cache_mb,
+                                     os.path.join(os.path.dirname(__file__), 'pcmcache') if pcm_cache else None,
+                                     stream_mb)
+            if self._player is not None:
+                self.tracks.preload(self.library)
+            if watch:
+                self._watcher = DirectoryWatcher(musicPath, self.__reload_library)
+                self._watcher.start()
+        finally:
+            self._ready.set()
+            STARTUP.record("ready", STARTUP.started)
+
+    def __fail(self):
+        """ The music couldn't be loaded: have step() return, so its caller can exit """
+        self._music_failed = True
+        try:
+            self._receiver.messages.put_nowait([])
+        except queue.Full:
+            pass
 
     def connect(self):
-        """ Connects to the Slippi server (dolphin or wii).
+        """ Connects to the Slippi server (dolphin or wii), or opens the replay.
         Returns:
             True if successful, False otherwise
         """
         to_return = self._slippstream.connect()
         if(to_return):
             if(self.menu):
-                stageFiles = self.fileNames[MENU]
-                self.playMusic(stageFiles[random.randrange(len(stageFiles))])
+                self._audio.post(self.__play_menu, self._games)
+            self._audio.post(self.__prefetch)
+            self._receiver.start()
         return to_return
 
 
@@ -136,7 +268,7 @@ class Console:
                 if not using the default
             environment_vars (dict, optional): Dict (string->string) of environment variables to set
         """
-        if self.path:
+        if self.path and not self.replay:
             command = [os.path.normpath(self.path)]
             if platform.system() == "Darwin": #mac
                 command.insert(0, "open") #can't run directly on mac, gotta call open on it
@@ -154,42 +286,95 @@ class Console:
                 for var, value in environment_vars.items():
                     env[var] = value
             #print(command)
+            started = time.perf_counter()
             try:
                 self._process = subprocess.Popen(command, env=env)
             except PermissionError:
                     print("Access denied to your Dolphin executable! Can't open Dolphin automatically")
             except FileNotFoundError:
                 print("Path to your Dolphin executable is incorrect! Can't open Dolphin automatically")              
+            else:
+                STARTUP.record("launch", started)
+                threading.Thread(target=self._watch_dolphin, name="Dolphin watcher", daemon=True).start()
+
+    def _watch_dolphin(self):
+        """ Wait for Dolphin to exit, then wake up step() so it can exit too """
+        self._process.wait()
+        self._dolphin_closed.set()
+        try:
+            self._receiver.messages.put_nowait([])
+        except queue.Full:
+            pass #step() is busy with messages anyway, it'll see the flag soon
 
     def stop(self):
         """ Stop the console.
         For Dolphin instances, this will kill the dolphin process.
         For Wiis and SLP files, it just shuts down our connection
          """
-        if self.path:
-            self._slippstream.shutdown()
-            # If dolphin, kill the process
-            if self._process is not None:
-                self._process.terminate()
+        self._receiver.stop()
+        self._slippstream.shutdown()
+        if self._watcher is not None:
+            self._watcher.stop()
+        if self.tracks is not None:
+            self.tracks.close()
+        if self._player is not None:
+            self._player.close()
+        # If dolphin, kill the process
+        if self._process is not None:
+            self._process.terminate()
+
+    @property
+    def music_failed(self):
+        """(bool): True if the music couldn't be loaded. Only final once wait_ready() returns"""
+        return self._music_failed
+
+    @property
+    def finished(self):
+        """(bool): True once the replay has been played to the end. Always False for Dolphin / Wii"""
+        return (getattr(self._slippstream, "finished", False) and self._receiver.messages.empty()
+                and self._batch_index == len(self._batch))
 
 
 
     def step(self):
         """ 'step' to the next state of the game and flushes all controllers
+        Returns early, without a frame ending, if the replay being played is finished or
+        the music couldn't be loaded
         Returns:
             GameState object that represents new current state of the game"""
         frame_ended = False
         while not frame_ended:
-            if(self._current_loop is not None):
-                mixer.music.queue(self._current_loop)
-            if(self._process is not None and self._process.poll() is not None):
-                print("Dolphin closed! Exiting...")
-                sys.exit(0)
-            message = self._slippstream.dispatch()
-            if(message and message["type"] == "connect_reply"):
+            if(self._batch_index == len(self._batch)):
+                if(self._dolphin_closed.is_set()):
+                    print("Dolphin closed! Exiting...")
+                    sys.exit(0)
+                if(self._music_failed):
+                    return None #the caller checks music_failed and exits on the main thread
+                try:
+                    self._batch = self._receiver.messages.get(timeout = 1)
+                except queue.Empty:
+                    if self.finished:
+                        return None
+                    continue
+                self._batch_index = 0
+                continue #the batch may be empty, if it was the Dolphin watcher waking us up
+            message = self._batch[self._batch_index]
+            self._batch_index += 1
+            if(message["type"] == "connect_reply"):
                 self.cursor = message["cursor"]
-            if message and message["type"] == "game_event" and len(message["payload"]) > 0:
-                frame_ended = self.__handle_slippstream_events(base64.b64decode(message["payload"]))
+                # A second handshake means the connection dropped. Events from before the
+                # drop may be sent again, don't restart the music over them
+                self._resyncing = self._connected
+                self._connected = True
+            if message["type"] == "game_event" and len(message["payload"]) > 0:
+                if METRICS.enabled and "decoded_at" in message:
+                    started = time.perf_counter()
+                    METRICS.observe("queue", started - message["decoded_at"])
+                    self._received_at = message["received_at"]
+                    frame_ended = self.__handle_slippstream_events(message["payload"])
+                    METRICS.observe("parse", time.perf_counter() - started)
+                else:
+                    frame_ended = self.__handle_slippstream_events(message["payload"])
             else:
                 continue
         return None
@@ -202,100 +387,230 @@ class Console:
         return gamestate"""
 
     def __handle_slippstream_events(self, event_bytes):
-        """ Handle a series of events, provided sequentially in a byte array """
-        #gamestate.menu_state = enums.Menu.IN_GAME
-        while len(event_bytes) > 0:
-            event_size = self.eventsize[event_bytes[0]]
-            if len(event_bytes) < event_size:
+        """ Handle a series of events, provided sequentially in a byte array
+
+        The buffer is walked with an offset into a memoryview rather than sliced, and each
+        event is dispatched on its command byte through self._handlers, which is filled in
+        from the sizes announced by the PAYLOADS event.
+        Returns:
+            True if a frame ended, False otherwise"""
+        view = memoryview(event_bytes)
+        end = len(view)
+        offset = 0
+        eventsize = self.eventsize
+        handlers = self._handlers
+        while offset < end:
+            command = view[offset]
+            if command == _PAYLOADS:
+                offset = self.__handle_payloads(view, offset)
+                if offset < 0:
+                    return False
+                continue
+            event_size = eventsize[command]
+            if event_size == 0:
+                print("WARNING: Something went wrong unpacking events. " + \
+                    "Data is probably missing")
+                print("\tGot invalid event type: ", command)
+                return False
+            if end - offset < event_size:
                 print("WARNING: Something went wrong unpacking events. Data is probably missing")
                 print("\tDidn't have enough data for event")
                 return False
-            if EventType(event_bytes[0]) == EventType.PAYLOADS:
-                cursor = 0x2
-                payload_size = event_bytes[1]
-                num_commands = (payload_size - 1) // 3
-                for i in range(0, num_commands):
-                    command = int(event_bytes[cursor])
-                    command_len = (int(event_bytes[cursor + 0x1]) << 8) + int(event_bytes[cursor + 0x2])
-                    self.eventsize[command] = command_len+1
-                    cursor += 3
-                event_bytes = event_bytes[payload_size + 1:]
-
-            elif EventType(event_bytes[0]) == EventType.FRAME_START:
-                event_bytes = event_bytes[event_size:]
-
-            elif EventType(event_bytes[0]) == EventType.GAME_START:
-                #self.__game_start(gamestate, event_bytes)
-                print("Game start")
-                self._stocks = [-1]*4
-                stage = (int(event_bytes[0x13]) << 8) + int(event_bytes[0x14])
-                print(stage)
-                if(self.fileNames[stage] != None):
-                    stageFiles = self.fileNames[stage]
-                    self.playMusic(stageFiles[random.randrange(len(stageFiles))])
-                else:
-                    self.stop_music()
-                event_bytes = event_bytes[event_size:]
-
-            elif EventType(event_bytes[0]) == EventType.GAME_END:
-                event_bytes = event_bytes[event_size:]
-                print("Game end")
-                self.stop_music()
-                if(self.menu and self.fileNames[MENU] != None):
-                    if(self._stocks.count(0) >= int((4 - self._stocks.count(-1)) / 2)): #Check if game ended in not LRAS
-                        time.sleep(2) #magic, time that the "GAME" message is on screen in melee
-                    stageFiles = self.fileNames[MENU]
-                    self.playMusic(stageFiles[random.randrange(len(stageFiles))])
-                return False
+            handler = handlers[command]
+            if handler is not None:
+                frame_ended = handler(view, offset)
+                if frame_ended is not None:
+                    return frame_ended
+            offset += event_size
+        return False
 
-            elif(EventType(event_bytes[0]) in [EventType.PRE_FRAME, EventType.GECKO_CODES, EventType.ITEM_UPDATE]):
-                event_bytes = event_bytes[event_size:]
-                
-            elif EventType(event_bytes[0]) == EventType.POST_FRAME:
-                self._stocks[event_bytes[0x5]] = event_bytes[0x21]
-                event_bytes = event_bytes[event_size:]
-                
-            elif EventType(event_bytes[0]) == EventType.FRAME_BOOKEND:
-                #self.__frame_bookend(gamestate, event_bytes)
-                event_bytes = event_bytes[event_size:]
-                # If this is an old frame, then don't return it.
-                #if gamestate.frame <= self._frame:
-                    #return False
-                #self._frame = gamestate.frame
-                return True
+    def __handle_payloads(self, view, offset):
+        """ Read the event sizes out of a PAYLOADS event and rebuild the handler table
+        Returns:
+            The offset of the next event, or -1 if the event was truncated"""
+        payload_size = view[offset + 0x1]
+        if len(view) - offset < payload_size + 1:
+            print("WARNING: Something went wrong unpacking events. Data is probably missing")
+            print("\tDidn't have enough data for event")
+            return -1
+        cursor = offset + 0x2
+        for i in range((payload_size - 1) // 3):
+            command = view[cursor]
+            self.eventsize[command] = ((view[cursor + 0x1] << 8) | view[cursor + 0x2]) + 1
+            self._handlers[command] = self._event_handlers.get(command)
+            cursor += 3
+        return offset + payload_size + 1
 
+    def __on_game_start(self, view, offset):
+        stage = (view[offset + 0x13] << 8) | view[offset + 0x14]
+        if self._resyncing:
+            self._resyncing = False
+            if stage == self._stage:
+                print("Resumed game in progress")
+                return
+        print("Game start")
+        self.frames.reset()
+        self._stage = stage
+        print(stage)
+        self._audio.post(self.__start_game, stage, time.perf_counter(), self._received_at)
 
-            else:
-                print("WARNING: Something went wrong unpacking events. " + \
-                    "Data is probably missing")
-                print("\tGot invalid event type: ", event_bytes[0])
-                return False
+    def __on_game_end(self, view, offset):
+        if self._resyncing:
+            self._resyncing = False
+            if self._stage is None:
+                return False #already handled this game end before the connection dropped
+        self._stage = None
+        print("Game end")
+        self._audio.post(self.__end_game, self.frames.stocks())
         return False
-    
-        
-    
-    def playMusic(self, fileName):
+
+    def __on_post_frame(self, view, offset):
+        self.frames.post_frame(view, offset)
+
+    def __on_frame_bookend(self, view, offset):
+        # If this is an old frame, then don't return it.
+        #if gamestate.frame <= self._frame:
+            #return False
+        #self._frame = gamestate.frame
+        return True
+
+    def __reload_library(self, changed):
+        """ Runs on the watcher thread when something in the music folder changes. The new
+        library is indexed and its changed files decoded here, then handed to the audio
+        thread to swap in between two music actions
+        """
+        library = Library(self.library.music_dir, index_path=self.library.index_path)
         try:
-            #print(os.path.dirname(__file__))
-            dirname = os.path.dirname(__file__)
-            musicPath = os.path.normpath(os.path.join(dirname, 'music/' + fileName[0]))
-            print(musicPath)
-            mixer.music.stop()
-            mixer.music.load(musicPath)
-            if(len(fileName) == 1):
-                self._current_loop = None
-                mixer.music.play(-1)
-            else:
-                self._current_loop = os.path.normpath(os.path.join(dirname, 'music/' + fileName[1]))
-                print(self._current_loop)
-                mixer.music.queue(self._current_loop)
-                mixer.music.play()
-        except pg_error:
-            print("Couldn't play the media. Usually means the filename is wrong.")
+            library.load()
+        except (OSError, ValueError):
+            print("Couldn't read " + os.path.normpath(library.config_path) + ", keeping the music library as it was")
+            return
+        old = self.library.info
+        stale = [fileName for fileName in old if fileName not in library.info or
+                 (old[fileName].get("mtime_ns"), old[fileName].get("size")) !=
+                 (library.info[fileName].get("mtime_ns"), library.info[fileName].get("size"))]
+        if self._player is not None:
+            self.tracks.update(library, stale)
+        print("Music library reloaded: %d entries for %d stages (%d files probed)" %
+              (sum(len(entries) for entries in library.stages.values()), len(library.stages), library.probed))
+        for console in [self] + self._followers:
+            console._audio.post(console.__swap_library, library)
+
+    # The methods below run on the audio worker thread
+
+    def __start_game(self, stage, start, received_at=None):
+        self._games += 1
+        if self._menu_timer is not None:
+            self._menu_timer.cancel() #rematch started before the menu music did
+            self._menu_timer = None
+        if(stage in self.library):
+            if stage in self._recent:
+                self._recent.remove(stage)
+            self._recent = self._recent[-(RECENT_STAGES - 1):] + [stage]
+            self.__play_stage(stage)
+            issued = time.perf_counter()
+            if METRICS.enabled:
+                METRICS.observe("game_start_to_audio", issued - start)
+                if received_at is not None:
+                    METRICS.observe("receive_to_audio", issued - received_at)
+            print("Music started %.1f ms after game start" % ((issued - start) * 1000))
+        else:
+            self.stop_music()
+
+    def __end_game(self, stocks):
+        self.stop_music()
+        if(self.menu and MENU in self.library):
+            delay = 0
+            if(stocks.count(0) >= int((4 - stocks.count(-1)) / 2)): #Check if game ended in not LRAS
+                delay = 2 #magic, time that the "GAME" message is on screen in melee
+            self._menu_timer = self._scheduler.call_later(delay, self._audio.post, self.__play_menu, self._games)
+        self.__prefetch()
+        if METRICS.enabled:
+            print(self.stats())
+
+    def __prefetch(self):
+        """ Pick the next song for every stage now, and decode those picks while the players
+        are on the menus: the menu music and the stages played recently first, then the
+        rest while there's room in the cache
+        """
+        if self._player is None or self.tracks is None:
+            return
+        for stage in self.library.stages:
+            if stage not in self._next:
+                self._next[stage] = self.library.pick(stage)
+        first = [stage for stage in reversed(self._recent) if stage in self._next]
+        if self.menu and MENU in self._next:
+            first.insert(0, MENU)
+        self.tracks.prefetch([fileName for stage in first for fileName in self._next[stage]],
+                             [fileName for stage, entry in self._next.items() if stage not in first for fileName in entry])
+
+    def __play_menu(self, game):
+        if game != self._games or MENU not in self.library:
+            return #a game started after this was scheduled
+        self._menu_timer = None
+        self.__play_stage(MENU)
+
+    def __play_stage(self, stage):
+        entry = self._next.pop(stage, None)
+        predicted = entry is not None
+        if not predicted:
+            entry = self.library.pick(stage)
+        if METRICS.enabled:
+            ready = predicted and all(fileName in self.tracks for fileName in entry)
+            METRICS.count("prefetch_hits" if ready else "prefetch_misses")
+        self.playMusic(entry)
+        self._playing = (stage, entry)
+
+    def __swap_library(self, library):
+        """ Switch to a reloaded library. The song that's playing carries on, unless its
+        entry was taken out, in which case another one for the same stage starts
+        """
+        self.library = library
+        self._next = {stage: entry for stage, entry in self._next.items() if entry in library.stages.get(stage, [])}
+        if self._playing is None:
+            return
+        stage, entry = self._playing
+        if entry in library.stages.get(stage, []):
+            return
+        print("The song that was playing was removed from the music library")
+        if stage in library:
+            self.__play_stage(stage)
+        else:
+            self.stop_music()
+
+    def stats(self):
+        """ Queue depth and latency counters for the receiver and audio threads, how full
+        the track cache is and the connection's ENet counters """
+        stats = {"receiver": self._receiver.stats(), "audio": self._audio.stats()}
+        if self._player is not None:
+            from melee.stream import PCMStream
+            stats["player"] = {"underruns": self._player.underruns, "stream_misses": PCMStream.misses}
+        if self.tracks is not None:
+            stats["cache"] = self.tracks.stats()
+        if hasattr(self._slippstream, "stats"): #not for replays
+            stats["connection"] = self._slippstream.stats()
+        return stats
+
+    def playMusic(self, fileName):
+        """ Play an entry from musicConfig.txt: [intro, loop] or just [loop] """
+        if self._player is None:
+            print("Couldn't play the media. The mixer isn't initialized.")
+            return
+        for name in fileName:
+            print(self.tracks.path(name) + ("" if name in self.tracks else " (not preloaded)"))
+        sounds = [self.tracks.get(name) for name in fileName]
+        if None in sounds:
+            return
+        if(len(sounds) == 1):
+            self._player.play(None, sounds[0])
+        else:
+            self._player.play(sounds[0], sounds[1])
     
     
     def stop_music(self):
-        mixer.music.stop()
+        self._playing = None
+        if self._player is not None:
+            self._player.stop(self.fadeout_ms)
     
     def _get_dolphin_config_path(self):
         """ Return the path to dolphin's config directory
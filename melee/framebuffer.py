@@ -0,0 +1,119 @@
+""" Recent per-frame game state, kept from the POST_FRAME events of the game in progress
+The fields the music reacts to (stocks, percent, action state) are unpacked straight out
+of the event buffer into preallocated arrays indexed by frame number, so memory stays flat
+however long a set runs and storing a frame costs the same at frame 10 as at frame 100000.
+Older frames are overwritten once the buffer has gone all the way round.
+"""
+import struct
+from array import array
+
+PORTS = 4
+FIRST_FRAME = -123 #frame number of the first frame of every game
+CAPACITY = 8 * 60 * 60 #frames kept, 8 minutes (a full timed game)
+# POST_FRAME from byte 0x1: frame, port, is follower, (character), action state,
+# (x, y, facing), percent, (shield, last attack, combo, last hit by), stocks
+POST_FRAME = struct.Struct(">iBBxH12xf7xB")
+
+class FrameBuffer():
+    """ Ring buffer of the last CAPACITY frames of the game in progress, for all four ports """
+
+    def __init__(self, capacity=CAPACITY):
+        """ Constructor for this object
+        Args:
+            capacity (int): How many frames to keep
+        """
+        self.capacity = capacity
+        size = capacity * PORTS
+        self._arrays = {
+            "stocks": array('b', bytes(size)),
+            "percent": array('f', bytes(size * 4)),
+            "action": array('H', bytes(size * 2)),
+        }
+        self.first = None
+        """(int): Frame number of the first frame of the game, None before one arrives"""
+        self.latest = None
+        """(int): Frame number of the latest frame, None before one arrives"""
+        self._stocks = [-1] * PORTS
+        self._stock_lost = [None] * PORTS
+
+    def reset(self):
+        """ Forget the last game, when a new one starts. Nothing is reallocated """
+        self.first = None
+        self.latest = None
+        self._stocks = [-1] * PORTS
+        self._stock_lost = [None] * PORTS
+
+    def post_frame(self, view, offset):
+        """ Store a POST_FRAME event
+        Args:
+            view (memoryview): The event buffer
+            offset (int): Where the event starts (its command byte)
+        """
+        frame, port, follower, action, percent, stocks = POST_FRAME.unpack_from(view, offset + 0x1)
+        if follower or port >= PORTS:
+            return #Nana, who shares Popo's stocks
+        if self.first is None:
+            self.first = frame
+        if self.latest is None or frame > self.latest:
+            self.latest = frame
+        if stocks < self._stocks[port]:
+            self._stock_lost[port] = frame
+        self._stocks[port] = stocks
+        cell = (frame - FIRST_FRAME) % self.capacity * PORTS + port
+        arrays = self._arrays
+        arrays["stocks"][cell] = stocks
+        arrays["percent"][cell] = percent
+        arrays["action"][cell] = action
+
+    def stocks(self):
+        """ Stocks left per port, -1 for ports that aren't playing """
+        return list(self._stocks)
+
+    def get(self, field, port, frame=None):
+        """ One field for one port, at a frame (the latest by default)
+        Args:
+            field (str): "stocks", "percent" or "action"
+        Returns:
+            The value, or None if that frame isn't in the buffer or the port isn't playing
+        """
+        if frame is None:
+            frame = self.latest
+        if self._stocks[port] < 0 or frame is None or not self._oldest() <= frame <= self.latest:
+            return None
+        return self._arrays[field][(frame - FIRST_FRAME) % self.capacity * PORTS + port]
+
+    def history(self, field, port, frames=None):
+        """ One field for one port over the last few frames, oldest first
+        Args:
+            field (str): "stocks", "percent" or "action"
+            frames (int): How many frames back to go, everything in the buffer by default
+        Returns:
+            array of the values, empty if the port isn't playing
+        """
+        values = self._arrays[field]
+        if self._stocks[port] < 0 or self.latest is None:
+            return values[0:0]
+        count = self.latest - self._oldest() + 1
+        if frames is not None:
+            count = min(count, frames)
+        end = (self.latest - FIRST_FRAME) % self.capacity + 1
+        start = end - count
+        if start >= 0:
+            return values[start * PORTS + port:end * PORTS:PORTS]
+        # Wrapped around the end of the buffer
+        return values[(self.capacity + start) * PORTS + port::PORTS] + values[port:end * PORTS:PORTS]
+
+    def last_stock_lost(self, port=None):
+        """ Frame number a port (any port by default) last lost a stock on, None if nobody has """
+        lost = self._stock_lost if port is None else [self._stock_lost[port]]
+        lost = [frame for frame in lost if frame is not None]
+        return max(lost) if lost else None
+
+    def frames_since_stock_lost(self, port=None):
+        """ Frames since a port (any port by default) last lost a stock, None if nobody has """
+        lost = self.last_stock_lost(port)
+        return None if lost is None else self.latest - lost
+
+    def _oldest(self):
+        """ Frame number of the oldest frame still in the buffer """
+        return max(self.first, self.latest - self.capacity + 1)
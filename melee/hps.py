@@ -0,0 +1,326 @@
+""" Extracts Melee's music from the game disc
+Melee's music is in .hps files ("HALPST" streams) in the /audio folder of the GameCube
+filesystem. An .hps file is a chain of blocks of DSP-ADPCM data, and a looping track's last
+block points back to the block the loop starts at, so splitting the decoded track at that
+block gives intro and loop files cut at exactly the right sample, with no manual editing.
+
+Every block header carries the decoder state for the start of the block, so blocks (and
+files) can be decoded independently; files are decoded in a process pool.
+The tracks are 32kHz, and they're resampled to the mixer's rate here rather than when they
+load. Resampled on their own, the intro and loop files would each start and end with a
+resampler in a different state, and the seams would no longer line up with the sample.
+Run "python -m melee.hps --help" for the command line options, or set extract_music in
+config.txt to extract from the iso_path there.
+"""
+import argparse
+import concurrent.futures
+import mmap
+import os
+import posixpath
+import struct
+import sys
+import time
+import warnings
+import wave
+from array import array
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop as _audioop #for resampling, gone in Python 3.13
+    except ImportError:
+        _audioop = None
+
+MAGIC = b" HALPST\0"
+HEADER_SIZE = 0x80
+CHANNEL_HEADER = 0x38
+BLOCK_HEADER = 0x20
+END = 0xFFFFFFFF #next block offset of the last block of a track that doesn't loop
+MIXER_RATE = 44100 #the rate SlippiMusic opens the mixer at
+
+# Tracks with a stage (or the menu) in musicConfig.txt, by file name: (stage ID, name)
+TRACKS = {
+    "izumi": ("2", "fountain"),
+    "pstadium": ("3", "pstadium"),
+    "ystory": ("8", "ystory"),
+    "old_kb": ("28", "dreamland"),
+    "hyaku": ("31", "battlefield"),
+    "hyaku2": ("31", "battlefield-alt"),
+    "sp_end": ("32", "final"),
+    "menu01": ("menu", "menu01"),
+    "menu02": ("menu", "menu02"),
+    "menu3": ("menu", "menu3"),
+}
+
+class HPS():
+    """ The layout of an .hps file: format, DSP coefficients and blocks """
+
+    def __init__(self, data, offset=0, size=None):
+        """ Parse the headers of an .hps file
+        Args:
+            data: Buffer holding the file (can be the whole disc)
+            offset (int): Where the file starts in data
+            size (int): Length of the file, to check block offsets against
+        Raises:
+            ValueError if it isn't a valid .hps file
+        """
+        if size is None:
+            size = len(data) - offset
+        if bytes(data[offset:offset + 8]) != MAGIC:
+            raise ValueError("not an HPS file")
+        self.sample_rate, self.channels = struct.unpack_from(">II", data, offset + 0x8)
+        if not 1 <= self.channels <= 2:
+            raise ValueError("unsupported channel count " + str(self.channels))
+        self.coefficients = []
+        """(list): Per channel, 8 (coefficient 1, coefficient 2) pairs"""
+        for channel in range(self.channels):
+            coefs = struct.unpack_from(">16h", data, offset + 0x10 + channel * CHANNEL_HEADER + 0x10)
+            self.coefficients.append([(coefs[i], coefs[i + 1]) for i in range(0, 16, 2)])
+        self.blocks = []
+        """(list): (offset in data, bytes per channel, samples, [(ps, hist1, hist2) per channel])"""
+        self.loop_block = None
+        """(int): Index of the block the loop starts at, None if the track doesn't loop"""
+        starts = {}
+        block = HEADER_SIZE
+        while block != END:
+            if block in starts:
+                self.loop_block = starts[block]
+                break
+            if block + BLOCK_HEADER > size:
+                raise ValueError("block outside the file")
+            length, end_nibble, next_block = struct.unpack_from(">III", data, offset + block)
+            per_channel = length // self.channels
+            if block + BLOCK_HEADER + length > size:
+                raise ValueError("block outside the file")
+            contexts = [struct.unpack_from(">Hhh", data, offset + block + 0xC + channel * 8)
+                        for channel in range(self.channels)]
+            samples = min(nibbles_to_samples(end_nibble + 1), per_channel // 8 * 14)
+            starts[block] = len(self.blocks)
+            self.blocks.append((offset + block + BLOCK_HEADER, per_channel, samples, contexts))
+            block = next_block
+
+    @property
+    def loop_start(self):
+        """ The sample the loop starts at, None if the track doesn't loop """
+        if self.loop_block is None:
+            return None
+        return sum(samples for start, per_channel, samples, contexts in self.blocks[:self.loop_block])
+
+    def decode(self, data):
+        """ Decode the whole track
+        Returns:
+            array('h') of interleaved 16-bit PCM
+        """
+        channels = [array('h') for channel in range(self.channels)]
+        for start, per_channel, samples, contexts in self.blocks:
+            for channel, out in enumerate(channels):
+                ps, hist1, hist2 = contexts[channel]
+                decode_dsp(data, start + channel * per_channel, samples, self.coefficients[channel],
+                           hist1, hist2, out)
+        if self.channels == 1:
+            return channels[0]
+        pcm = array('h', bytes(len(channels[0]) * 4))
+        pcm[0::2] = channels[0]
+        pcm[1::2] = channels[1]
+        return pcm
+
+def nibbles_to_samples(nibbles):
+    """ Samples in a DSP stream of this many nibbles (every 16 nibbles has a 2 nibble header) """
+    frames, extra = divmod(nibbles, 16)
+    return frames * 14 + max(0, extra - 2)
+
+# For every frame header: (nibble value << scale) << 11, plus rounding, for all 16 nibbles
+_SCALED = [[((nibble - 16 if nibble >= 8 else nibble) << (header & 0xF) << 11) + 1024 for nibble in range(16)]
+           for header in range(256)]
+
+def decode_dsp(data, offset, samples, coefficients, hist1, hist2, out):
+    """ Decode one channel of DSP-ADPCM, appending to out
+    Args:
+        data: Buffer holding the encoded frames (8 bytes for every 14 samples)
+        offset (int): Where the first frame starts
+        samples (int): How many samples to decode
+        coefficients (list): The channel's 8 (coefficient 1, coefficient 2) pairs
+        hist1, hist2 (int): The previous two samples
+        out (array): array('h') to append to
+    """
+    decoded = []
+    append = decoded.append
+    remaining = samples
+    while remaining > 0:
+        header = data[offset]
+        c1, c2 = coefficients[(header >> 4) & 0x7]
+        scaled = _SCALED[header]
+        for byte in data[offset + 1:offset + 8]:
+            for nibble in (byte >> 4, byte & 0xF):
+                sample = (scaled[nibble] + c1 * hist1 + c2 * hist2) >> 11
+                if sample > 32767:
+                    sample = 32767
+                elif sample < -32768:
+                    sample = -32768
+                append(sample)
+                hist2 = hist1
+                hist1 = sample
+        offset += 8
+        remaining -= 14
+    if remaining < 0:
+        del decoded[remaining:]
+    out.extend(decoded)
+
+def iso_files(data, folder="/audio"):
+    """ List a folder of a GameCube disc image
+    Args:
+        data: Buffer holding the disc image
+        folder (str): Path of the folder in the disc's filesystem
+    Returns:
+        dict of file name -> (offset, size)
+    Raises:
+        ValueError if it isn't a GameCube disc image
+    """
+    fst_offset, fst_size = struct.unpack_from(">II", data, 0x424)
+    if fst_offset + fst_size > len(data) or fst_size < 12:
+        raise ValueError("not a GameCube disc image")
+    entries = struct.unpack_from(">I", data, fst_offset + 8)[0]
+    strings = fst_offset + entries * 12
+    if strings > fst_offset + fst_size:
+        raise ValueError("not a GameCube disc image")
+    files = {}
+    parents = [(entries, "")] #(index the directory ends at, its path)
+    for index in range(1, entries):
+        while index >= parents[-1][0]:
+            parents.pop()
+        flags_name, offset, size = struct.unpack_from(">III", data, fst_offset + index * 12)
+        name_start = strings + (flags_name & 0xFFFFFF)
+        name = bytes(data[name_start:data.find(b"\0", name_start)]).decode("ascii", "replace")
+        path = parents[-1][1] + "/" + name
+        if flags_name >> 24: #a directory; size is the index of the entry after its contents
+            parents.append((size, path))
+        elif posixpath.dirname(path).lower() == folder.lower():
+            files[name] = (offset, size)
+    return files
+
+def extract(iso_path, out_dir, everything=False, processes=None, rate=MIXER_RATE):
+    """ Decode Melee's music to WAV files, with a musicConfig.txt for them
+    Args:
+        iso_path (str): The Melee disc image
+        out_dir (str): Folder to write the WAV files and musicConfig.txt to
+        everything (bool): Extract every track, not just the ones in TRACKS
+        processes (int): Size of the process pool, None for one per CPU
+        rate (int): Sample rate to write the WAV files at, None to keep the tracks' own.
+            Without audioop, the tracks' own rate is kept
+    Returns:
+        List of (track name, intro file or None, loop file) that were written
+    Raises:
+        OSError if the disc can't be read, ValueError if it isn't a GameCube disc
+    """
+    with open(iso_path, "rb") as iso:
+        data = mmap.mmap(iso.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        files = iso_files(data)
+    finally:
+        data.close()
+    tracks = sorted(name[:-4] for name in files if name.lower().endswith(".hps"))
+    if not everything:
+        tracks = [track for track in tracks if track in TRACKS]
+    os.makedirs(out_dir, exist_ok=True)
+    if rate is not None and _audioop is None:
+        print("Can't resample without audioop, the music will be resampled as it loads and the loop points may click")
+        rate = None
+    jobs = [(iso_path, files[track + ".hps"], track, out_dir, rate) for track in tracks]
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        written = [result for result in pool.map(_extract_track, jobs) if result is not None]
+    write_config(written, out_dir)
+    return written
+
+def write_config(written, out_dir):
+    """ Write a musicConfig.txt for the extracted tracks that have a stage
+    The file names in it are relative to melee/music, assuming out_dir is inside it.
+    """
+    music_dir = os.path.join(os.path.dirname(__file__), "music")
+    relative = os.path.relpath(out_dir, music_dir)
+    prefix = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+    lines = []
+    for track, intro, loop in written:
+        if track not in TRACKS:
+            continue
+        stage = TRACKS[track][0]
+        files = [intro, loop] if intro is not None else [loop]
+        lines.append(stage + ":" + ":".join(prefix + name for name in files))
+    with open(os.path.join(out_dir, "musicConfig.txt"), "w") as configFile:
+        configFile.write("\n".join(lines) + "\n")
+
+def _extract_track(job):
+    """ Decode one .hps file from the disc and write its WAV file(s). Runs in the pool """
+    iso_path, (offset, size), track, out_dir, rate = job
+    with open(iso_path, "rb") as iso:
+        data = mmap.mmap(iso.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        hps = HPS(data, offset, size)
+        pcm = hps.decode(data)
+    except (ValueError, struct.error, IndexError) as e:
+        print("Couldn't decode " + track + ".hps: " + str(e))
+        return None
+    finally:
+        data.close()
+    name = TRACKS[track][1] if track in TRACKS else track
+    loop_start = hps.loop_start
+    if rate is None or rate == hps.sample_rate:
+        rate = hps.sample_rate
+    else:
+        pcm, loop_start = resample(pcm, hps.channels, hps.sample_rate, rate, loop_start)
+    if loop_start is None:
+        _write_wav(os.path.join(out_dir, name + ".wav"), pcm, hps.channels, rate)
+        return track, None, name + ".wav"
+    split = loop_start * hps.channels
+    intro = None
+    if split > 0:
+        intro = name + "-intro.wav"
+        _write_wav(os.path.join(out_dir, intro), pcm[:split], hps.channels, rate)
+    _write_wav(os.path.join(out_dir, name + "-loop.wav"), pcm[split:], hps.channels, rate)
+    return track, intro, name + "-loop.wav"
+
+def resample(pcm, channels, rate, new_rate, loop_start=None):
+    """ Resample a decoded track in one pass, so the loop seams stay continuous
+    The loop's start is resampled again after its end, so the end of the loop leads into its
+    start the way it does when it repeats. The loop is rounded to a whole number of samples
+    at the new rate.
+    Args:
+        pcm (array): 16-bit samples, channels interleaved
+        loop_start (int): Sample the loop starts at, None if the track doesn't loop
+    Returns:
+        (array of the resampled samples, the loop start at the new rate or None)
+    """
+    frames = len(pcm) // channels
+    if loop_start is None or loop_start >= frames:
+        converted = _audioop.ratecv(pcm.tobytes(), 2, channels, rate, new_rate, None)[0]
+        return array('h', converted), None
+    lead = min(frames - loop_start, rate // 100) * channels #10ms of the loop's start
+    source = pcm + pcm[loop_start * channels:loop_start * channels + lead]
+    converted = array('h', _audioop.ratecv(source.tobytes(), 2, channels, rate, new_rate, None)[0])
+    new_start = round(loop_start * new_rate / rate)
+    new_end = new_start + max(1, round((frames - loop_start) * new_rate / rate))
+    return converted[:new_end * channels], new_start
+
+def _write_wav(path, pcm, channels, rate):
+    if sys.byteorder == "big":
+        pcm = array('h', pcm)
+        pcm.byteswap() #WAV is little-endian
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract Melee's music from the game disc, cut at the loop points")
+    parser.add_argument("iso", help="the Melee disc image (.iso)")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(__file__), "music", "extracted"),
+                        help="folder to write the music and its musicConfig.txt to (default melee/music/extracted)")
+    parser.add_argument("--all", action="store_true", help="extract every track, not just the stages in musicConfig.txt")
+    parser.add_argument("--processes", type=int, default=None, help="decoding processes (default: one per CPU)")
+    parser.add_argument("--rate", type=int, default=MIXER_RATE, help="sample rate to write at (default %d, SlippiMusic's), 0 to keep the tracks' own" % MIXER_RATE)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    written = extract(args.iso, args.out, args.all, args.processes, args.rate or None)
+    print("Extracted %d tracks to %s in %.1f s" % (len(written), args.out, time.perf_counter() - started))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+""" The music library described by musicConfig.txt
+Every line of the config is "stageID:intro-filename:loop-filename" (or just one filename
+to loop), optionally followed by a weight: "31:battlefield-intro.mp3:battlefield-loop.mp3:9"
+is picked 9 times as often as an entry with the default weight of 1. Repeating a line adds
+its weights together, so configs written before weights existed still work. Any integer is
+accepted as a stage ID, so modded stages can have music too, and "menu" is the menu music.
+
+At startup every referenced file is checked for existence and probed for its duration,
+sample rate and channel count by reading its headers, in a process pool when there are
+many to probe. The results are kept in an index file next to the config and reused for
+files whose modification time and size haven't changed. Entries with missing or unreadable
+files are reported and left out, instead of failing when they're picked mid-set.
+Picks use an alias table per stage, so they take constant time however many entries a
+stage has.
+"""
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+import struct
+
+MENU = 0 #"Stage ID" for the menu music. In reality, 0 is a DUMMY stage which crashes the game.
+INDEX_VERSION = 2
+PARALLEL_MIN = 16 #probe in a process pool only when there are at least this many files to probe
+
+class AliasTable():
+    """ Constant-time weighted random choice (Vose's alias method) """
+
+    def __init__(self, weights):
+        """ Constructor for this object
+        Args:
+            weights (list): Positive weight of each choice
+        """
+        count = len(weights)
+        total = sum(weights)
+        scaled = [weight * count / total for weight in weights]
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # Whatever is left over is 1 up to rounding error, and already has probability 1
+
+    def sample(self, rng=random):
+        """ Index of a random choice, in proportion to its weight """
+        i = rng.randrange(len(self.probability))
+        return i if rng.random() < self.probability[i] else self.alias[i]
+
+class Library():
+    """ Entries per stage ID, with the probed details of every file they use """
+
+    def __init__(self, music_dir, config_path=None, index_path=None):
+        """ Constructor for this object
+        Args:
+            music_dir (str): Folder the file names in the config are relative to
+            config_path (str): The musicConfig.txt to read. Defaults to the one in music_dir
+            index_path (str): Where to keep the probe results between runs, or None to
+                probe every file every time
+        """
+        self.music_dir = music_dir
+        self.config_path = config_path or os.path.join(music_dir, "musicConfig.txt")
+        self.index_path = index_path
+        self.stages = {}
+        """(dict): stage ID -> list of entries, each a list of file names: [intro, loop] or [loop]"""
+        self.weights = {}
+        """(dict): stage ID -> list of weights, one per entry"""
+        self.info = {}
+        """(dict): file name -> probe result (see probe())"""
+        self.probed = 0
+        self._tables = {}
+
+    def __contains__(self, stage):
+        return stage in self._tables
+
+    def path(self, fileName):
+        """ Full path of a file from the config """
+        return os.path.normpath(os.path.join(self.music_dir, fileName))
+
+    def load(self):
+        """ Read the config and probe the files it uses
+        Raises:
+            OSError if the config can't be read, ValueError (UnicodeDecodeError) if it isn't text
+        """
+        with open(self.config_path) as configFile:
+            stages, weights = parse_config(configFile)
+        files = sorted({fileName for entries in stages.values() for entry in entries for fileName in entry})
+        self.info = self._probe_all(files)
+        for stage in list(stages):
+            keep = [i for i, entry in enumerate(stages[stage])
+                    if all(self.info[fileName]["error"] is None for fileName in entry)]
+            stages[stage] = [stages[stage][i] for i in keep]
+            weights[stage] = [weights[stage][i] for i in keep]
+            if not stages[stage]:
+                del stages[stage]
+                del weights[stage]
+        for fileName in files:
+            if self.info[fileName]["error"] is not None:
+                print("Skipping " + self.path(fileName) + ": " + self.info[fileName]["error"])
+        self.stages = stages
+        self.weights = weights
+        self._tables = {stage: AliasTable(weights[stage]) for stage in stages}
+
+    def pick(self, stage, rng=random):
+        """ A random entry for a stage, in proportion to the weights
+        Returns:
+            List of file names ([intro, loop] or [loop]), or None if the stage has no music
+        """
+        table = self._tables.get(stage)
+        if table is None:
+            return None
+        return self.stages[stage][table.sample(rng)]
+
+    def odds(self):
+        """ For every file in the library, its highest chance of being picked on any stage """
+        odds = {}
+        for stage, entries in self.stages.items():
+            total = sum(self.weights[stage])
+            for entry, weight in zip(entries, self.weights[stage]):
+                for fileName in entry:
+                    odds[fileName] = max(odds.get(fileName, 0), weight / total)
+        return odds
+
+    def _probe_all(self, files):
+        """ Probe results for files, from the index where it's still valid """
+        index = self._read_index()
+        info = {}
+        stale = []
+        for fileName in files:
+            try:
+                stat = os.stat(self.path(fileName))
+            except OSError:
+                info[fileName] = {"error": "file not found"}
+                continue
+            cached = index.get(fileName)
+            if cached is not None and cached["mtime_ns"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+                info[fileName] = cached
+            else:
+                stale.append(fileName)
+        paths = [self.path(fileName) for fileName in stale]
+        if len(stale) >= PARALLEL_MIN:
+            # Spawned rather than forked: this runs while other threads (and their locks) are live
+            with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as pool:
+                results = list(pool.map(probe, paths, chunksize=4))
+        else:
+            results = [probe(path) for path in paths]
+        info.update(zip(stale, results))
+        self.probed = len(stale)
+        if stale:
+            self._write_index(info)
+        return info
+
+    def _read_index(self):
+        if not self.index_path:
+            return {}
+        try:
+            with open(self.index_path) as indexFile:
+                index = json.load(indexFile)
+        except (OSError, ValueError):
+            return {}
+        if index.get("version") != INDEX_VERSION or index.get("music_dir") != os.path.abspath(self.music_dir):
+            return {}
+        return index.get("files", {})
+
+    def _write_index(self, info):
+        if not self.index_path:
+            return
+        index = {"version": INDEX_VERSION,
+                 "music_dir": os.path.abspath(self.music_dir),
+                 "files": {fileName: result for fileName, result in info.items() if "mtime_ns" in result}}
+        temp_path = self.index_path + ".tmp"
+        try:
+            with open(temp_path, "w") as indexFile:
+                json.dump(index, indexFile)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print("Couldn't write the music index to " + self.index_path + ": " + str(e))
+
+def parse_config(lines):
+    """ Parse the lines of a musicConfig.txt
+    Returns:
+        (stages, weights): dicts of stage ID -> list of entries, and -> list of weights
+    """
+    stages = {}
+    weights = {}
+    for line in lines:
+        split = [field.strip() for field in line.split(":")]
+        if len(split) < 2:
+            continue
+        try:
+            stageID = int(split[0])
+        except ValueError:
+            if split[0].lower() == "menu":
+                stageID = MENU
+            else:
+                continue
+        entry = split[1:]
+        weight = 1.0
+        if len(entry) > 1:
+            try:
+                weight = float(entry[-1])
+            except ValueError:
+                pass
+            else:
+                entry = entry[:-1]
+        if weight <= 0 or not all(entry):
+            continue
+        entries = stages.setdefault(stageID, [])
+        stageWeights = weights.setdefault(stageID, [])
+        if entry in entries:
+            stageWeights[entries.index(entry)] += weight
+        else:
+            entries.append(entry)
+            stageWeights.append(weight)
+    return stages, weights
+
+def probe(path):
+    """ Check a music file and read its details from its headers, without decoding it
+    Returns:
+        dict with "mtime_ns", "size", "duration" (seconds), "rate" (Hz), "channels" and
+        "error" (None unless the file can't be read or is empty). The details are None for
+        formats that can't be probed, or headers the probers don't understand; pygame may
+        still be able to play those.
+    """
+    result = {"duration": None, "rate": None, "channels": None, "error": None}
+    extension = os.path.splitext(path)[1].lower()
+    prober = _PROBERS.get(extension)
+    try:
+        stat = os.stat(path)
+        result["mtime_ns"] = stat.st_mtime_ns
+        result["size"] = stat.st_size
+        with open(path, "rb") as musicFile:
+            head = musicFile.read(64 * 1024)
+            musicFile.seek(max(0, stat.st_size - 64 * 1024))
+            tail = musicFile.read()
+            if not head:
+                result["error"] = "the file is empty"
+                return result
+            if prober is not None:
+                try:
+                    details = prober(musicFile, head, tail, stat.st_size)
+                except (struct.error, IndexError, ValueError, ZeroDivisionError):
+                    details = None
+                if details is not None:
+                    result["duration"], result["rate"], result["channels"] = details
+    except OSError as e:
+        result["error"] = "couldn't read the file (" + str(e) + ")"
+    return result
+
+_MP3_BITRATES = { #kbps by (MPEG-1?, layer), indexed by the bitrate field
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def _probe_mp3(musicFile, head, tail, size):
+    start = 0
+    base = 0 #where head starts in the file
+    if head[:3] == b"ID3":
+        start = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9])
+        if head[5] & 0x10:
+            start += 10 #footer
+        if start + 4 > len(head):
+            # A big tag (usually cover art), the first frame is past what was read
+            musicFile.seek(start)
+            head = musicFile.read(64 * 1024)
+            base = start
+            start = 0
+    for offset in range(start, len(head) - 4):
+        if head[offset] != 0xFF or head[offset + 1] & 0xE0 != 0xE0:
+            continue
+        version = (head[offset + 1] >> 3) & 0x3 #3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5
+        layer = 4 - ((head[offset + 1] >> 1) & 0x3)
+        bitrate_index = head[offset + 2] >> 4
+        rate_index = (head[offset + 2] >> 2) & 0x3
+        if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+            continue #not a frame header, keep looking
+        mpeg1 = version == 3
+        rate = _MP3_RATES[version][rate_index]
+        channels = 1 if head[offset + 3] >> 6 == 3 else 2
+        samples = 384 if layer == 1 else (1152 if mpeg1 or layer == 2 else 576)
+        # A Xing/Info (VBR) header after the side info has the real frame count
+        side_info = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+        xing = offset + 4 + side_info
+        if head[xing:xing + 4] in (b"Xing", b"Info") and struct.unpack_from(">I", head, xing + 4)[0] & 1:
+            frames = struct.unpack_from(">I", head, xing + 8)[0]
+            return frames * samples / rate, rate, channels
+        vbri = offset + 36
+        if head[vbri:vbri + 4] == b"VBRI":
+            frames = struct.unpack_from(">I", head, vbri + 14)[0]
+            return frames * samples / rate, rate, channels
+        bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+        audio = size - base - offset - (128 if tail[-128:-125] == b"TAG" else 0)
+        return audio * 8 / bitrate, rate, channels #constant bitrate
+    return None
+
+def _probe_wav(musicFile, head, tail, size):
+    if head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return None
+    # The data chunk can come after big LIST/bext chunks, so the chunks are read from the file
+    offset = 12
+    rate = channels = block_align = None
+    while offset + 8 <= size:
+        musicFile.seek(offset)
+        header = musicFile.read(24)
+        chunk, length = struct.unpack_from("<4sI", header)
+        if chunk == b"fmt ":
+            channels, rate = struct.unpack_from("<HI", header, 10)
+            block_align = struct.unpack_from("<H", header, 20)[0]
+        elif chunk == b"data" and rate:
+            length = min(length, size - offset - 8)
+            return length / block_align / rate, rate, channels
+        offset += 8 + length + (length & 1)
+    return None
+
+def _probe_ogg(musicFile, head, tail, size):
+    if head[:4] != b"OggS":
+        return None
+    packet = 27 + head[26] #after the page header and its segment table
+    if head[packet:packet + 7] == b"\x01vorbis":
+        channels = head[packet + 11]
+        rate = struct.unpack_from("<I", head, packet + 12)[0]
+        granule_rate = rate
+    elif head[packet:packet + 8] == b"OpusHead":
+        channels = head[packet + 9]
+        rate = struct.unpack_from("<I", head, packet + 12)[0] or 48000
+        granule_rate = 48000 #Opus always counts samples at 48kHz
+    else:
+        return None
+    last = tail.rfind(b"OggS")
+    if last < 0 or last + 14 > len(tail):
+        return None
+    samples = struct.unpack_from("<q", tail, last + 6)[0]
+    return samples / granule_rate, rate, channels
+
+def _probe_flac(musicFile, head, tail, size):
+    if head[:4] != b"fLaC" or head[4] & 0x7F != 0: #STREAMINFO has to be the first block
+        return None
+    info = head[8:8 + 34]
+    rate = (info[10] << 12) | (info[11] << 4) | (info[12] >> 4)
+    channels = ((info[12] >> 1) & 0x7) + 1
+    samples = ((info[13] & 0xF) << 32) | struct.unpack_from(">I", info, 14)[0]
+    return (samples / rate if samples else None), rate, channels
+
+_PROBERS = {".mp3": _probe_mp3, ".wav": _probe_wav, ".ogg": _probe_ogg, ".opus": _probe_ogg, ".flac": _probe_flac}
@@ -0,0 +1,210 @@
+""" Latency histograms for the path from Dolphin sending an event to the music changing
+Timestamps are taken with time.perf_counter() at packet receive, after the JSON/base64
+decode, around event parsing and when the audio command is issued. They're aggregated
+into fixed-bucket histograms that can be written out periodically as JSON or in the
+Prometheus text format, and summarized on shutdown. A few counters (prefetch hits and
+misses, and decoding done for songs that were never played) go along with them.
+Everything is off unless METRICS.enable() is called, in which case the only cost on the
+hot path is checking METRICS.enabled.
+STARTUP, which is always on, times the steps of starting up for the startup report.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in milliseconds. One frame is ~16.7ms
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 16.7, 33.3, 50, 100, 250, 500, 1000)
+
+class Histogram():
+    """ Counts of observed durations per fixed bucket """
+
+    def __init__(self, description):
+        self.description = description
+        self.counts = [0] * (len(BUCKETS_MS) + 1) #last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """ Upper bound of the bucket the p-th percentile falls in (capped at the largest
+        value seen), in milliseconds """
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+class Counter():
+    """ A running total """
+
+    def __init__(self, description):
+        self.description = description
+        self.value = 0
+
+class Metrics():
+    """ The set of latency histograms and counters, see the module docstring """
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {
+            "decode": Histogram("Packet received to JSON/base64 decoded"),
+            "queue": Histogram("Packet decoded to parsing started (receiver queue wait)"),
+            "parse": Histogram("Parsing the events in one packet"),
+            "game_start_to_audio": Histogram("GAME_START parsed to the audio command issued"),
+            "receive_to_audio": Histogram("GAME_START packet received to the audio command issued"),
+        }
+        self.counters = {
+            "prefetch_hits": Counter("Songs started that were picked and decoded ahead of time"),
+            "prefetch_misses": Counter("Songs started that had to be picked or decoded when they started"),
+            "prefetch_decodes": Counter("Files decoded ahead of time by the prefetcher"),
+            "prefetch_decode_seconds": Counter("Time spent decoding files ahead of time"),
+            "prefetch_wasted": Counter("Prefetched files dropped from the cache before they were played"),
+            "prefetch_wasted_seconds": Counter("Time spent decoding prefetched files that were dropped unplayed"),
+        }
+        self._lock = threading.Lock()
+        self._path = None
+        self._interval = 10
+
+    def enable(self, path=None, interval=10):
+        """ Start recording
+        Args:
+            path (str): Write the histograms to this file every interval seconds. Files
+                ending in .json get JSON, anything else the Prometheus text format.
+            interval (float): Seconds between writes
+        """
+        self.enabled = True
+        self._path = path
+        self._interval = interval
+        if path:
+            threading.Thread(target=self._write_periodically, name="Metrics writer", daemon=True).start()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.histograms[name].observe(seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name].value += amount
+
+    def to_json(self):
+        with self._lock:
+            metrics = {name: {"description": histogram.description,
+                              "buckets_ms": list(BUCKETS_MS) + ["+Inf"],
+                              "counts": histogram.counts,
+                              "count": histogram.count,
+                              "sum_ms": histogram.sum,
+                              "max_ms": histogram.max}
+                       for name, histogram in self.histograms.items()}
+            metrics.update({name: {"description": counter.description, "value": counter.value}
+                            for name, counter in self.counters.items()})
+            return json.dumps(metrics, indent=2)
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            for name, histogram in self.histograms.items():
+                metric = "slippimusic_" + name + "_seconds"
+                lines.append("# HELP " + metric + " " + histogram.description)
+                lines.append("# TYPE " + metric + " histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS_MS, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%g"} %d' % (metric, bound / 1000, cumulative))
+                lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram.count))
+                lines.append("%s_sum %g" % (metric, histogram.sum / 1000))
+                lines.append("%s_count %d" % (metric, histogram.count))
+            for name, counter in self.counters.items():
+                metric = "slippimusic_" + name + "_total"
+                lines.append("# HELP " + metric + " " + counter.description)
+                lines.append("# TYPE " + metric + " counter")
+                lines.append("%s %g" % (metric, counter.value))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """ Write the histograms to the file given to enable(), if any """
+        if not self._path:
+            return
+        text = self.to_json() if self._path.lower().endswith(".json") else self.to_prometheus()
+        # Write then rename, so whatever is scraping the file never sees half of it
+        temp_path = self._path + ".tmp"
+        try:
+            with open(temp_path, "w") as out:
+                out.write(text)
+            os.replace(temp_path, self._path)
+        except OSError as e:
+            print("Couldn't write metrics to " + self._path + ": " + str(e))
+
+    def summary(self):
+        """ One line per histogram: count, median, 99th percentile and max, in milliseconds,
+        then the prefetch hit rate and wasted decoding """
+        lines = ["Latency (ms)             count      p50      p99      max"]
+        with self._lock:
+            for name, histogram in self.histograms.items():
+                lines.append("%-22s %8d %8.2f %8.2f %8.2f" % (name, histogram.count, histogram.percentile(50),
+                                                             histogram.percentile(99), histogram.max))
+            counters = {name: counter.value for name, counter in self.counters.items()}
+        started = counters["prefetch_hits"] + counters["prefetch_misses"]
+        if started:
+            lines.append("Prefetch: %d/%d songs ready when they started (%.0f%%), %d of %d prefetched files "
+                         "wasted (%.1f of %.1f s decoding)" %
+                         (counters["prefetch_hits"], started, counters["prefetch_hits"] * 100 / started,
+                          counters["prefetch_wasted"], counters["prefetch_decodes"],
+                          counters["prefetch_wasted_seconds"], counters["prefetch_decode_seconds"]))
+        return "\n".join(lines)
+
+    def _write_periodically(self):
+        while True:
+            time.sleep(self._interval)
+            self.write()
+
+class StartupTimes():
+    """ When each step of starting up began and how long it took, for the startup report.
+    Times are from when this module was imported, which slippiMusic.py does first thing
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = {} #name -> (began, seconds), both in seconds
+        self._lock = threading.Lock()
+
+    def record(self, name, began, ended=None):
+        """ Record a step, unless one with that name was recorded already
+        Args:
+            name (str): The step
+            began (float): time.perf_counter() when the step started
+            ended (float): time.perf_counter() when it finished, now by default
+        """
+        if ended is None:
+            ended = time.perf_counter()
+        with self._lock:
+            self.steps.setdefault(name, (began - self.started, ended - began))
+
+    def to_dict(self):
+        with self._lock:
+            return {name: {"began_ms": began * 1000, "ms": seconds * 1000}
+                    for name, (began, seconds) in self.steps.items()}
+
+    def report(self):
+        """ One line per step, in the order they started """
+        lines = ["Startup (ms)        began     took"]
+        with self._lock:
+            for name, (began, seconds) in sorted(self.steps.items(), key=lambda step: step[1][0]):
+                lines.append("%-16s %8.0f %8.0f" % (name, began * 1000, seconds * 1000))
+        return "\n".join(lines)
+
+METRICS = Metrics()
+STARTUP = StartupTimes()
@@ -0,0 +1,101 @@
+""" On-disk cache of decoded music
+Decoding the MP3s again on every launch is slow on weaker machines, so the decoded PCM of
+each file is written to a cache folder, in the mixer's sample format and cut at exactly the
+same samples as the source. The files are memory-mapped for playback, so the music doesn't
+count towards the program's own memory and the OS can share the pages between runs.
+Files over a size limit are streamed from disk as they play instead (see melee.stream),
+and WAV files can be written a chunk at a time, without decoding them whole first.
+A cache file is keyed by the source's path, modification time and size, and the mixer
+format, so it's rebuilt only when the source file (or the audio setup) changes.
+"""
+import hashlib
+import mmap
+import os
+import struct
+from pygame import mixer
+
+from melee.stream import PCMSource
+
+MAGIC = b"SMPCM1\0\0"
+# magic, source mtime (ns), source size, frequency, sample size (bits, negative if signed), channels
+HEADER = struct.Struct("<8sqqiii")
+
+class PCMCache():
+    """ Folder of decoded tracks, one file per source file """
+
+    def __init__(self, cache_dir):
+        """ Constructor for this object
+        Args:
+            cache_dir (str): Folder to keep the decoded files in. Created if it doesn't exist.
+        """
+        self.cache_dir = cache_dir
+
+    def load(self, source, stream_above=None):
+        """ Map the decoded PCM for a source file, if it's cached and up to date
+        Args:
+            source (str): Path of the music file
+            stream_above (int): Stream files with more than this many bytes of PCM
+                rather than mapping them, None to map every file
+        Returns:
+            A read-only memoryview of the PCM, a PCMSource to stream it from, or None if
+            there's no valid cache file
+        """
+        path = self._cache_path(source)
+        try:
+            stat = os.stat(source)
+            with open(path, "rb") as cachefile:
+                header = cachefile.read(HEADER.size)
+                if len(header) < HEADER.size or HEADER.unpack(header) != self._header(stat):
+                    return None
+                length = os.fstat(cachefile.fileno()).st_size - HEADER.size
+                if stream_above is not None and length > stream_above:
+                    return PCMSource(path, HEADER.size, length)
+                data = mmap.mmap(cachefile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): #ValueError for empty files
+            return None
+        # The map stays open for as long as the view (or a slice of it) is referenced
+        return memoryview(data)[HEADER.size:]
+
+    def store(self, source, sound, stream_above=None):
+        """ Write the decoded PCM of a source file to the cache, then map it
+        Args:
+            source (str): Path of the music file
+            sound (mixer.Sound): The decoded file
+            stream_above (int): See load()
+        Returns:
+            What load() returns for it, or None if it couldn't be written
+        """
+        return self.store_chunks(source, [memoryview(sound).cast('B')], stream_above)
+
+    def store_chunks(self, source, chunks, stream_above=None):
+        """ Write the decoded PCM of a source file to the cache a piece at a time, then map it
+        Args:
+            source (str): Path of the music file
+            chunks: Iterable of PCM buffers in the mixer's format, in order
+            stream_above (int): See load()
+        Returns:
+            What load() returns for it, or None if it couldn't be written
+        """
+        path = self._cache_path(source)
+        temp_path = path + ".tmp"
+        try:
+            stat = os.stat(source)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(temp_path, "wb") as cachefile:
+                cachefile.write(HEADER.pack(*self._header(stat)))
+                for chunk in chunks:
+                    cachefile.write(chunk)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print("Couldn't write " + path + " to the music cache: " + str(e))
+            return None
+        return self.load(source, stream_above)
+
+    def _cache_path(self, source):
+        name = hashlib.sha1(os.path.abspath(source).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".pcm")
+
+    @staticmethod
+    def _header(stat):
+        frequency, size, channels = mixer.get_init()
+        return (MAGIC, stat.st_mtime_ns, stat.st_size, frequency, size, channels)
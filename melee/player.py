@@ -0,0 +1,341 @@
+""" Gapless intro -> loop music playback
+The MusicPlayer mixes the decoded PCM of a track itself and feeds it to a mixer Channel
+in short chunks, so the switch from the end of the intro to the start of the loop (and
+from the end of the loop back to its start) happens at an exact sample.
+Long tracks can be PCMSources, which are read from disk as they play (see melee.stream).
+"""
+import atexit
+import threading
+import time
+import warnings
+from array import array
+from pygame import mixer
+
+from melee.stream import PCMSource, PCMStream
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop as _audioop #for volume and fades, gone in Python 3.13
+    except ImportError:
+        _audioop = None
+
+class MusicPlayer():
+    """ Plays an intro once and then repeats a loop forever on a single mixer Channel """
+
+    def __init__(self, channel, chunk_ms=100, crossfade_ms=0):
+        """ Constructor for this object
+        Args:
+            channel (mixer.Channel): The channel to play on. Nothing else should use it.
+            chunk_ms (int): Length of the PCM chunks handed to the mixer. The feeder thread
+                wakes up about once per chunk, but playback reacts to stop() at most this
+                much later.
+            crossfade_ms (int): Length of the crossfade at the intro -> loop and loop -> loop
+                seams, 0 for a hard cut at the exact loop point
+        """
+        self.channel = channel
+        frequency, size, channels = mixer.get_init()
+        self.frame_size = channels * (abs(size) // 8)
+        self.chunk_size = frequency * chunk_ms // 1000 * self.frame_size
+        self.chunk_seconds = self.chunk_size / self.frame_size / frequency
+        self.crossfade_frames = frequency * crossfade_ms // 1000 if abs(size) == 16 else 0
+        self.sample_size = size
+        self.underruns = 0
+        self._segments = None
+        self._fade = None #(frames left, frames in total) while fading out
+        self._loop_start = 0
+        self._index = 0
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event() #set while there's a track to feed
+        self._kick = threading.Event() #cuts the feeder's sleep short when the track changes
+        self._thread = None
+        self._closed = False
+        # pygame quits the mixer at exit, make sure the feeder is done with it before then
+        atexit.register(self.close)
+
+    def play(self, intro, loop):
+        """ Start playing a track, replacing whatever is playing
+        Args:
+            intro (mixer.Sound): Played once, or None to start straight into the loop
+            loop (mixer.Sound): Repeated forever after the intro
+            Either can also be a buffer of PCM in the mixer's format instead of a Sound,
+            or a PCMSource to stream it from.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._arrange(_pcm(intro) if intro is not None else None, _pcm(loop))
+            self._fade = None
+            self.channel.stop()
+            self.channel.play(mixer.Sound(buffer=self.render(self.chunk_size)))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._feed, name="MusicPlayer feeder", daemon=True)
+            self._thread.start()
+        self._wake.set()
+        self._kick.set()
+
+    def stop(self, fade_ms=0):
+        """ Stop playing, optionally fading out over fade_ms milliseconds. The fade is
+        applied to the chunks as they're fed, so the track keeps playing until it's silent
+        """
+        with self._lock:
+            if fade_ms > 0 and self._segments is not None and self.sample_size == -16:
+                if self._fade is None:
+                    frames = mixer.get_init()[0] * fade_ms // 1000
+                    self._fade = (frames, frames)
+            else:
+                self._release()
+                self._fade = None
+                self._wake.clear()
+                self.channel.stop()
+
+    def close(self):
+        """ Stop playing and shut down the feeder thread """
+        with self._lock:
+            self._closed = True
+            self._release()
+            self.channel.stop()
+        self._wake.set()
+        self._kick.set()
+
+    def set_volume(self, volume):
+        """ Set the volume, between 0.0 and 1.0 """
+        self.channel.set_volume(volume)
+
+    def get_busy(self):
+        """ True if a track is playing """
+        return self._segments is not None
+
+    def render(self, nbytes):
+        """ Mix the next nbytes of PCM for the current track and advance through it
+        Returns:
+            bytes, shorter than nbytes only if nothing is playing
+        """
+        out = bytearray()
+        segments = self._segments
+        while segments is not None and len(out) < nbytes:
+            segment = segments[self._index]
+            take = min(nbytes - len(out), len(segment) - self._pos)
+            if isinstance(segment, PCMStream):
+                out += segment.read(self._pos, take)
+            else:
+                out += segment[self._pos:self._pos + take]
+            self._pos += take
+            if self._pos == len(segment):
+                self._pos = 0
+                self._index += 1
+                if self._index == len(segments):
+                    self._index = self._loop_start
+        return bytes(out)
+
+    def _next_chunk(self, nbytes):
+        """ render() with the fade-out applied. Once the fade is done, the track ends """
+        pcm = self.render(nbytes)
+        if self._fade is None:
+            return pcm
+        left, total = self._fade
+        frames = len(pcm) // self.frame_size
+        if self.sample_size == -16:
+            pcm = _ramp(pcm, left / total, max(0, left - frames) / total, self.frame_size // 2)
+        left -= frames
+        if left <= 0:
+            self._release()
+            self._fade = None
+            self._wake.clear()
+        else:
+            self._fade = (left, total)
+        return pcm
+
+    def _arrange(self, intro, loop):
+        """ Lay the track out as a list of PCM segments, where everything from
+        self._loop_start on is repeated. With a crossfade, the seams are precomputed
+        blends of the end of one section and the start of the loop. Streamed sections
+        are sliced into streams of their own, and only the blends are read into memory.
+        """
+        self._release()
+        first = intro if intro is not None and len(intro) > 0 else loop
+        fade = min(self.crossfade_frames, len(first) // self.frame_size // 2,
+                   len(loop) // self.frame_size // 2) * self.frame_size
+        if fade == 0:
+            head = [first] if first is not loop else []
+            cycle = [loop]
+        else:
+            loop_head = _load(loop[:fade])
+            head = [first[:len(first) - fade], _crossfade(_load(first[len(first) - fade:]), loop_head)]
+            cycle = [loop[fade:len(loop) - fade], _crossfade(_load(loop[len(loop) - fade:]), loop_head)]
+        head = [segment for segment in head if len(segment) > 0]
+        cycle = [segment for segment in cycle if len(segment) > 0]
+        self._loop_start = len(head)
+        self._segments = head + cycle
+        self._index = 0
+        self._pos = 0
+
+    def _release(self):
+        """ Drop the track's segments, closing the files of any streamed ones """
+        segments = self._segments
+        self._segments = None
+        for segment in segments or ():
+            if isinstance(segment, PCMStream):
+                segment.close()
+
+    def _feed(self):
+        """ Keep one chunk queued behind the one that's playing
+        Rather than polling the channel all the time, the feeder sleeps until shortly
+        before the playing chunk should run out, then polls briefly for the queue slot to
+        free up. Timing each chunk from when the slot was seen freeing up keeps the
+        schedule in step with the mixer's clock. Blocks on self._wake while nothing is
+        playing.
+        """
+        margin = self.chunk_seconds / 10
+        poll = margin / 2
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.perf_counter()
+                wake_at = now + poll
+                if self._segments is not None and self.channel.get_queue() is None:
+                    chunk = mixer.Sound(buffer=self._next_chunk(self.chunk_size))
+                    if self.channel.get_busy():
+                        # The chunk that's playing started within the last poll
+                        self.channel.queue(chunk)
+                        wake_at = now + self.chunk_seconds - margin
+                    else:
+                        self.underruns += 1
+                        self.channel.play(chunk)
+                        wake_at = now #the queue slot is still free, fill it right away
+            self._kick.wait(max(0.0, wake_at - time.perf_counter()))
+            self._kick.clear()
+
+class DevicePlayer(MusicPlayer):
+    """ A MusicPlayer on an audio output device of its own, rather than a mixer Channel
+    The device is opened with pygame's SDL2 audio API in the mixer's sample format, so the
+    same decoded tracks can be shared with players on other devices. SDL pulls the PCM
+    from render() on its audio thread, so there's no feeder thread.
+    """
+
+    def __init__(self, device, chunk_ms=100, crossfade_ms=0):
+        """ Constructor for this object
+        Args:
+            device (str): Name of the output device, as listed by
+                pygame._sdl2.audio.get_audio_device_names()
+            chunk_ms (int): Unused, the device asks for PCM as it needs it
+            crossfade_ms (int): See MusicPlayer
+        Raises:
+            ImportError if pygame was built without SDL2 audio support
+            RuntimeError (a pygame SDL error) if the device can't be opened
+        """
+        from pygame._sdl2 import audio as sdl_audio
+        super().__init__(None, chunk_ms, crossfade_ms)
+        frequency, size, channels = mixer.get_init()
+        formats = {8: sdl_audio.AUDIO_U8, -8: sdl_audio.AUDIO_S8, 16: sdl_audio.AUDIO_U16,
+                   -16: sdl_audio.AUDIO_S16, 32: sdl_audio.AUDIO_F32}
+        self._volume = 1.0
+        self.device = None
+        self.device = sdl_audio.AudioDevice(device, False, frequency, formats[size], channels,
+                                            1024, 0, self._callback)
+        self.device.pause(0)
+
+    def play(self, intro, loop):
+        with self._lock:
+            if self._closed:
+                return
+            self._arrange(_pcm(intro) if intro is not None else None, _pcm(loop))
+            self._fade = None
+
+    def stop(self, fade_ms=0):
+        with self._lock:
+            if fade_ms > 0 and self._segments is not None:
+                frames = mixer.get_init()[0] * fade_ms // 1000
+                self._fade = (frames, frames)
+            else:
+                self._release()
+                self._fade = None
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._release()
+        if self.device is not None:
+            self.device.close()
+
+    def set_volume(self, volume):
+        self._volume = volume
+
+    def _callback(self, device, stream):
+        with self._lock:
+            pcm = self._next_chunk(len(stream)) if self._segments is not None else b""
+            volume = self._volume
+        if volume != 1.0 and self.sample_size == -16:
+            pcm = _scale(pcm, volume)
+        silence = _SILENCE.get(self.sample_size, b"\0")
+        stream[:] = pcm + silence * ((len(stream) - len(pcm)) // len(silence))
+
+_SILENCE = {8: b"\x80", 16: b"\x00\x80"} #unsigned formats are centred on half their range
+
+GAIN_STEPS = 1024
+"""(int): Most gain changes in a ramp or crossfade done with audioop. The gain is held
+for a few frames at a time on longer ones, in steps well under what can be heard"""
+
+def _gain_steps(frames):
+    """ (first frame, end frame) of each stretch of a ramp over frames that gets one gain """
+    size = -(-frames // GAIN_STEPS)
+    return [(first, min(first + size, frames)) for first in range(0, frames, size)]
+
+def _scale(pcm, volume):
+    """ Multiply 16-bit PCM by volume """
+    if _audioop is not None:
+        return _audioop.mul(pcm, 2, volume)
+    samples = array('h', pcm)
+    return array('h', [int(sample * volume) for sample in samples]).tobytes()
+
+def _ramp(pcm, start, end, channels):
+    """ Multiply 16-bit PCM by a gain going linearly from start to end """
+    frames = len(pcm) // 2 // channels
+    if frames == 0:
+        return pcm
+    step = (end - start) / frames
+    if _audioop is not None:
+        out = bytearray()
+        for first, last in _gain_steps(frames):
+            out += _audioop.mul(pcm[first * channels * 2:last * channels * 2], 2, start + first * step)
+        return bytes(out)
+    samples = array('h', pcm)
+    for i in range(len(samples)):
+        samples[i] = int(samples[i] * (start + (i // channels) * step))
+    return samples.tobytes()
+
+def _pcm(sound):
+    """ Zero-copy bytes view of a Sound's samples (or of a PCM buffer), or a new stream of a PCMSource """
+    if isinstance(sound, PCMSource):
+        return sound.open()
+    return memoryview(sound).cast('B')
+
+def _load(segment):
+    """ A segment's PCM as a memoryview, reading it in if it's a stream """
+    if isinstance(segment, PCMStream):
+        return memoryview(segment.load())
+    return segment
+
+def _crossfade(tail, head):
+    """ Linear crossfade from tail into head, both 16-bit PCM of the same length """
+    channels = mixer.get_init()[2]
+    frames = len(tail) // 2 // channels
+    if _audioop is not None:
+        out = bytearray()
+        for first, last in _gain_steps(frames):
+            t = first / frames
+            start, end = first * channels * 2, last * channels * 2
+            out += _audioop.add(_audioop.mul(tail[start:end], 2, 1 - t),
+                                _audioop.mul(head[start:end], 2, t), 2)
+        return memoryview(bytes(out))
+    tail = tail.cast('h')
+    head = head.cast('h')
+    out = array('h', bytes(len(tail) * 2))
+    for i in range(len(tail)):
+        t = (i // channels) / frames
+        out[i] = int(tail[i] * (1 - t) + head[i] * t)
+    return memoryview(out.tobytes())
@@ -0,0 +1,122 @@
+""" Profiling a SlippiMusic that's already running
+SamplingProfiler takes the stack of every thread every few milliseconds, so it sees the
+event loops, the receiver and the audio threads of every station at once, and writes what
+it saw as a .pstats file that "python -m pstats" or snakeviz can open. Nothing runs until
+it's started, so it costs nothing while it's off.
+dump_state writes every thread's current stack along with the Console's counters.
+"""
+import json
+import marshal
+import sys
+import threading
+import time
+import traceback
+
+class SamplingProfiler():
+    """ Samples the stacks of all threads on a thread of its own
+    In the .pstats file, the call counts are sample counts and the times are wall-clock
+    time. Each thread shows up as a function called "<thread name>", with everything it
+    ran below it, so a thread waiting on a queue counts as time spent in the wait.
+    """
+
+    def __init__(self, interval=0.01):
+        """ Constructor for this object
+        Args:
+            interval (float): Seconds between samples
+        """
+        self.interval = interval
+        self.samples = 0
+        self._stats = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        """(bool): True while sampling"""
+        return self._thread is not None
+
+    def start(self):
+        """ Start sampling, forgetting any earlier samples """
+        if self._thread is not None:
+            return
+        self.samples = 0
+        self._stats = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="Profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self, path):
+        """ Stop sampling and write the profile
+        Args:
+            path (str): The .pstats file to write
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        stats = {}
+        for key, (samples, tottime, cumtime, callers) in self._stats.items():
+            stats[key] = (samples, samples, tottime, cumtime,
+                          {caller: (count, count, tt, ct) for caller, (count, tt, ct) in callers.items()})
+        with open(path, "wb") as out:
+            marshal.dump(stats, out)
+
+    def _run(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            elapsed = now - last
+            last = now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._sample(names.get(ident, str(ident)), frame, elapsed)
+            self.samples += 1
+
+    def _sample(self, thread, frame, seconds):
+        """ Add one stack to the totals, as if it had run for seconds """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.append(("~", 0, "<" + thread + ">")) #pstats' file name for things that aren't in a file
+        stack.reverse()
+        seen = set()
+        caller = None
+        top = len(stack) - 1
+        for i, key in enumerate(stack):
+            # [samples, time on top of the stack, time on the stack, {caller: [samples, tt, ct]}]
+            entry = self._stats.get(key)
+            if entry is None:
+                entry = self._stats[key] = [0, 0.0, 0.0, {}]
+            if key not in seen: #recursive calls are only counted once per sample
+                seen.add(key)
+                entry[0] += 1
+                entry[2] += seconds
+            if caller is not None:
+                edge = entry[3].get(caller)
+                if edge is None:
+                    edge = entry[3][caller] = [0, 0.0, 0.0]
+                edge[0] += 1
+                edge[2] += seconds
+                if i == top:
+                    edge[1] += seconds
+            caller = key
+        self._stats[stack[-1]][1] += seconds
+
+def dump_state(path, stats):
+    """ Write the stack of every thread and a set of counters to a text file
+    Args:
+        path (str): File to write
+        stats (dict): Counters to include, written as JSON
+    """
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    with open(path, "w") as out:
+        out.write("SlippiMusic state at " + time.strftime("%Y-%m-%d %H:%M:%S") + "\n\n")
+        for ident, frame in sys._current_frames().items():
+            out.write("Thread " + names.get(ident, str(ident)) + ":\n")
+            out.write("".join(traceback.format_stack(frame)) + "\n")
+        out.write(json.dumps(stats, indent=2, default=str) + "\n")
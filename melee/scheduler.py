@@ -0,0 +1,57 @@
+""" Delayed actions that can be cancelled
+Used instead of time.sleep() for things like waiting for the "GAME" message to leave the
+screen before starting the menu music, so nothing blocks while waiting and a rematch can
+call the wait off.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+class Timer():
+    """ A pending action returned by Scheduler.call_later """
+
+    def __init__(self, when, action, args):
+        self.when = when
+        self.action = action
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """ Don't run the action. Does nothing if it already ran """
+        self.cancelled = True
+
+class Scheduler():
+    """ Runs actions after a delay on a single timer thread """
+
+    def __init__(self):
+        self._timers = []
+        self._order = itertools.count() #tie-breaker so the heap never compares Timers
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="Scheduler", daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, action, *args):
+        """ Run action(*args) after delay seconds
+        Returns:
+            The Timer, which can be cancelled
+        """
+        timer = Timer(time.monotonic() + delay, action, args)
+        with self._condition:
+            heapq.heappush(self._timers, (timer.when, next(self._order), timer))
+            self._condition.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._timers:
+                    self._condition.wait()
+                when, order, timer = self._timers[0]
+                now = time.monotonic()
+                if when > now:
+                    self._condition.wait(when - now)
+                    continue
+                heapq.heappop(self._timers)
+            if not timer.cancelled:
+                timer.action(*timer.args)
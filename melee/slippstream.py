@@ -8,6 +8,12 @@ import socket
 from enum import Enum
 import enet
 import json
+import base64
+import random
+import select
+import time
+
+from melee.metrics import METRICS
 
 # pylint: disable=too-few-public-methods
 class EventType(Enum):
@@ -29,20 +35,50 @@ class CommType(Enum):
     KEEPALIVE = 0x03
     MENU = 0x04
 
+def decode_message(data):
+    """ Parse a SlippiComm packet
+    Returns:
+        The message, with the payload of a "game_event" base64-decoded to bytes, or None
+        if the packet isn't valid JSON
+    """
+    if METRICS.enabled:
+        received = time.perf_counter()
+    try:
+        message = json.loads(data)
+    except json.JSONDecodeError:
+        return None
+    if message.get("type") == "game_event":
+        message["payload"] = base64.b64decode(message.get("payload", ""))
+    if METRICS.enabled:
+        message["received_at"] = received
+        message["decoded_at"] = time.perf_counter()
+        METRICS.observe("decode", message["decoded_at"] - received)
+    return message
+
 class SlippstreamClient():
     """ Container representing a client to some SlippiComm server """
 
-    def __init__(self, address="127.0.0.1", port=51441, realtime=True):
-        """ Constructor for this object """
+    def __init__(self, address="127.0.0.1", port=51441, realtime=True, backoff_min=0.5, backoff_max=8.0):
+        """ Constructor for this object
+        Args:
+            backoff_min (float): Seconds to wait after the first failed reconnect attempt
+            backoff_max (float): Most seconds to wait between reconnect attempts
+        """
         self._host = enet.Host(None, 1, 0, 0)
         self._peer = None
+        self._closed = False
         self.buf = bytearray()
         self.realtime = realtime
         self.address = address
         self.port = port
+        self.cursor = 0
+        """(int): Where to resume the stream from, the next_cursor of the last game_event received"""
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
 
     def shutdown(self):
         """ Close down the socket and connection to the console """
+        self._closed = True
         if self._peer:
             self._peer.send(0, enet.Packet())
             self._host.service(100)
@@ -54,31 +90,34 @@ class SlippstreamClient():
         return False
 
     def dispatch(self):
-        """Dispatch messages with the peer (read and write packets)"""
+        """Dispatch messages with the peer (read and write packets)
+        Returns:
+            The next message, decoded like dispatch_batch's, or None if nothing arrived
+        """
         event = None
         event_type = 1000
         while event_type not in [enet.EVENT_TYPE_RECEIVE]:
             wait_time = 1000
             try:
-                event = self._host.service(timeout = wait_time)
+                event = self._service(wait_time)
                 event_type = event.type
             except OSError:
                 print("OSError! Reconnecting...")
-                self.connect()
+                self.reconnect()
                 continue
 
             if event.type == enet.EVENT_TYPE_NONE:
                 return None
                 #print("none event recieved")
             if event.type == enet.EVENT_TYPE_RECEIVE:
-                try:
-                    return json.loads(event.packet.data)
-                except json.JSONDecodeError:
+                if len(event.packet.data) == 0:
                     # This happens at the end of a game for some reason?
-                    if len(event.packet.data) == 0:
-                        event_type = 0
-                        continue
-                    return None
+                    event_type = 0
+                    continue
+                message = decode_message(event.packet.data)
+                if message is not None and message.get("type") == "game_event":
+                    self.cursor = message.get("next_cursor", self.cursor)
+                return message
             elif event.type == enet.EVENT_TYPE_CONNECT:
                 print("recieved connect in dispatch")
                 #handshake = json.dumps({
@@ -87,12 +126,88 @@ class SlippstreamClient():
                 #})
                 #self._peer.send(0, enet.Packet(handshake.encode()))
             elif event.type == enet.EVENT_TYPE_DISCONNECT:
-                print("Disconnect event receieved")
+                print("Disconnect event receieved, reconnecting...")
+                self.reconnect()
                 return None
         return None
 
-    def connect(self):
-        """ Connect to the server
+    def dispatch_batch(self, timeout=1000):
+        """Read every packet that's already buffered in one go
+        Blocks for up to timeout milliseconds, but only if nothing has arrived yet.
+        Returns:
+            A list of messages, possibly empty. The payloads of "game_event" messages
+            are already base64-decoded to bytes.
+        """
+        messages = []
+        wait_time = timeout
+        while True:
+            try:
+                event = self._service(wait_time)
+            except OSError:
+                print("OSError! Reconnecting...")
+                self.reconnect()
+                return messages
+            if event.type == enet.EVENT_TYPE_NONE:
+                return messages
+            wait_time = 0 #only block if there was nothing buffered to begin with
+            if event.type == enet.EVENT_TYPE_RECEIVE:
+                if len(event.packet.data) == 0:
+                    continue # This happens at the end of a game for some reason?
+                message = decode_message(event.packet.data)
+                if message is None:
+                    continue
+                if message.get("type") == "game_event":
+                    self.cursor = message.get("next_cursor", self.cursor)
+                messages.append(message)
+            elif event.type == enet.EVENT_TYPE_CONNECT:
+                print("recieved connect in dispatch")
+            elif event.type == enet.EVENT_TYPE_DISCONNECT:
+                print("Disconnect event receieved, reconnecting...")
+                self.reconnect()
+                return messages
+
+    def stats(self):
+        """ ENet counters for the connection, like MuxedClient.stats() """
+        peer = self._peer
+        if peer is None or peer.state != enet.PEER_STATE_CONNECTED:
+            return {"connected": False}
+        return {"connected": True,
+                "round_trip_ms": peer.roundTripTime,
+                "packet_loss": peer.packetLoss / 65536, #ENet counts loss in 1/65536ths
+                "packets_lost": peer.packetsLost}
+
+    def _service(self, timeout):
+        """ self._host.service(timeout), without holding the GIL while it waits
+        pyenet keeps the GIL for the whole service() call once a peer is connected, which
+        stalls every other thread, so wait for the socket with select() first.
+        """
+        if timeout > 0:
+            self._host.flush() #send anything queued (acks, connect requests) before waiting
+            select.select([self._host.socket.fileno()], [], [], timeout / 1000)
+        return self._host.service(0)
+
+    def reconnect(self):
+        """ Reconnect after losing the connection, resuming the stream from self.cursor
+        Retries with exponential backoff, with jitter so that several clients don't retry
+        in lockstep, until it's connected or shutdown() is called.
+        Returns True once reconnected, False if the client was shut down
+        """
+        delay = self.backoff_min
+        while not self._closed:
+            # The old host may be broken (OSError) and only has room for one peer anyway
+            self._peer = None
+            self._host = enet.Host(None, 1, 0, 0)
+            if self.connect(maxAttempts = 1):
+                print("Reconnected, resuming from cursor " + str(self.cursor))
+                return True
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self.backoff_max)
+        return False
+
+    def connect(self, maxAttempts = 4):
+        """ Connect to the server, resuming the stream from self.cursor
+        Args:
+            maxAttempts (int): How many extra seconds to wait for the server to answer
         Returns True on success, False on failure
         """
         # Try to connect to the server and send a handshake
@@ -103,9 +218,8 @@ class SlippstreamClient():
         try:
             event = None
             attempts = 0
-            maxAttempts = 4 #only attempt to connect 4 times
             while True:
-                event = self._host.service(1000)
+                event = self._service(1000)
                 if event.type == enet.EVENT_TYPE_CONNECT: #this means we've connected
                     break
                 attempts = attempts + 1
@@ -113,7 +227,7 @@ class SlippstreamClient():
                     return False
             handshake = json.dumps({
                         "type" : "connect_request",
-                        "cursor" : 0,
+                        "cursor" : self.cursor,
                     })
             self._peer.send(0, enet.Packet(handshake.encode()))
             return True
@@ -0,0 +1,226 @@
+""" Several Slippstream connections on a single ENet host
+For running more than one station per PC: every station's spectator connection is a peer of
+the same enet.Host, serviced by one thread that hands each peer's messages to its own
+MuxedClient. A MuxedClient has the same connect() / dispatch_batch() / shutdown() contract
+as a SlippstreamClient, so a Console can use either.
+"""
+import json
+import queue
+import random
+import select
+import socket
+import threading
+import time
+import enet
+
+from melee.slippstream import decode_message
+
+CONNECT_TIMEOUT = 1.0 #seconds to wait for a server to answer before trying again
+
+class SlippstreamMux():
+    """ Services the ENet connections of any number of MuxedClients on one thread """
+
+    def __init__(self, max_peers=32, backoff_min=0.5, backoff_max=8.0):
+        """ Constructor for this object
+        Args:
+            max_peers (int): Most connections the host can have at once
+            backoff_min (float): Seconds to wait after the first failed connection attempt
+            backoff_max (float): Most seconds to wait between connection attempts
+        """
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._host = enet.Host(None, max_peers, 0, 0)
+        self._clients = []
+        self._peers = {} #incomingPeerID -> the MuxedClient using that peer slot
+        self._requests = queue.Queue()
+        # pyenet isn't thread safe, so other threads ask the mux thread to do things and
+        # wake it up through this socket pair
+        self._wake_read, self._wake_write = socket.socketpair()
+        self._wake_read.setblocking(False)
+        self._closed = False
+        self._thread = None
+
+    def client(self, address="127.0.0.1", port=51441):
+        """ A new client for a SlippiComm server, multiplexed on this host """
+        client = MuxedClient(self, address, port)
+        self._clients.append(client)
+        return client
+
+    def close(self):
+        """ Disconnect every client and stop the mux thread """
+        self._closed = True
+        self._wake()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+
+    def stats(self):
+        """ Per-connection ENet counters, by server port """
+        return {client.port: client.stats() for client in self._clients}
+
+    def _request(self, action, client):
+        self._requests.put((action, client))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="Slippstream mux", daemon=True)
+            self._thread.start()
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_write.send(b"\0")
+        except OSError:
+            pass #the buffer is full, so the mux thread has plenty of wake-ups waiting already
+
+    def _run(self):
+        socket_fd = self._host.socket.fileno()
+        while not self._closed:
+            now = time.monotonic()
+            due = [client._retry_at for client in self._clients if client._retry_at is not None]
+            timeout = max(0.0, min(due) - now) if due else 1.0
+            self._host.flush()
+            readable = select.select([socket_fd, self._wake_read], [], [], min(timeout, 1.0))[0]
+            if self._wake_read in readable:
+                try:
+                    while self._wake_read.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            while True:
+                try:
+                    action, client = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if action == "connect":
+                    self._connect(client)
+                elif action == "disconnect":
+                    self._disconnect(client)
+            now = time.monotonic()
+            for client in self._clients:
+                if client._retry_at is not None and now >= client._retry_at and not client._closed:
+                    self._connect(client) #the last attempt timed out, or the connection dropped
+            try:
+                event = self._host.service(0)
+                while event.type != enet.EVENT_TYPE_NONE:
+                    self._route(event)
+                    event = self._host.service(0)
+            except OSError as e:
+                print("OSError in the Slippstream mux: " + str(e))
+        for client in self._clients:
+            self._disconnect(client)
+        self._host.flush()
+
+    def _connect(self, client):
+        if client._peer is not None:
+            self._peers.pop(client._peer.incomingPeerID, None)
+            client._peer.reset()
+            client._peer = None
+        try:
+            peer = self._host.connect(enet.Address(bytes(client.address, 'utf-8'), int(client.port)), 1)
+        except OSError: #no free peer slots
+            client._retry_at = time.monotonic() + client._backoff
+        else:
+            client._peer = peer
+            self._peers[peer.incomingPeerID] = client
+            client._retry_at = time.monotonic() + max(CONNECT_TIMEOUT, client._backoff)
+        client._backoff = min(client._backoff * 2, self.backoff_max)
+
+    def _disconnect(self, client):
+        client._retry_at = None
+        client._connected = False
+        if client._peer is not None:
+            self._peers.pop(client._peer.incomingPeerID, None)
+            client._peer.disconnect_later()
+            client._peer = None
+
+    def _route(self, event):
+        client = self._peers.get(event.peer.incomingPeerID)
+        if client is None:
+            return
+        if event.type == enet.EVENT_TYPE_CONNECT:
+            client._retry_at = None
+            client._backoff = self.backoff_min
+            if client._connected_before:
+                print("Reconnected to port " + str(client.port) + ", resuming from cursor " + str(client.cursor))
+            client._connected = client._connected_before = True
+            handshake = json.dumps({
+                        "type" : "connect_request",
+                        "cursor" : client.cursor,
+                    })
+            event.peer.send(0, enet.Packet(handshake.encode()))
+        elif event.type == enet.EVENT_TYPE_DISCONNECT:
+            if client._connected:
+                print("Lost the connection to port " + str(client.port) + ", reconnecting...")
+            self._peers.pop(event.peer.incomingPeerID, None)
+            client._peer = None
+            client._connected = False
+            client._retry_at = time.monotonic() + client._backoff * random.uniform(0.5, 1.0)
+            client._backoff = min(client._backoff * 2, self.backoff_max)
+        elif event.type == enet.EVENT_TYPE_RECEIVE and len(event.packet.data) > 0:
+            message = decode_message(event.packet.data)
+            if message is None:
+                return
+            if message.get("type") == "game_event":
+                client.cursor = message.get("next_cursor", client.cursor)
+            client._messages.put(message)
+
+class MuxedClient():
+    """ One SlippiComm connection of a SlippstreamMux """
+
+    def __init__(self, mux, address, port):
+        self.mux = mux
+        self.address = address
+        self.port = port
+        self.cursor = 0
+        """(int): Where to resume the stream from, the next_cursor of the last game_event received"""
+        self._messages = queue.Queue()
+        self._peer = None
+        self._connected = False
+        self._connected_before = False
+        self._retry_at = None
+        self._backoff = mux.backoff_min
+        self._closed = False
+
+    def connect(self):
+        """ Start connecting. The mux keeps trying, with backoff, until the server answers,
+        and reconnects whenever the connection drops, so this doesn't wait for the server
+        Returns:
+            True
+        """
+        self._closed = False
+        self.mux._request("connect", self)
+        return True
+
+    def shutdown(self):
+        """ Disconnect from the server """
+        self._closed = True
+        self.mux._request("disconnect", self)
+        return False
+
+    def dispatch(self):
+        """ The next message, or None if none arrives within a second """
+        messages = self.dispatch_batch(timeout=1000, limit=1)
+        return messages[0] if messages else None
+
+    def dispatch_batch(self, timeout=1000, limit=1024):
+        """ Every message that's arrived, like SlippstreamClient.dispatch_batch
+        Blocks for up to timeout milliseconds, but only if nothing has arrived yet.
+        """
+        try:
+            messages = [self._messages.get(timeout=timeout / 1000)]
+        except queue.Empty:
+            return []
+        while len(messages) < limit:
+            try:
+                messages.append(self._messages.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def stats(self):
+        """ ENet counters for the connection """
+        peer = self._peer
+        if peer is None or not self._connected:
+            return {"connected": False}
+        return {"connected": True,
+                "round_trip_ms": peer.roundTripTime,
+                "packet_loss": peer.packetLoss / 65536, #ENet counts loss in 1/65536ths
+                "packets_lost": peer.packetsLost}
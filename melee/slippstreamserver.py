@@ -0,0 +1,192 @@
+""" Stand-in for the SlippiComm server built into Slippi Dolphin
+Speaks enough of the protocol (connect_request / connect_reply, then game_event messages)
+for a SlippstreamClient to connect to it, and replays recorded or synthetic games at a
+chosen speed. Used by benchmark.py to exercise the client without Dolphin.
+"""
+import base64
+import json
+import struct
+import time
+import enet
+
+from melee.slippstream import EventType
+from melee.slpfilestreamer import SLPFileStreamer
+
+# Payload sizes (not counting the command byte) announced by the synthetic games
+SYNTHETIC_SIZES = {
+    EventType.GAME_START.value: 0x1A0,
+    EventType.PRE_FRAME.value: 0x40,
+    EventType.POST_FRAME.value: 0x34,
+    EventType.GAME_END.value: 0x2,
+    EventType.FRAME_START.value: 0xC,
+    EventType.ITEM_UPDATE.value: 0x2B,
+    EventType.FRAME_BOOKEND.value: 0x8,
+}
+
+def _event(command, fields=()):
+    event = bytearray(SYNTHETIC_SIZES[command] + 1)
+    event[0] = command
+    for offset, value in fields:
+        event[offset] = value
+    return event
+
+def synthetic_game(stage=31, frames=3600, players=2, items=2):
+    """ Build the game_event payloads for a made-up game, one per frame
+    Each player loses a stock every frames // 4 frames, except player 0 who wins,
+    so the game ends by stocks rather than LRAS.
+    Returns:
+        List of payloads (bytes). The first carries the PAYLOADS and GAME_START events,
+        the last the GAME_END event.
+    """
+    payloads = bytearray([EventType.PAYLOADS.value, len(SYNTHETIC_SIZES) * 3 + 1])
+    for command, size in SYNTHETIC_SIZES.items():
+        payloads += bytes([command]) + struct.pack(">H", size)
+    game_start = _event(EventType.GAME_START.value, [(0x13, stage >> 8), (0x14, stage & 0xFF)])
+    messages = []
+    for frame in range(frames):
+        message = bytearray(payloads + game_start) if frame == 0 else bytearray()
+        message += _event(EventType.FRAME_START.value)
+        for port in range(players):
+            message += _event(EventType.PRE_FRAME.value, [(0x5, port)])
+        for item in range(items):
+            message += _event(EventType.ITEM_UPDATE.value)
+        for port in range(players):
+            stocks = 4 if port == 0 else 4 - (frame * 4 // frames)
+            post_frame = _event(EventType.POST_FRAME.value, [(0x5, port), (0x21, stocks)])
+            struct.pack_into(">i", post_frame, 0x1, frame - 123) #frame numbers start at -123
+            message += post_frame
+        message += _event(EventType.FRAME_BOOKEND.value)
+        messages.append(bytes(message))
+    messages.append(bytes(_event(EventType.GAME_END.value)))
+    return messages
+
+def replay_payloads(path):
+    """ The game_event payloads of a recorded .slp file (or folder of them), one per frame """
+    return [bytes(payload) for payload, frame_ended in SLPFileStreamer._events(path)]
+
+def count_events(payload, eventsize):
+    """ How many events are in a payload, given the sizes from the PAYLOADS event
+    (which is read from the payload itself, if present)
+    """
+    count = 0
+    offset = 0
+    while offset < len(payload):
+        command = payload[offset]
+        if command == EventType.PAYLOADS.value:
+            size = payload[offset + 1] + 1
+            for i in range((size - 2) // 3):
+                cursor = offset + 2 + i * 3
+                eventsize[payload[cursor]] = ((payload[cursor + 1] << 8) | payload[cursor + 2]) + 1
+        else:
+            size = eventsize[command]
+        if size == 0:
+            break
+        offset += size
+        count += 1
+    return count
+
+class SlippstreamServer():
+    """ Serves game_event messages to one SlippstreamClient at a time """
+
+    def __init__(self, address="127.0.0.1", port=51441, resume=True):
+        """ Constructor for this object
+        Args:
+            resume (bool): Resume from the cursor a reconnecting client asks for. If False,
+                every client gets the whole stream again from cursor 0
+        """
+        self._host = enet.Host(enet.Address(bytes(address, 'utf-8'), int(port)), 4, 0, 0)
+        self._peer = None
+        self.resume = resume
+        self.messages = []
+        """(list): The payload for every cursor served so far"""
+
+    def wait_for_client(self, timeout=30):
+        """ Wait until a client has connected and sent its connect_request
+        Returns True if a client connected
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.service(100) and self._peer is not None:
+                return True
+        return False
+
+    def service(self, timeout=0):
+        """ Handle one ENet event: connections, handshakes and disconnects
+        Returns True if a connect_request was answered
+        """
+        event = self._host.service(timeout)
+        if event.type == enet.EVENT_TYPE_CONNECT:
+            self._peer = event.peer
+        elif event.type == enet.EVENT_TYPE_DISCONNECT:
+            self._peer = None
+        elif event.type == enet.EVENT_TYPE_RECEIVE and len(event.packet.data) > 0:
+            try:
+                request = json.loads(event.packet.data)
+            except json.JSONDecodeError:
+                return False
+            if request.get("type") == "connect_request":
+                # Resume from the client's cursor if it's one we've served, otherwise
+                # start from whatever is sent next, like Dolphin does
+                cursor = request.get("cursor", 0)
+                if not self.resume:
+                    cursor = 0
+                elif not 0 < cursor <= len(self.messages):
+                    cursor = len(self.messages)
+                self._send({"type": "connect_reply", "nick": "SlippiMusic stand-in",
+                            "version": "0.0.0", "cursor": cursor})
+                for index in range(cursor, len(self.messages)):
+                    self._send_event(index)
+                return True
+        return False
+
+    def send_game(self, payloads, fps=60, burst=1):
+        """ Send a game to the connected client
+        Args:
+            payloads (list): game_event payloads (bytes) in order
+            fps (float): Frames per second to send at. 60 is real time, higher is
+                faster than real time and 0 is as fast as possible.
+            burst (int): Send this many frames back to back, then wait for them to be
+                due, like a rollback client catching up
+        Returns:
+            List of time.monotonic() timestamps when each payload was handed to ENet
+        """
+        sent = []
+        start = time.monotonic()
+        for index, payload in enumerate(payloads):
+            if fps and index % burst == 0:
+                delay = start + index / fps - time.monotonic()
+                while delay > 0:
+                    self.service(int(delay * 1000))
+                    delay = start + index / fps - time.monotonic()
+            self.messages.append(payload)
+            self._send_event(len(self.messages) - 1)
+            sent.append(time.monotonic())
+            if index % burst == burst - 1:
+                # service() can return on an incoming event before sending anything, so flush
+                self._host.flush()
+                self.service(0 if fps else 1) #unthrottled still lets acks through between bursts
+        self._host.flush()
+        return sent
+
+    def idle(self, seconds):
+        """ Keep the connection alive without sending anything """
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.service(int(max(0, deadline - time.monotonic()) * 1000))
+
+    def disconnect(self):
+        """ Drop the client, as if Dolphin crashed or the network went down """
+        if self._peer is not None:
+            self._peer.disconnect_now()
+            self._peer = None
+            self._host.flush()
+
+    def _send_event(self, cursor):
+        self._send({"type": "game_event",
+                    "cursor": cursor,
+                    "next_cursor": cursor + 1,
+                    "payload": base64.b64encode(self.messages[cursor]).decode()})
+
+    def _send(self, message):
+        if self._peer is not None:
+            self._peer.send(0, enet.Packet(json.dumps(message).encode()))
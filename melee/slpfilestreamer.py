@@ -0,0 +1,171 @@
+""" Plays back .slp replay files as if they were a Slippstream
+The SLPFileStreamer has the same dispatch() / dispatch_batch() contract as the
+SlippstreamClient, so the Console can run its event handling and music logic off recorded
+games without Dolphin or a network connection, either at game speed or as fast as possible.
+"""
+import mmap
+import os
+import time
+
+from melee.metrics import METRICS
+from melee.slippstream import EventType
+
+FRAME_START = EventType.FRAME_START.value
+FRAME_BOOKEND = EventType.FRAME_BOOKEND.value
+GAME_END = EventType.GAME_END.value
+PAYLOADS = EventType.PAYLOADS.value
+
+class SLPFileStreamer():
+    """ Streams the raw events of one or more .slp files, one frame per message """
+
+    def __init__(self, path, realtime=True, batch_size=256):
+        """ Constructor for this object
+        Args:
+            path (str): A .slp file, or a folder to play every .slp file in (sorted by name)
+            realtime (bool): Pace frames at 60 per second like a live game. If False, the
+                replays are streamed as fast as they can be read.
+            batch_size (int): Most messages dispatch_batch() returns at once when not realtime
+        """
+        self.path = path
+        self.realtime = realtime
+        self.batch_size = batch_size
+        self.cursor = 0
+        self.finished = False
+        self._messages = None
+
+    def connect(self):
+        """ Open the replay(s)
+        Returns True on success, False if there's nothing to play
+        """
+        if os.path.isdir(self.path):
+            files = sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                           if name.lower().endswith(".slp"))
+        elif os.path.isfile(self.path):
+            files = [self.path]
+        else:
+            print("No replay found at " + self.path)
+            return False
+        if not files:
+            print("No .slp files in " + self.path)
+            return False
+        self._messages = self._stream(files)
+        return True
+
+    def shutdown(self):
+        """ Stop streaming """
+        self._messages = None
+        self.finished = True
+        return False
+
+    def dispatch(self):
+        """ Get the next message
+        Returns:
+            A "game_event" message for the next frame, or None once all replays are done
+        """
+        messages = self.dispatch_batch(timeout=0)
+        return messages[0] if messages else None
+
+    def dispatch_batch(self, timeout=1000):
+        """ Get the next messages, in the same format as SlippstreamClient.dispatch_batch
+        In realtime mode this waits until the next frame is due and returns just that frame.
+        Once all replays are done it returns an empty list after waiting timeout milliseconds,
+        like a live connection with nothing to read.
+        """
+        if self._messages is not None:
+            count = 1 if self.realtime else self.batch_size
+            messages = []
+            for message in self._messages:
+                messages.append(message)
+                if len(messages) == count:
+                    break
+            if messages:
+                return messages
+            self.shutdown()
+        time.sleep(timeout / 1000)
+        return []
+
+    def _stream(self, files):
+        frames = 0
+        start = time.perf_counter()
+        for path in files:
+            for payload, frame_ended in self._events(path):
+                if self.realtime and frame_ended:
+                    frames += 1
+                    delay = start + frames / 60 - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                message = {"type": "game_event",
+                           "cursor": self.cursor,
+                           "next_cursor": self.cursor + 1,
+                           "payload": payload}
+                if METRICS.enabled:
+                    # Nothing to decode, the replay is read straight into the payload
+                    message["received_at"] = message["decoded_at"] = time.perf_counter()
+                self.cursor += 1
+                yield message
+
+    @staticmethod
+    def _events(path):
+        """ Split the raw event block of a replay into messages
+        Each message is a zero-copy view into the memory-mapped file covering one frame
+        (frame start through frame bookend). The first one also carries the PAYLOADS event.
+        Yields:
+            (payload, True if the message ends a frame)
+        """
+        try:
+            with open(path, "rb") as slpfile:
+                data = mmap.mmap(slpfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): #ValueError for empty files
+            print("Couldn't open replay " + path)
+            return
+        try:
+            start, end = raw_bounds(data)
+        except ValueError:
+            print("Not a valid .slp file: " + path)
+            return
+        if data[start] != PAYLOADS:
+            print("Not a valid .slp file: " + path)
+            return
+        eventsize = [0] * 0x100
+        payload_size = data[start + 1]
+        for i in range((payload_size - 1) // 3):
+            cursor = start + 2 + i * 3
+            eventsize[data[cursor]] = ((data[cursor + 1] << 8) | data[cursor + 2]) + 1
+        view = memoryview(data)
+        message_start = start
+        offset = start + payload_size + 1
+        while offset < end:
+            command = data[offset]
+            size = eventsize[command]
+            if size == 0 or offset + size > end:
+                break #corrupt, or the game was still being recorded
+            if command == FRAME_START and offset > message_start:
+                yield view[message_start:offset], False
+                message_start = offset
+            offset += size
+            if command == FRAME_BOOKEND or command == GAME_END:
+                yield view[message_start:offset], command == FRAME_BOOKEND
+                message_start = offset
+        if offset > message_start:
+            yield view[message_start:offset], False
+
+def raw_bounds(data):
+    """ Find the raw event array in the UBJSON of a .slp file
+    Returns:
+        (start, end) byte offsets of the events
+    Raises:
+        ValueError if the file doesn't start with a "raw" byte array
+    """
+    # {  then the key: a length-prefixed string (U = uint8 length, i = int8 length)
+    if data[0:1] != b"{" or data[1:2] not in (b"U", b"i") or data[3:3 + data[2]] != b"raw":
+        raise ValueError("no raw element")
+    pos = 3 + data[2]
+    # [$U#l  is a strongly-typed uint8 array with an int32 count
+    if data[pos:pos + 5] != b"[$U#l":
+        raise ValueError("raw element isn't a byte array")
+    pos += 5
+    length = int.from_bytes(data[pos:pos + 4], "big")
+    pos += 4
+    if length == 0 or pos + length > len(data):
+        length = len(data) - pos #the length is only written once the game is over
+    return pos, pos + length
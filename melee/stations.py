@@ -0,0 +1,70 @@
+""" Music for several setups from one SlippiMusic
+Each station is a Console for one setup's spectator port, with its own volume and audio
+output (a device of its own, or a channel of the default output). All of their Slippstream
+connections share one ENet host, and they share the music library and decoded tracks, so
+each extra station costs a few threads rather than another process and another copy of
+the music.
+"""
+import threading
+
+from melee.console import Console
+from melee.slippstreammux import SlippstreamMux
+
+class Stations():
+    """ A set of Consoles sharing one ENet host, music library and track cache """
+
+    def __init__(self, address="127.0.0.1", **console_args):
+        """ Constructor for this object
+        Args:
+            address (str): IP address the setups' Dolphins are on
+            console_args: Passed on to every Console (menu, cache_mb, crossfade_ms...)
+        """
+        self.address = address
+        self.console_args = console_args
+        self.mux = SlippstreamMux()
+        self.consoles = []
+        self._threads = []
+
+    def add(self, port, output=None, volume=70):
+        """ Add a station
+        Args:
+            port (int): Spectator port of the setup's Dolphin
+            output (str): Audio device to play on, or None for a channel of the default output
+            volume (int): Between 0 and 100
+        Returns:
+            The station's Console
+        """
+        console = Console(slippi_address=self.address, slippi_port=port, volume=volume,
+                          client=self.mux.client(self.address, port), output=output,
+                          channel=len(self.consoles),
+                          shared=self.consoles[0] if self.consoles else None,
+                          **self.console_args)
+        self.consoles.append(console)
+        return console
+
+    def start(self):
+        """ Connect any stations that aren't running yet and handle their events, each on
+        a thread of its own. The connections are retried in the background until each
+        setup's Dolphin answers
+        """
+        for console in self.consoles[len(self._threads):]:
+            console.connect()
+            thread = threading.Thread(target=self._run, args=(console,),
+                                      name="Station " + str(console.slippi_port), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Stop every station """
+        for console in self.consoles:
+            console.stop()
+        self.mux.close()
+
+    def stats(self):
+        """ Console.stats() for every station, by port """
+        return {console.slippi_port: console.stats() for console in self.consoles}
+
+    @staticmethod
+    def _run(console):
+        while not console.music_failed:
+            console.step()
@@ -0,0 +1,286 @@
+""" Streaming playback of long tracks with bounded memory
+Holding a long track's decoded PCM in memory (or letting the pages of its cache file pile
+up) costs around 10MB a minute, so tracks over a size limit are read from disk as they
+play instead. A PCMSource is a stretch of PCM in the mixer's format in a file: a PCMCache
+file, or a WAV file that's already in the mixer's format. It keeps the first HEAD bytes in
+memory, so starting the track and jumping back to the start of a loop never wait on the
+disk. A MusicPlayer plays a source through PCMStreams, which each keep a ring buffer of
+the next few seconds that a read-ahead thread tops up as they play.
+WAV files can also be decoded a chunk at a time, so they go into the PCMCache without
+ever being decoded whole.
+"""
+import struct
+import sys
+import threading
+import wave
+import warnings
+from pygame import mixer
+
+from melee.workers import Worker
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop as _audioop #for volume and format conversion, gone in Python 3.13
+    except ImportError:
+        _audioop = None
+
+CHUNK = 128 * 1024 #bytes read from disk at a time, ~0.75 seconds of 44.1kHz stereo
+HEAD = CHUNK #bytes of every source kept in memory
+READ_AHEAD = 4 * CHUNK #most bytes a stream buffers ahead of where it's playing
+REFILL = READ_AHEAD // 2 #top the buffer up once less than this is left ahead
+
+_reader = None
+_reader_lock = threading.Lock()
+_misses_lock = threading.Lock()
+
+def _read_ahead(action):
+    """ Run action on the read-ahead thread, which is shared by every stream """
+    global _reader
+    with _reader_lock:
+        if _reader is None:
+            _reader = Worker("Stream read-ahead")
+    _reader.post(action)
+
+class PCMSource():
+    """ PCM in the mixer's format, stored in a file, to be played a bit at a time """
+
+    def __init__(self, path, offset, length):
+        """ Constructor for this object
+        Args:
+            path (str): The file
+            offset (int): Where the PCM starts in the file
+            length (int): Bytes of PCM
+        Raises:
+            OSError if the file can't be read
+        """
+        self.path = path
+        self.offset = offset
+        frame_size = _frame_size()
+        self.length = length - length % frame_size
+        with open(path, "rb") as pcmFile:
+            pcmFile.seek(offset)
+            self.head = pcmFile.read(min(HEAD, self.length))
+            """(bytes): The start of the PCM, kept in memory"""
+
+    def __len__(self):
+        return self.length
+
+    def open(self):
+        """ A new PCMStream for playing the whole source """
+        return PCMStream(self, 0, self.length)
+
+class PCMStream():
+    """ Reads a stretch of a PCMSource as it plays, buffering ahead on a background thread
+    Slicing a stream gives a stream of part of it; read() gives the bytes. Reads that
+    aren't buffered yet read from the disk on the spot and are counted in misses. Each
+    stream opens the file when it's first read, and keeps it open until close().
+    """
+
+    misses = 0
+    """(int): Reads that had to wait on the disk, across every stream"""
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+        self._buffer = bytearray()
+        self._buffer_start = start #position in the source of self._buffer[0]
+        self._next = start #where the next read is expected to start
+        self._filling = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_lock = threading.Lock()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("PCMStream slices can't have a step")
+        return PCMStream(self.source, self.start + start, self.start + max(start, stop))
+
+    def read(self, pos, size):
+        """ size bytes from pos (relative to the start of this stream), fewer at the end """
+        position = self.start + pos
+        size = max(0, min(size, self.end - position))
+        head = self.source.head
+        with self._lock:
+            self._next = position + size
+            data = head[position:position + size] if position < len(head) else b""
+            rest = position + len(data)
+            offset = rest - self._buffer_start
+            missing = size - len(data)
+            if missing and 0 <= offset and offset + missing <= len(self._buffer):
+                data += self._buffer[offset:offset + missing]
+                missing = 0
+            fill = not self._filling and not self._closed and self._ahead() < REFILL
+            if fill:
+                self._filling = True
+        if fill:
+            _read_ahead(self._fill)
+        if missing:
+            with _misses_lock:
+                PCMStream.misses += 1
+            data += self._read_file(rest, missing)
+        return data
+
+    def load(self):
+        """ The whole stream as bytes, for short streams (the ends that get crossfaded).
+        Closes the stream """
+        head = self.source.head
+        if self.end <= len(head):
+            return head[self.start:self.end]
+        data = self._read_file(self.start, len(self))
+        self.close()
+        return data
+
+    def close(self):
+        """ Close the file and drop the buffer. Reads after this get silence """
+        with self._lock:
+            self._closed = True
+            self._buffer = bytearray()
+        with self._file_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _ahead(self):
+        """ Bytes buffered past where the next read starts (or past the head, which doesn't
+        need buffering). Called with self._lock held """
+        want = max(self._next, len(self.source.head))
+        if want >= self.end:
+            return READ_AHEAD #nothing left to buffer
+        buffer_end = self._buffer_start + len(self._buffer)
+        if not self._buffer_start <= want <= buffer_end:
+            return 0
+        return buffer_end - want
+
+    def _fill(self):
+        """ Top the buffer up to READ_AHEAD bytes past the next read. Runs on the read-ahead thread """
+        try:
+            while True:
+                with self._lock:
+                    if self._closed:
+                        return
+                    want = max(self._next, len(self.source.head), self.start)
+                    buffer_end = self._buffer_start + len(self._buffer)
+                    if not self._buffer_start <= want <= buffer_end:
+                        # The stream jumped (back to the start of the loop), start over from there
+                        self._buffer = bytearray()
+                        self._buffer_start = want
+                    elif want > self._buffer_start:
+                        del self._buffer[:want - self._buffer_start] #already played
+                        self._buffer_start = want
+                    buffer_end = self._buffer_start + len(self._buffer)
+                    size = min(CHUNK, READ_AHEAD - len(self._buffer), self.end - buffer_end)
+                    if size <= 0:
+                        return
+                data = self._read_file(buffer_end, size)
+                with self._lock:
+                    if self._closed:
+                        return
+                    if self._buffer_start + len(self._buffer) != buffer_end:
+                        continue #jumped while reading, the data is for the wrong place
+                    self._buffer += data
+        finally:
+            with self._lock:
+                self._filling = False
+
+    def _read_file(self, position, size):
+        with self._file_lock:
+            if self._closed:
+                return bytes(size)
+            try:
+                if self._file is None:
+                    self._file = open(self.source.path, "rb")
+                self._file.seek(self.source.offset + position)
+                data = self._file.read(size)
+            except OSError as e:
+                print("Couldn't read " + self.source.path + ": " + str(e))
+                data = b""
+        if len(data) < size:
+            data += bytes(size - len(data)) #the file was cut short, play silence
+        return data
+
+def wav_source(path):
+    """ A PCMSource for a WAV file that's already in the mixer's format
+    Returns:
+        The PCMSource, or None if it isn't a PCM WAV file in the mixer's format
+    """
+    frequency, size, channels = mixer.get_init()
+    try:
+        with open(path, "rb") as wavFile:
+            header = wavFile.read(12)
+            if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+                return None
+            wav_format = None
+            while True:
+                chunk = wavFile.read(8)
+                if len(chunk) < 8:
+                    return None
+                name, length = struct.unpack("<4sI", chunk)
+                if name == b"fmt ":
+                    wav_format = struct.unpack("<HHIIHH", wavFile.read(16))
+                    wavFile.seek(length - 16 + (length & 1), 1)
+                elif name == b"data":
+                    break
+                else:
+                    wavFile.seek(length + (length & 1), 1)
+            offset = wavFile.tell()
+            length = min(length, wavFile.seek(0, 2) - offset)
+        if wav_format is None:
+            return None
+        tag, wav_channels, rate, byte_rate, block_align, bits = wav_format
+        if (tag, wav_channels, rate, bits, size, sys.byteorder) != (1, channels, frequency, 16, -16, "little"):
+            return None
+        return PCMSource(path, offset, length)
+    except (OSError, struct.error):
+        return None
+
+def wav_chunks(path, frames=32 * 1024):
+    """ Decode a WAV file a chunk at a time, converted to the mixer's format
+    Args:
+        path (str): The WAV file
+        frames (int): Frames per chunk, before conversion
+    Returns:
+        An iterator of PCM chunks (bytes), or None if the file can't be decoded this way
+        (it isn't a PCM WAV, or it needs a conversion and audioop isn't available)
+    """
+    frequency, size, channels = mixer.get_init()
+    try:
+        wav = wave.open(path, "rb")
+    except (wave.Error, EOFError, OSError):
+        return None
+    rate, width, wav_channels = wav.getframerate(), wav.getsampwidth(), wav.getnchannels()
+    same = (rate, width, wav_channels, sys.byteorder) == (frequency, 2, channels, "little")
+    if size != -16 or wav_channels not in (1, 2) or (not same and _audioop is None):
+        wav.close()
+        return None
+
+    def chunks():
+        state = None
+        with wav:
+            while True:
+                data = wav.readframes(frames)
+                if not data:
+                    return
+                if sys.byteorder == "big" and width > 1:
+                    data = _audioop.byteswap(data, width) #WAV is little-endian
+                if width == 1:
+                    data = _audioop.bias(data, 1, -128) #8-bit WAV is unsigned
+                if width != 2:
+                    data = _audioop.lin2lin(data, width, 2)
+                if wav_channels == 1 and channels == 2:
+                    data = _audioop.tostereo(data, 2, 1, 1)
+                elif wav_channels == 2 and channels == 1:
+                    data = _audioop.tomono(data, 2, 0.5, 0.5)
+                if rate != frequency:
+                    data, state = _audioop.ratecv(data, 2, channels, rate, frequency, state)
+                yield data
+    return chunks()
+
+def _frame_size():
+    frequency, size, channels = mixer.get_init()
+    return channels * (abs(size) // 8)
@@ -0,0 +1,295 @@
+""" Cache of decoded music files
+Decoding an MP3 takes long enough to be heard when it happens at GAME_START, so the
+TrackCache decodes the likely picks ahead of time. With a PCMCache folder, every file is
+decoded once to disk and memory-mapped from then on. Otherwise the tracks are kept as
+pygame Sound objects under a memory budget, evicting the least recently used ones first.
+Between games, the songs already picked for the next games are prefetched before the rest.
+Tracks over stream_mb are streamed from disk as they play rather than held in memory.
+Without a PCMCache, only WAV files already in the mixer's format can be streamed, so other
+tracks over stream_mb are skipped rather than decoded whole into memory.
+"""
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from pygame import mixer
+from pygame import error as pg_error
+
+from melee.metrics import METRICS
+from melee.pcmcache import PCMCache
+from melee.stream import PCMSource, wav_chunks, wav_source
+from melee.workers import Worker
+
+class TrackCache():
+    """ LRU cache of decoded (PCM) tracks, keyed by file name relative to the music folder
+    Tracks are mixer.Sound objects, or read-only memoryviews of memory-mapped PCM when
+    they come from the PCMCache, or PCMSources for tracks that are streamed. Any of them
+    can be handed to MusicPlayer.play().
+    """
+
+    def __init__(self, music_dir, budget_mb=256, cache_dir=None, stream_mb=32):
+        """ Constructor for this object
+        Args:
+            music_dir (str): Folder the file names in musicConfig.txt are relative to
+            budget_mb (int): How much decoded audio to keep in memory, in megabytes.
+                Memory-mapped tracks don't count towards it.
+            cache_dir (str): Folder to keep decoded files in between runs, or None to
+                decode everything in memory on every run
+            stream_mb (int): Stream tracks with more than this many megabytes of PCM from
+                disk instead of keeping them in memory, 0 to never stream. Needs cache_dir,
+                except for WAV files already in the mixer's format. Without cache_dir, other
+                files that are longer are skipped
+        """
+        self.music_dir = music_dir
+        self.budget = budget_mb * 1024 * 1024
+        self.pcm = PCMCache(cache_dir) if cache_dir else None
+        self.stream_above = stream_mb * 1024 * 1024 if stream_mb > 0 else None
+        self.size = 0
+        self._tracks = OrderedDict()
+        self._loading = {} #file name -> lock held while it's being decoded, so it's only decoded once
+        self._prefetched = {} #file name -> seconds it took to decode, for prefetched files not played yet
+        self._durations = {} #file name -> seconds, as probed by the Library, to skip tracks too long to keep
+        self._too_long = set() #files skipped for being too long, so they're only reported once
+        self._lock = threading.Lock()
+        self._thread = None
+        self._prefetcher = None
+        self._closed = False
+
+    def path(self, fileName):
+        """ Full path of a file from musicConfig.txt """
+        return os.path.normpath(os.path.join(self.music_dir, fileName))
+
+    def get(self, fileName):
+        """ Get the decoded track for a file, decoding it now if it isn't cached
+        Returns:
+            The track, or None if the file couldn't be decoded
+        """
+        with self._lock:
+            sound = self._tracks.get(fileName)
+            if sound is not None:
+                self._tracks.move_to_end(fileName)
+                self._prefetched.pop(fileName, None)
+                return sound
+        return self._load_once(fileName)[0]
+
+    def __contains__(self, fileName):
+        with self._lock:
+            return fileName in self._tracks
+
+    def preload(self, library):
+        """ Decode the most likely picks for every stage in a background thread
+        Args:
+            library (Library): The music library. Files are decoded from most to least
+                likely to be picked until the budget is full. With a PCMCache every file
+                is loaded, decoding only files that aren't cached yet or have changed since.
+        """
+        self._durations = self._probed_durations(library)
+        self._thread = threading.Thread(target=self._preload, args=(self.rank(library),),
+                                        name="TrackCache preload", daemon=True)
+        self._thread.start()
+        atexit.register(self.close) #before pygame quits the mixer
+
+    def prefetch(self, fileNames, spare=()):
+        """ Decode files that are about to be played, in a background thread
+        Args:
+            fileNames (list): Files to decode even if that evicts others, most likely first.
+                Those that are already cached are kept from being evicted next
+            spare (list): Files to decode only while there's room left in the budget
+        """
+        with self._lock:
+            for fileName in reversed(fileNames):
+                if fileName in self._tracks:
+                    self._tracks.move_to_end(fileName)
+        if self._prefetcher is None:
+            self._prefetcher = Worker("Prefetch")
+            atexit.register(self.close) #before pygame quits the mixer
+        self._prefetcher.post(self._prefetch, list(fileNames), list(spare))
+
+    def stats(self):
+        """ How full the cache is """
+        with self._lock:
+            return {"tracks": len(self._tracks),
+                    "mapped": sum(1 for sound in self._tracks.values() if isinstance(sound, memoryview)),
+                    "streamed": sum(1 for sound in self._tracks.values() if isinstance(sound, PCMSource)),
+                    "size_mb": self.size / (1024 * 1024),
+                    "budget_mb": self.budget / (1024 * 1024),
+                    "prefetched_unplayed": len(self._prefetched)}
+
+    @staticmethod
+    def rank(library):
+        """ Every file in the library, ordered from most to least likely to be played next """
+        odds = library.odds()
+        return sorted(odds, key=odds.get, reverse=True)
+
+    def update(self, library, stale):
+        """ Bring the cache up to date with a reloaded library, in the calling thread
+        Args:
+            library (Library): The reloaded library
+            stale (list): File names that changed or were removed since the last load. They're
+                dropped from the cache, then whatever the budget allows is loaded again.
+        """
+        wasted = []
+        self._durations = self._probed_durations(library)
+        self._too_long.difference_update(stale)
+        with self._lock:
+            for fileName in stale:
+                sound = self._tracks.pop(fileName, None)
+                if sound is not None:
+                    self.size -= self._sizeof(sound)
+                if fileName in self._prefetched:
+                    wasted.append(self._prefetched.pop(fileName))
+        self._count_wasted(wasted)
+        self._preload(self.rank(library))
+
+    def close(self):
+        """ Stop preloading and prefetching. Waits briefly for a decode in progress, since
+        the mixer can't be shut down while a Sound is being decoded
+        """
+        self._closed = True
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        if self._prefetcher is not None:
+            self._prefetcher.stop(timeout=2)
+
+    def _preload(self, ranked):
+        for fileName in ranked:
+            if self._closed:
+                return
+            if fileName in self:
+                continue
+            if not self._load_once(fileName, evict=False)[2]:
+                break # everything after this is less likely, don't evict for it
+
+    def _prefetch(self, fileNames, spare):
+        for fileName, evict in [(fileName, True) for fileName in fileNames] + [(fileName, False) for fileName in spare]:
+            if self._closed:
+                return
+            if not evict and self.size >= self.budget:
+                return
+            sound, seconds, fits = self._load_once(fileName, evict, prefetched=True)
+            if seconds and METRICS.enabled:
+                METRICS.count("prefetch_decodes")
+                METRICS.count("prefetch_decode_seconds", seconds)
+            if not fits:
+                self._count_wasted([seconds])
+                return
+
+    def _load_once(self, fileName, evict=True, prefetched=False):
+        """ Load a file and cache it, unless it's cached already. If another thread is
+        loading it, waits for that instead of loading it twice
+        Args:
+            evict (bool): Evict other tracks to make room. If False, the track is only
+                cached if it fits in what's left of the budget
+            prefetched (bool): The prefetcher is loading it, to tell if it goes unplayed
+        Returns:
+            (track or None, seconds spent loading it, False if it was loaded but didn't fit)
+        """
+        with self._lock:
+            lock = self._loading.setdefault(fileName, threading.Lock())
+        with lock:
+            with self._lock:
+                sound = self._tracks.get(fileName)
+            if sound is not None:
+                return sound, 0.0, True
+            started = time.perf_counter()
+            sound = self._load(fileName)
+            seconds = time.perf_counter() - started
+            if sound is None:
+                return None, seconds, True
+            if not evict and self.size + self._sizeof(sound) > self.budget:
+                return sound, seconds, False
+            self._add(fileName, sound, seconds if prefetched else None)
+            return sound, seconds, True
+
+    def _load(self, fileName):
+        """ Map a file from the PCMCache, decoding (and caching) it first if needed. WAV
+        files are decoded into the cache a chunk at a time. Tracks over the streaming limit
+        come back as PCMSources
+        """
+        path = self.path(fileName)
+        if self.pcm is None:
+            if self.stream_above is None:
+                return self._decode(fileName)
+            source = wav_source(path)
+            if source is not None:
+                return source if len(source) > self.stream_above else self._decode(fileName)
+            # Only a PCMCache could stream anything else. Skip it rather than letting one
+            # long track take up the memory of all the others
+            if fileName in self._too_long or self._decoded_size(self._durations.get(fileName)) > self.stream_above:
+                return self._skip(fileName)
+            sound = self._decode(fileName)
+            if sound is not None and self._sizeof(sound) > self.stream_above:
+                return self._skip(fileName) #the probe didn't know how long it was
+            return sound
+        pcm = self.pcm.load(path, self.stream_above)
+        if pcm is not None:
+            return pcm
+        chunks = wav_chunks(path)
+        if chunks is not None:
+            pcm = self.pcm.store_chunks(path, chunks, self.stream_above)
+            if pcm is not None:
+                return pcm
+        sound = self._decode(fileName)
+        if sound is None:
+            return None
+        pcm = self.pcm.store(path, sound, self.stream_above)
+        return pcm if pcm is not None else sound
+
+    def _skip(self, fileName):
+        if fileName not in self._too_long:
+            self._too_long.add(fileName)
+            print("Skipping " + self.path(fileName) + ": it's over stream_mb once decoded, and only WAV files"
+                  " in the mixer's format can be streamed without pcm_cache")
+        return None
+
+    @staticmethod
+    def _probed_durations(library):
+        return {fileName: info["duration"] for fileName, info in library.info.items() if info.get("duration")}
+
+    @staticmethod
+    def _decoded_size(seconds):
+        """ Bytes of PCM a track of this many seconds decodes to, 0 if that isn't known """
+        if not seconds:
+            return 0
+        frequency, size, channels = mixer.get_init()
+        return int(seconds * frequency) * channels * (abs(size) // 8)
+
+    def _decode(self, fileName):
+        try:
+            return mixer.Sound(self.path(fileName))
+        except (pg_error, FileNotFoundError):
+            print("Couldn't decode " + self.path(fileName) + ". Usually means the filename is wrong.")
+            return None
+
+    def _add(self, fileName, sound, prefetched=None):
+        """ Cache a track. prefetched is how long it took to decode, if the prefetcher did it """
+        wasted = []
+        with self._lock:
+            if fileName in self._tracks:
+                return
+            self._tracks[fileName] = sound
+            self.size += self._sizeof(sound)
+            if prefetched is not None:
+                self._prefetched[fileName] = prefetched
+            # Never evict the track that was just added, even if it's over the budget by itself
+            while self.size > self.budget and len(self._tracks) > 1:
+                evicted, evicted_sound = self._tracks.popitem(last=False)
+                self.size -= self._sizeof(evicted_sound)
+                if evicted in self._prefetched:
+                    wasted.append(self._prefetched.pop(evicted))
+        self._count_wasted(wasted)
+
+    @staticmethod
+    def _count_wasted(wasted):
+        if wasted and METRICS.enabled:
+            METRICS.count("prefetch_wasted", len(wasted))
+            METRICS.count("prefetch_wasted_seconds", sum(wasted))
+
+    @staticmethod
+    def _sizeof(sound):
+        if isinstance(sound, memoryview):
+            return 0 #memory-mapped, the OS pages it in and out as needed
+        if isinstance(sound, PCMSource):
+            return len(sound.head) #streamed, only the start is kept in memory
+        return TrackCache._decoded_size(sound.get_length())
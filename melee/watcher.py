@@ -0,0 +1,144 @@
+""" Watches a folder for changes, so the music library can be reloaded without a restart
+Uses inotify on Linux (through ctypes, no extra dependencies) and falls back to comparing
+the modification times and sizes of the files in the folder every so often elsewhere.
+Changes are reported once the folder has been quiet for a moment, so a song that's still
+being copied in isn't picked up half-written.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+# inotify event mask bits, from <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII") #wd, mask, cookie, length of the name that follows
+
+class DirectoryWatcher():
+    """ Calls back with the names of the files that changed in a folder """
+
+    def __init__(self, path, callback, interval=1.0, settle=0.5):
+        """ Constructor for this object
+        Args:
+            path (str): Folder to watch. Subfolders aren't watched.
+            callback (function): Called on the watcher thread with a set of the names of the
+                files that were added, changed or removed
+            interval (float): Seconds between checks when polling
+            settle (float): Seconds the folder has to be quiet before changes are reported
+        """
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.settle = settle
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        """ Start watching, on a background thread """
+        fd = self._inotify()
+        target = self._watch_inotify if fd is not None else self._watch_polling
+        self._thread = threading.Thread(target=target, args=(fd,), name="Directory watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop watching. Waits for a callback in progress to finish """
+        self._closed = True
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+
+    def _inotify(self):
+        """ An inotify file descriptor watching self.path, or None if inotify isn't available """
+        if not hasattr(os, "O_NONBLOCK"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init = libc.inotify_init1
+            add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError, TypeError):
+            return None
+        fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if add_watch(fd, os.fsencode(self.path), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _watch_inotify(self, fd):
+        try:
+            while not self._closed:
+                names = self._read_events(fd, 1.0)
+                if not names:
+                    continue
+                # Keep collecting until nothing has happened for self.settle seconds
+                while not self._closed:
+                    more = self._read_events(fd, self.settle)
+                    if not more:
+                        break
+                    names |= more
+                if not self._closed:
+                    self.callback(names)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_events(fd, timeout):
+        """ Names from the inotify events that arrive within timeout seconds """
+        readable = select.select([fd], [], [], timeout)[0]
+        if not readable:
+            return set()
+        names = set()
+        while True:
+            try:
+                data = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                names.add(os.fsdecode(name))
+                offset += EVENT.size + length
+
+    def _watch_polling(self, fd=None):
+        before = self._snapshot()
+        while not self._closed:
+            time.sleep(self.interval)
+            after = self._snapshot()
+            if after == before:
+                continue
+            # Wait for the folder to stop changing
+            while not self._closed:
+                time.sleep(self.settle)
+                settled = self._snapshot()
+                if settled == after:
+                    break
+                after = settled
+            names = {name for name in before.keys() | after.keys() if before.get(name) != after.get(name)}
+            before = after
+            if not self._closed:
+                self.callback(names)
+
+    def _snapshot(self):
+        """ Modification time and size of every file in the folder """
+        files = {}
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue #removed since the folder was listed
+                    files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+        return files
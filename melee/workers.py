@@ -0,0 +1,111 @@
+""" Threads that split up the work of Console.step
+The Receiver drains the Slippstream connection into a bounded queue so packets are read
+as soon as they arrive, and the Worker runs audio/control actions (starting and stopping
+music) in order without holding up event parsing.
+"""
+import queue
+import threading
+import time
+
+class Receiver():
+    """ Drains SlippstreamClient.dispatch_batch on its own thread into a bounded queue
+    Each item in the queue is the list of messages read by one dispatch_batch() call.
+    """
+
+    def __init__(self, client, maxsize=1024):
+        """ Constructor for this object
+        Args:
+            client (SlippstreamClient): Connected client to read messages from
+            maxsize (int): Most batches to hold before the thread stops reading and lets
+                ENet buffer them instead
+        """
+        self.client = client
+        self.messages = queue.Queue(maxsize)
+        self.received = 0
+        self.max_depth = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """ Start reading messages, if not already reading """
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="Receiver", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop reading messages. Waits for the current dispatch() to return """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def stats(self):
+        return {"received": self.received,
+                "depth": self.messages.qsize(),
+                "max_depth": self.max_depth}
+
+    def _run(self):
+        while self._running:
+            messages = self.client.dispatch_batch()
+            if not messages:
+                continue
+            self.messages.put(messages)
+            self.received += len(messages)
+            depth = self.messages.qsize()
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+class Worker():
+    """ Runs actions posted from other threads one at a time, in the order they were posted """
+
+    def __init__(self, name):
+        self.name = name
+        self.events = queue.Queue()
+        self.handled = 0
+        self.max_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def post(self, action, *args):
+        """ Run action(*args) on the worker thread """
+        self.events.put((time.perf_counter(), action, args))
+        depth = self.events.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def stop(self, timeout=None):
+        """ Run the actions already posted, then end the thread
+        Args:
+            timeout (float): Most seconds to wait for that, None to wait until it's done
+        """
+        self.events.put((time.perf_counter(), None, ()))
+        self._thread.join(timeout)
+
+    def stats(self):
+        """ Counters for how far behind the worker is running
+        latency is from post() until the action finished, in milliseconds
+        """
+        return {"handled": self.handled,
+                "depth": self.events.qsize(),
+                "max_depth": self.max_depth,
+                "avg_latency_ms": self.total_latency / self.handled * 1000 if self.handled else 0.0,
+                "max_latency_ms": self.max_latency * 1000}
+
+    def _run(self):
+        while True:
+            posted, action, args = self.events.get()
+            if action is None:
+                return
+            try:
+                action(*args)
+            except Exception as e: # pylint: disable=broad-except
+                # Keep the worker alive, one bad action shouldn't kill the music for the session
+                print("Error in " + self.name + " thread: " + repr(e))
+            latency = time.perf_counter() - posted
+            self.handled += 1
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
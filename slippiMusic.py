@@ -1,75 +1,243 @@
 #adapted by regEx from altf4's project https://github.com/altf4/libmelee
+from melee.metrics import METRICS, STARTUP #first, so startup is timed from here
 import signal
 import sys
 import os
+import multiprocessing
+import threading
+import time
 import melee
+from melee.stations import Stations
+from melee.profiler import SamplingProfiler, dump_state
 
-path = None
-port = 51441
-volume = 70
-menu = False
-iso_path = None
+# Everything runs under this guard because the music library is probed in a process pool,
+# and on Windows every process in the pool imports this file
+if __name__ == "__main__":
+    multiprocessing.freeze_support() #for the packaged releases
+    path = None
+    port = 51441
+    volume = 70
+    menu = False
+    iso_path = None
+    cache_mb = 256
+    stream_mb = 32
+    pcm_cache = True
+    watch = True
+    crossfade_ms = 0
+    fadeout_ms = 0
+    replay = None
+    realtime = True
+    metrics = None
+    metrics_interval = 10
+    extract_music = False
+    stations = [] #(port, audio device or None, volume or None) per station
 
-#simple parser for the config file
-configPath = melee.console.get_slippiMusic_config_path()
-try:
-    configFile = open(configPath)
-except FileNotFoundError:
-    print("No config file found at " + configPath + "! Using defaults...")
-else:
-    for line in configFile:
-        split = line.split("=")
-        var = split[0].strip().lower()
-        if var == "path":
-            path = split[1].strip()
-        elif var == "slippi_port":
-            try:
-                port = int(split[1].strip())
-            except valueError:
-                input('There was an error parsing the port in the config file! Should be "slippi_port = [num]. Pres enter to exit...')
-                sys.exit(-1)
-        elif var == "volume":
-            try:
-                volume = int(split[1].strip())
-                if volume > 100:
-                    volume = 100
-                elif volume < 0:
-                    volume = 0
-            except valueError:
-                input('There was an error parsing the volume in the config file! Should be "volume = [num]! Press enter to exit...')
-                sys.exit(-1)
-        elif var == "menu":
-            menu = split[1].strip().lower()[0] in ["y", "t"]
-        elif var == "iso_path":
-            iso_path = os.path.normpath(split[1].strip())
+    #simple parser for the config file
+    started = time.perf_counter()
+    configPath = melee.console.get_slippiMusic_config_path()
+    try:
+        configFile = open(configPath)
+    except FileNotFoundError:
+        print("No config file found at " + configPath + "! Using defaults...")
+    else:
+        for line in configFile:
+            split = line.split("=")
+            var = split[0].strip().lower()
+            if var == "path":
+                path = split[1].strip()
+            elif var == "slippi_port":
+                try:
+                    port = int(split[1].strip())
+                except valueError:
+                    input('There was an error parsing the port in the config file! Should be "slippi_port = [num]. Pres enter to exit...')
+                    sys.exit(-1)
+            elif var == "volume":
+                try:
+                    volume = int(split[1].strip())
+                    if volume > 100:
+                        volume = 100
+                    elif volume < 0:
+                        volume = 0
+                except valueError:
+                    input('There was an error parsing the volume in the config file! Should be "volume = [num]! Press enter to exit...')
+                    sys.exit(-1)
+            elif var == "menu":
+                menu = split[1].strip().lower()[0] in ["y", "t"]
+            elif var == "iso_path":
+                iso_path = os.path.normpath(split[1].strip())
+            elif var == "crossfade_ms":
+                try:
+                    crossfade_ms = min(1000, max(0, int(split[1].strip()))) #longer ones would make starting a song slow
+                except ValueError:
+                    input('There was an error parsing the crossfade in the config file! Should be "crossfade_ms = [num]! Press enter to exit...')
+                    sys.exit(-1)
+            elif var == "fadeout_ms":
+                try:
+                    fadeout_ms = max(0, int(split[1].strip()))
+                except ValueError:
+                    input('There was an error parsing the fadeout in the config file! Should be "fadeout_ms = [num]! Press enter to exit...')
+                    sys.exit(-1)
+            elif var == "replay":
+                replay = os.path.normpath(split[1].strip())
+            elif var == "realtime":
+                realtime = split[1].strip().lower()[0] in ["y", "t"]
+            elif var == "metrics":
+                metrics = os.path.normpath(split[1].strip())
+            elif var == "metrics_interval":
+                try:
+                    metrics_interval = max(1, float(split[1].strip()))
+                except ValueError:
+                    input('There was an error parsing the metrics interval in the config file! Should be "metrics_interval = [seconds]! Press enter to exit...')
+                    sys.exit(-1)
+            elif var == "watch":
+                watch = split[1].strip().lower()[0] in ["y", "t"]
+            elif var == "extract_music":
+                extract_music = split[1].strip().lower()[0] in ["y", "t"]
+            elif var == "pcm_cache":
+                pcm_cache = split[1].strip().lower()[0] in ["y", "t"]
+            elif var == "station":
+                # station = port, audio device, volume   (device and volume can be left out)
+                fields = [field.strip() for field in line.split("=", 1)[1].split(",")]
+                try:
+                    station_port = int(fields[0])
+                    station_volume = min(100, max(0, int(fields[-1]))) if len(fields) > 2 else None
+                except ValueError:
+                    input('There was an error parsing a station in the config file! Should be "station = [port], [audio device], [volume]"! Press enter to exit...')
+                    sys.exit(-1)
+                output = ",".join(fields[1:-1] if len(fields) > 2 else fields[1:])
+                stations.append((station_port, None if output.lower() in ["", "default"] else output, station_volume))
+            elif var == "cache_mb":
+                try:
+                    cache_mb = max(0, int(split[1].strip()))
+                except ValueError:
+                    input('There was an error parsing the cache size in the config file! Should be "cache_mb = [num]! Press enter to exit...')
+                    sys.exit(-1)
+            elif var == "stream_mb":
+                try:
+                    stream_mb = max(0, int(split[1].strip()))
+                except ValueError:
+                    input('There was an error parsing the streaming size in the config file! Should be "stream_mb = [num]! Press enter to exit...')
+                    sys.exit(-1)
     
+    STARTUP.record("config", started)
+    if metrics:
+        METRICS.enable(metrics, metrics_interval)
 
-console = melee.Console(path=path,
-                        slippi_port=port,
-                         volume = volume, menu = menu)
+    extracted = os.path.join(os.path.dirname(melee.__file__), "music", "extracted")
+    if extract_music and iso_path and not os.path.isfile(os.path.join(extracted, "musicConfig.txt")):
+        from melee import hps
+        print("Extracting the music from " + iso_path + "...")
+        started = time.perf_counter()
+        try:
+            written = hps.extract(iso_path, extracted)
+        except (OSError, ValueError) as e:
+            print("Couldn't extract the music: " + str(e))
+        else:
+            print("Extracted %d tracks in %.1f s. To use them, copy the lines from %s into melee/music/musicConfig.txt"
+                  % (len(written), time.perf_counter() - started, os.path.join(extracted, "musicConfig.txt")))
+
+    # The Consoles start the mixer and load the music in the background, so Dolphin is
+    # launched straight after and boots while that happens
+    if stations:
+        # Several setups on this PC, each with its own port and audio output. Dolphin
+        # isn't launched, each setup runs its own
+        console = Stations(menu = menu, cache_mb = cache_mb, stream_mb = stream_mb, pcm_cache = pcm_cache, watch = watch,
+                           crossfade_ms = crossfade_ms, fadeout_ms = fadeout_ms)
+        for station_port, output, station_volume in stations:
+            console.add(station_port, output, volume if station_volume is None else station_volume)
+    else:
+        console = melee.Console(path=path,
+                                slippi_port=port,
+                                 volume = volume, menu = menu,
+                                 cache_mb = cache_mb, stream_mb = stream_mb, pcm_cache = pcm_cache, watch = watch,
+                                 crossfade_ms = crossfade_ms, fadeout_ms = fadeout_ms,
+                                 replay = replay, realtime = realtime)
                         
-# This isn't necessary, but makes it so that Dolphin will get killed when you ^C
-def signal_handler(sig, frame):
-    console.stop()
-    print("Shutting down cleanly...")
-    sys.exit(0)
+    # This isn't necessary, but makes it so that Dolphin will get killed when you ^C
+    def print_metrics():
+        if METRICS.enabled:
+            METRICS.write()
+            print(METRICS.summary())
+
+    def signal_handler(sig, frame):
+        console.stop()
+        print_metrics()
+        print("Shutting down cleanly...")
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, signal_handler)
+
+    # For looking into problems without restarting: SIGUSR1 starts and stops the profiler,
+    # SIGUSR2 writes out what every thread is doing. Both write files to the current folder
+    profiler = SamplingProfiler()
+
+    def profile_handler(sig, frame):
+        if not profiler.running:
+            profiler.start()
+            print("Profiling, send SIGUSR1 again to stop")
+            return
+        profilePath = time.strftime("slippimusic-%Y%m%d-%H%M%S.pstats")
+        try:
+            profiler.stop(profilePath)
+        except OSError as e:
+            print("Couldn't write the profile: " + str(e))
+        else:
+            print("Wrote a profile of %d samples to %s" % (profiler.samples, os.path.abspath(profilePath)))
 
-signal.signal(signal.SIGINT, signal_handler)
+    def dump_handler(sig, frame):
+        statePath = time.strftime("slippimusic-%Y%m%d-%H%M%S-state.txt")
+        try:
+            dump_state(statePath, console.stats())
+        except OSError as e:
+            print("Couldn't write the state dump: " + str(e))
+        else:
+            print("Wrote the state of every thread to " + os.path.abspath(statePath))
 
-# Run the console
-if(path):
-    console.run(iso_path = iso_path)
+    if hasattr(signal, "SIGUSR1"): #not on Windows
+        signal.signal(signal.SIGUSR1, profile_handler)
+        signal.signal(signal.SIGUSR2, dump_handler)
 
-# Connect to the console
-while True:
-    print("Connecting to console...")
-    if console.connect():
-        print("Connected to console!")
-        break
-    user_input = input("ERROR: Failed to connect to the console. Try again? y/n ")
-    if(str(user_input).strip().lower()[0] != 'y'):    
-        sys.exit(-1)
+    def print_startup(ready):
+        ready.wait_ready()
+        print(STARTUP.report())
+
+    def exit_if_music_failed(ready):
+        # Waits on the main thread: station threads can't prompt or exit the program
+        ready.wait_ready()
+        if ready.music_failed:
+            input("Couldn't load the music! Press enter to exit...")
+            console.stop()
+            sys.exit(1)
+
+    if stations:
+        exit_if_music_failed(console.consoles[0]) #the other stations share its music
+        console.start()
+        print("Listening for " + str(len(stations)) + " stations on ports " + ", ".join(str(station[0]) for station in stations))
+        threading.Thread(target=print_startup, args=(console.consoles[0],), daemon=True).start()
+        while True:
+            time.sleep(1) #the stations run on their own threads until ^C
+
+    # Run the console
+    if(path and not replay):
+        console.run(iso_path = iso_path)
+    exit_if_music_failed(console) #the music loads while Dolphin boots
+
+    # Connect to the console
+    started = time.perf_counter()
+    while True:
+        print("Connecting to console...")
+        if console.connect():
+            print("Connected to console!")
+            STARTUP.record("connect", started)
+            threading.Thread(target=print_startup, args=(console,), daemon=True).start()
+            break
+        user_input = input("ERROR: Failed to connect to the console. Try again? y/n ")
+        if(str(user_input).strip().lower()[0] != 'y'):    
+            sys.exit(-1)
     
     
-while True:
-    console.step();
+    while not console.finished:
+        console.step();
+    print("Replay finished! Exiting...")
+    console.stop()
+    print_metrics()
@@ -0,0 +1,21 @@
+""" Shared fixtures. Everything runs under SDL's dummy audio driver, which plays nothing
+but pulls audio from the mixer in real time like a sound card would
+"""
+import os
+import sys
+
+import pytest
+
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FREQUENCY = 44100
+
+@pytest.fixture(scope="session")
+def mixer():
+    """ The pygame mixer, started at 44.1kHz 16-bit stereo. pygame quits it at exit, after
+    the players have closed """
+    from pygame import mixer
+    mixer.init(FREQUENCY, -16, 2)
+    return mixer
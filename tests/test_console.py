@@ -0,0 +1,86 @@
+""" Console start-up: the music loads on the audio thread while everything else starts.
+And once it's running, sitting on the menu costs next to no CPU
+"""
+import multiprocessing
+import threading
+import time
+
+import melee
+
+IDLE_SECONDS = 4
+IDLE_CPU_PERCENT = 5 #under 1% measured here, with the menu music playing
+
+def step_forever(console):
+    while True:
+        console.step()
+
+def test_follower_of_a_failed_console_wakes_step(capsys):
+    first = melee.Console(slippi_port=51541, menu=False, cache_mb=0, pcm_cache=False, watch=False)
+    assert first.wait_ready(30)
+    first._music_failed = True #as if musicConfig.txt couldn't be read
+    second = melee.Console(slippi_port=51542, menu=False, cache_mb=0, pcm_cache=False, watch=False,
+                           channel=1, shared=first)
+    try:
+        assert second.wait_ready(30)
+        assert second._music_failed
+        assert second._receiver.messages.get(timeout=5) == [] #wakes step() so it can exit
+        assert "Error in Audio thread" not in capsys.readouterr().out
+    finally:
+        second.stop()
+        first.stop()
+
+def test_step_returns_when_the_music_failed():
+    # step() runs on the station threads, so it can't prompt or exit: slippiMusic.py checks
+    # music_failed on the main thread instead
+    from melee.stations import Stations
+    console = melee.Console(slippi_port=51544, menu=False, cache_mb=0, pcm_cache=False, watch=False)
+    try:
+        assert console.wait_ready(30)
+        assert not console.music_failed
+        console._Console__fail() #as if musicConfig.txt couldn't be read
+        assert console.music_failed
+        assert console.step() is None
+        thread = threading.Thread(target=Stations._run, args=(console,), daemon=True)
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+    finally:
+        console.stop()
+
+def serve_idle(port, seconds, ready, connected):
+    """ Server process: accept the Console and then send nothing, like Dolphin on the menus.
+    Events rather than a Queue, since the server holds the GIL while it waits for packets
+    and a Queue's feeder thread wouldn't get to run """
+    from melee.slippstreamserver import SlippstreamServer
+    server = SlippstreamServer(port=port)
+    ready.set()
+    if server.wait_for_client():
+        connected.set()
+        server.idle(seconds)
+
+def test_idle_on_the_menu_uses_little_cpu():
+    ready = multiprocessing.Event()
+    connected = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_idle, args=(51543, 30, ready, connected), daemon=True)
+    server.start()
+    assert ready.wait(10)
+    console = melee.Console(slippi_port=51543, menu=True, cache_mb=0, pcm_cache=False, watch=False)
+    try:
+        assert console.wait_ready(30)
+        assert console.connect()
+        threading.Thread(target=step_forever, args=(console,), daemon=True).start()
+        assert connected.wait(10)
+        deadline = time.monotonic() + 15
+        while not console._player.get_busy() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert console._player.get_busy() #the menu music is playing
+        time.sleep(1)
+        wall = time.monotonic()
+        cpu = time.process_time()
+        time.sleep(IDLE_SECONDS)
+        percent = (time.process_time() - cpu) / (time.monotonic() - wall) * 100
+        print("Idle on the menu: %.2f%% CPU" % percent)
+        assert percent < IDLE_CPU_PERCENT
+    finally:
+        console.stop()
+        server.terminate()
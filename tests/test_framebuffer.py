@@ -0,0 +1,77 @@
+""" FrameBuffer: wrapping around, history() order and stock losses """
+import pytest
+
+from melee.framebuffer import FIRST_FRAME, POST_FRAME, FrameBuffer
+
+def post_frame(frame, port, stocks, percent=0.0, action=0, follower=False):
+    """ A POST_FRAME event with the fields FrameBuffer reads, and its command byte first """
+    event = bytearray(1 + POST_FRAME.size)
+    event[0] = 0x38
+    POST_FRAME.pack_into(event, 1, frame, port, follower, action, percent, stocks)
+    return memoryview(event)
+
+def play(frames, first=FIRST_FRAME, capacity=10):
+    """ A buffer with frames first.. for ports 0 and 1. Port 0's percent is the frame number,
+    port 1 loses a stock every 7 frames until it has none """
+    buffer = FrameBuffer(capacity)
+    for frame in range(first, first + frames):
+        buffer.post_frame(post_frame(frame, 0, 4, percent=frame, action=frame - first), 0)
+        buffer.post_frame(post_frame(frame, 1, max(0, 4 - (frame - first) // 7)), 0)
+    return buffer
+
+def test_before_wrapping():
+    buffer = play(6)
+    assert (buffer.first, buffer.latest) == (FIRST_FRAME, FIRST_FRAME + 5)
+    assert list(buffer.history("percent", 0)) == [float(FIRST_FRAME + i) for i in range(6)]
+    assert list(buffer.history("action", 0, frames=3)) == [3, 4, 5]
+    assert buffer.get("action", 0) == 5
+    assert buffer.get("action", 0, FIRST_FRAME) == 0
+    assert buffer.get("action", 0, FIRST_FRAME - 1) is None
+
+@pytest.mark.parametrize("frames", [10, 11, 17, 20, 23, 100])
+def test_history_wraps_around_oldest_first(frames):
+    buffer = play(frames)
+    latest = FIRST_FRAME + frames - 1
+    kept = list(range(max(FIRST_FRAME, latest - 9), latest + 1))
+    assert list(buffer.history("percent", 0)) == [float(frame) for frame in kept]
+    assert list(buffer.history("action", 0)) == [frame - FIRST_FRAME for frame in kept]
+    for count in (1, 3, 9, 10, 50):
+        assert list(buffer.history("percent", 0, frames=count)) == [float(frame) for frame in kept[-count:]]
+    assert buffer.get("percent", 0, kept[0]) == kept[0]
+    assert buffer.get("percent", 0, kept[0] - 1) is None #overwritten
+    assert buffer.get("percent", 0, latest + 1) is None #not there yet
+
+def test_games_that_do_not_start_at_the_first_frame():
+    # A client that connects mid-game sees frame numbers from wherever the game is
+    buffer = play(15, first=1000)
+    assert list(buffer.history("action", 0)) == list(range(5, 15))
+    assert buffer.get("action", 0, 1005) == 5
+
+def test_ports_that_are_not_playing():
+    buffer = play(5)
+    assert buffer.stocks() == [4, 4, -1, -1]
+    assert len(buffer.history("percent", 2)) == 0
+    assert buffer.get("percent", 2) is None
+
+def test_frames_since_stock_lost():
+    buffer = play(3)
+    assert buffer.last_stock_lost() is None
+    assert buffer.frames_since_stock_lost() is None
+    buffer = play(25)
+    # Port 1 went 4 -> 3 -> 2 -> 1 on the 7th, 14th and 21st frames
+    assert buffer.stocks()[1] == 1
+    assert buffer.last_stock_lost(1) == FIRST_FRAME + 21
+    assert buffer.frames_since_stock_lost(1) == 3
+    assert buffer.frames_since_stock_lost() == 3
+    assert buffer.frames_since_stock_lost(0) is None
+
+def test_followers_are_ignored_and_reset_forgets_the_game():
+    buffer = play(5)
+    buffer.post_frame(post_frame(FIRST_FRAME + 5, 0, 1, follower=True), 0)
+    assert buffer.latest == FIRST_FRAME + 4
+    assert buffer.stocks()[0] == 4
+    buffer.reset()
+    assert (buffer.first, buffer.latest) == (None, None)
+    assert buffer.stocks() == [-1] * 4
+    assert buffer.last_stock_lost() is None
+    assert len(buffer.history("percent", 0)) == 0
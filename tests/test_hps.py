@@ -0,0 +1,241 @@
+""" The .hps extractor, on synthetic HPS files and a synthetic GameCube disc """
+import math
+import random
+import struct
+import wave
+from array import array
+
+import pytest
+
+from melee import hps
+
+def reference_decode(data, offset, samples, coefficients, hist1, hist2):
+    """ DSP-ADPCM decoded one sample at a time, straight from the format's description """
+    out = []
+    for i in range(samples):
+        frame, position = divmod(i, 14)
+        header = data[offset + frame * 8]
+        scale = 1 << (header & 0xF)
+        c1, c2 = coefficients[(header >> 4) & 0x7]
+        byte = data[offset + frame * 8 + 1 + position // 2]
+        nibble = byte >> 4 if position % 2 == 0 else byte & 0xF
+        if nibble >= 8:
+            nibble -= 16
+        sample = (((nibble * scale) << 11) + 1024 + c1 * hist1 + c2 * hist2) >> 11
+        sample = max(-32768, min(32767, sample))
+        out.append(sample)
+        hist2, hist1 = hist1, sample
+    return out
+
+def random_coefficients(rng):
+    return [(rng.randint(-4096, 4096), rng.randint(-2048, 2048)) for i in range(8)]
+
+def random_dsp(rng, frames):
+    """ frames 8-byte DSP frames with valid headers and random nibbles """
+    data = bytearray()
+    for i in range(frames):
+        data.append((rng.randrange(8) << 4) | rng.randrange(12))
+        data += rng.randbytes(7)
+    return bytes(data)
+
+def samples_to_end_nibble(samples):
+    frames, extra = divmod(samples, 14)
+    return frames * 16 + (extra + 2 if extra else 0) - 1
+
+def build_hps(rng, block_samples, channels=2, rate=32000, loop_block=None):
+    """ An .hps file with a block per entry of block_samples, chained in order. The last
+    block points back to loop_block, or ends the track if it's None
+    Returns:
+        (file bytes, coefficients per channel)
+    """
+    coefficients = [random_coefficients(rng) for channel in range(channels)]
+    data = bytearray(hps.MAGIC + struct.pack(">II", rate, channels))
+    data += bytes(hps.HEADER_SIZE - len(data))
+    for channel in range(channels):
+        start = 0x10 + channel * hps.CHANNEL_HEADER + 0x10
+        struct.pack_into(">16h", data, start, *[c for pair in coefficients[channel] for c in pair])
+    sizes = [-(-samples // 14) * 8 for samples in block_samples] #bytes per channel
+    offsets = []
+    position = hps.HEADER_SIZE
+    for size in sizes:
+        offsets.append(position)
+        position += hps.BLOCK_HEADER + size * channels
+    for index, (samples, size) in enumerate(zip(block_samples, sizes)):
+        if index + 1 < len(offsets):
+            next_block = offsets[index + 1]
+        else:
+            next_block = hps.END if loop_block is None else offsets[loop_block]
+        header = bytearray(struct.pack(">III", size * channels, samples_to_end_nibble(samples), next_block))
+        header += bytes(hps.BLOCK_HEADER - len(header))
+        for channel in range(channels):
+            struct.pack_into(">Hhh", header, 0xC + channel * 8, 0,
+                             rng.randint(-3000, 3000), rng.randint(-3000, 3000))
+        data += header
+        for channel in range(channels):
+            data += random_dsp(rng, size // 8)
+    return bytes(data), coefficients
+
+def test_decode_dsp_matches_reference():
+    rng = random.Random(1)
+    coefficients = random_coefficients(rng)
+    data = random_dsp(rng, 200)
+    for samples in (14, 15, 27, 200 * 14):
+        out = array('h')
+        hps.decode_dsp(data, 0, samples, coefficients, 123, -456, out)
+        assert list(out) == reference_decode(data, 0, samples, coefficients, 123, -456)
+
+def test_block_chain_and_loop_block():
+    rng = random.Random(2)
+    data, coefficients = build_hps(rng, [1000, 2002, 777], loop_block=1)
+    track = hps.HPS(data)
+    assert (track.sample_rate, track.channels) == (32000, 2)
+    assert track.coefficients == coefficients
+    assert [block[2] for block in track.blocks] == [1000, 2002, 777]
+    assert track.loop_block == 1
+    assert track.loop_start == 1000
+
+def test_track_without_a_loop():
+    data, coefficients = build_hps(random.Random(3), [500, 600], channels=1)
+    track = hps.HPS(data)
+    assert track.loop_block is None and track.loop_start is None
+
+def test_broken_files():
+    data, coefficients = build_hps(random.Random(4), [500, 600])
+    with pytest.raises(ValueError):
+        hps.HPS(b"not an hps file" + data)
+    with pytest.raises(ValueError):
+        hps.HPS(data[:-100]) #the last block runs past the end
+
+def test_decode_interleaves_the_channels():
+    rng = random.Random(5)
+    data, coefficients = build_hps(rng, [300, 450], loop_block=0)
+    track = hps.HPS(data)
+    pcm = track.decode(data)
+    for channel in range(2):
+        expected = []
+        for start, per_channel, samples, contexts in track.blocks:
+            ps, hist1, hist2 = contexts[channel]
+            expected += reference_decode(data, start + channel * per_channel, samples,
+                                         coefficients[channel], hist1, hist2)
+        assert list(pcm[channel::2]) == expected
+
+def build_iso(files):
+    """ A disc image with just enough of a GameCube filesystem (FST) to hold files
+    Args:
+        files (dict): path -> contents, e.g. {"/audio/hyaku.hps": ...}
+    """
+    # FST entries: the root, then every directory followed by its contents
+    tree = {}
+    for path in files:
+        node = tree
+        parts = path.strip("/").split("/")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = path
+    entries = [] #[is directory, name, parent or file path, end index (directories)]
+    def walk(node, parent):
+        for name, child in node.items():
+            if isinstance(child, dict):
+                entry = [True, name, parent, None]
+                entries.append(entry)
+                walk(child, len(entries))
+                entry[3] = len(entries) + 1
+            else:
+                entries.append([False, name, child, None])
+    walk(tree, 0)
+    fst_offset = 0x1000
+    strings = bytearray()
+    names = []
+    for entry in entries:
+        names.append(len(strings))
+        strings += entry[1].encode() + b"\0"
+    fst = bytearray(struct.pack(">III", 0x01000000, 0, len(entries) + 1))
+    data_offset = fst_offset + (len(entries) + 1) * 12 + len(strings)
+    data_offset += -data_offset % 0x100
+    contents = bytearray()
+    for entry, name in zip(entries, names):
+        if entry[0]:
+            fst += struct.pack(">III", 0x01000000 | name, entry[2], entry[3])
+        else:
+            body = files[entry[2]]
+            fst += struct.pack(">III", name, data_offset + len(contents), len(body))
+            contents += body + bytes(-len(body) % 0x20)
+    fst += strings
+    iso = bytearray(fst_offset)
+    struct.pack_into(">II", iso, 0x424, fst_offset, len(fst))
+    iso += fst
+    iso += bytes(data_offset - len(iso))
+    return bytes(iso + contents)
+
+def test_iso_files_lists_the_audio_folder():
+    files = {"/opening.bnr": b"banner", "/audio/hyaku.hps": b"a" * 40, "/audio/us/other.hps": b"b",
+             "/audio/izumi.hps": b"c" * 10, "/movie/intro.mth": b"d"}
+    iso = build_iso(files)
+    listed = hps.iso_files(iso)
+    assert sorted(listed) == ["hyaku.hps", "izumi.hps"]
+    for name, (offset, size) in listed.items():
+        assert iso[offset:offset + size] == files["/audio/" + name]
+
+def test_iso_files_rejects_other_files():
+    with pytest.raises(ValueError):
+        hps.iso_files(bytes(0x1000))
+
+def test_extract_splits_at_the_loop_start(tmp_path):
+    rng = random.Random(6)
+    looping, coefficients = build_hps(rng, [1400, 2800, 1111], loop_block=1)
+    once, coefficients = build_hps(rng, [700], channels=1)
+    iso_path = tmp_path / "melee.iso"
+    iso_path.write_bytes(build_iso({"/audio/hyaku.hps": looping, "/audio/sp_end.hps": once,
+                                    "/audio/other.hps": once}))
+    out = tmp_path / "extracted"
+    written = hps.extract(str(iso_path), str(out), processes=1, rate=None)
+    assert sorted(written) == [("hyaku", "battlefield-intro.wav", "battlefield-loop.wav"),
+                               ("sp_end", None, "final.wav")]
+    pcm = hps.HPS(looping).decode(looping)
+    with wave.open(str(out / "battlefield-intro.wav")) as intro, wave.open(str(out / "battlefield-loop.wav")) as loop:
+        assert intro.getnframes() == 1400 #exactly the loop start
+        assert (intro.getframerate(), intro.getnchannels()) == (32000, 2)
+        assert array('h', intro.readframes(1400) + loop.readframes(loop.getnframes())) == pcm
+    with wave.open(str(out / "final.wav")) as final:
+        assert final.getnframes() == 700
+    config = (out / "musicConfig.txt").read_text().splitlines()
+    stages = {line.split(":")[0]: [name.rsplit("/", 1)[-1] for name in line.split(":")[1:]] for line in config}
+    assert stages == {"31": ["battlefield-intro.wav", "battlefield-loop.wav"], "32": ["final.wav"]}
+
+needs_audioop = pytest.mark.skipif(hps._audioop is None, reason="needs audioop")
+
+def steps(pcm):
+    """ How far each sample of the left channel is from the one before """
+    left = pcm[0::2]
+    return [abs(left[i + 1] - left[i]) for i in range(len(left) - 1)]
+
+@needs_audioop
+def test_resampling_keeps_the_seams_continuous():
+    # A 100Hz tone: the intro runs into the loop, and the loop is 10 whole periods
+    def tone(n):
+        return int(10000 * math.sin(2 * math.pi * 100 * n / 32000))
+    intro, loop = 1000, 3200
+    pcm = array('h', [tone(n) for n in range(intro + loop) for channel in range(2)])
+    converted, loop_start = hps.resample(pcm, 2, 32000, 44100, intro)
+    assert loop_start == round(intro * 44100 / 32000)
+    assert len(converted) // 2 - loop_start == 4410
+    played = converted + converted[loop_start * 2:] * 3 #the intro, then the loop repeating
+    smooth = 2 * math.pi * 100 / 44100 * 10000 #biggest step of the tone at 44.1kHz
+    assert max(steps(played)) <= smooth + 2
+    # Resampling the files one at a time puts a step in at the seam
+    separately = (array('h', hps._audioop.ratecv(pcm[:intro * 2].tobytes(), 2, 2, 32000, 44100, None)[0]) +
+                  array('h', hps._audioop.ratecv(pcm[intro * 2:].tobytes(), 2, 2, 32000, 44100, None)[0]))
+    assert max(steps(separately)) > smooth + 20
+
+@needs_audioop
+def test_extract_resamples_to_the_mixer_rate(tmp_path):
+    rng = random.Random(7)
+    looping, coefficients = build_hps(rng, [1400, 2800, 1111], loop_block=1)
+    iso_path = tmp_path / "melee.iso"
+    iso_path.write_bytes(build_iso({"/audio/hyaku.hps": looping}))
+    out = tmp_path / "extracted"
+    hps.extract(str(iso_path), str(out), processes=1)
+    with wave.open(str(out / "battlefield-intro.wav")) as intro, wave.open(str(out / "battlefield-loop.wav")) as loop:
+        assert (intro.getframerate(), loop.getframerate()) == (hps.MIXER_RATE, hps.MIXER_RATE)
+        assert intro.getnframes() == round(1400 * 44100 / 32000)
+        assert loop.getnframes() == round((2800 + 1111) * 44100 / 32000)
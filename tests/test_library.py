@@ -0,0 +1,117 @@
+""" The music library: probing files, the index of probe results, and weighted picks """
+import os
+import random
+import struct
+import wave
+
+from melee.library import AliasTable, Library, probe
+
+MUSIC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "melee", "music")
+MP3 = os.path.join(MUSIC, "dreamland-intro.mp3")
+
+def id3_tag(size):
+    """ An ID3v2 tag of size bytes in total, padding only (like a tag with cover art) """
+    body = size - 10
+    syncsafe = bytes([(body >> 21) & 0x7F, (body >> 14) & 0x7F, (body >> 7) & 0x7F, body & 0x7F])
+    return b"ID3\x03\x00\x00" + syncsafe + bytes(body)
+
+def test_mp3_after_a_big_id3_tag(tmp_path):
+    with open(MP3, "rb") as mp3:
+        audio = mp3.read()
+    tagged = tmp_path / "tagged.mp3"
+    tagged.write_bytes(id3_tag(100 * 1024) + audio)
+    plain = probe(MP3)
+    result = probe(str(tagged))
+    assert result["error"] is None
+    assert result["rate"] == plain["rate"] and result["channels"] == plain["channels"]
+    assert abs(result["duration"] - plain["duration"]) < 0.05
+
+def test_wav_data_after_a_big_chunk(tmp_path):
+    path = tmp_path / "long-header.wav"
+    pcm = bytes(44100 * 4 * 2) #2 seconds of stereo
+    fmt = struct.pack("<HHIIHH", 1, 2, 44100, 44100 * 4, 4, 16)
+    riff = b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt
+    riff += b"LIST" + struct.pack("<I", 100 * 1024) + bytes(100 * 1024)
+    riff += b"data" + struct.pack("<I", len(pcm)) + pcm
+    path.write_bytes(b"RIFF" + struct.pack("<I", len(riff)) + riff)
+    with wave.open(str(path)) as check: #a valid file, as far as Python's wave module goes
+        assert check.getnframes() == 88200
+    result = probe(str(path))
+    assert result["error"] is None
+    assert (result["duration"], result["rate"], result["channels"]) == (2.0, 44100, 2)
+
+def test_unrecognised_headers_keep_the_entry(tmp_path):
+    (tmp_path / "odd.mp3").write_bytes(b"not what the prober expects" * 100)
+    (tmp_path / "empty.mp3").write_bytes(b"")
+    (tmp_path / "musicConfig.txt").write_text("31:odd.mp3\n32:empty.mp3\n33:missing.mp3\n")
+    library = Library(str(tmp_path))
+    library.load()
+    assert library.info["odd.mp3"]["error"] is None
+    assert library.info["odd.mp3"]["duration"] is None
+    assert 31 in library
+    assert 32 not in library and 33 not in library
+
+def write_wav(path, seconds):
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(44100)
+        wav.writeframes(bytes(int(44100 * seconds) * 4))
+
+def test_alias_table_matches_the_weights():
+    weights = [1, 2, 3, 0.5, 13.5]
+    table = AliasTable(weights)
+    rng = random.Random(1)
+    draws = 200000
+    counts = [0] * len(weights)
+    for i in range(draws):
+        counts[table.sample(rng)] += 1
+    for count, weight in zip(counts, weights):
+        expected = weight / sum(weights)
+        assert abs(count / draws - expected) < 0.01
+
+def test_weighted_picks_and_odds(tmp_path):
+    for name in ("a", "b", "c", "menu"):
+        write_wav(tmp_path / (name + ".wav"), 0.1)
+    (tmp_path / "musicConfig.txt").write_text(
+        "31:a.wav:3\n"
+        "31:b.wav\n"
+        "31:b.wav\n" #repeated lines add up, to a weight of 2
+        "32:c.wav:b.wav\n"
+        "32:a.wav\n"
+        "menu:menu.wav\n"
+        "33:c.wav:0\n") #a weight of 0 is left out
+    library = Library(str(tmp_path))
+    library.load()
+    assert library.stages[31] == [["a.wav"], ["b.wav"]]
+    assert library.weights[31] == [3.0, 2.0]
+    assert 33 not in library
+    rng = random.Random(2)
+    picks = [library.pick(31, rng) for i in range(20000)]
+    assert abs(picks.count(["a.wav"]) / len(picks) - 0.6) < 0.02
+    assert library.pick(34) is None
+    assert library.odds() == {"a.wav": 0.6, "b.wav": 0.5, "c.wav": 0.5, "menu.wav": 1.0}
+
+def test_index_is_reused_until_a_file_changes(tmp_path):
+    write_wav(tmp_path / "a.wav", 1)
+    write_wav(tmp_path / "b.wav", 1)
+    (tmp_path / "musicConfig.txt").write_text("31:a.wav\n32:b.wav\n")
+    index = str(tmp_path / "library.json")
+    library = Library(str(tmp_path), index_path=index)
+    library.load()
+    assert library.probed == 2
+    library = Library(str(tmp_path), index_path=index)
+    library.load()
+    assert library.probed == 0
+    assert library.info["a.wav"]["duration"] == 1.0
+
+    write_wav(tmp_path / "a.wav", 2) #a new size
+    stat = os.stat(tmp_path / "b.wav")
+    os.utime(tmp_path / "b.wav", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9)) #only a new mtime
+    library = Library(str(tmp_path), index_path=index)
+    library.load()
+    assert library.probed == 2
+    assert library.info["a.wav"]["duration"] == 2.0
+    library = Library(str(tmp_path), index_path=index)
+    library.load()
+    assert library.probed == 0
@@ -0,0 +1,113 @@
+""" MusicPlayer: the intro -> loop seam, crossfades and fading out """
+import time
+from array import array
+
+import pytest
+
+from melee import player as player_module
+from melee.player import MusicPlayer, _pcm
+from tests.conftest import FREQUENCY
+
+def pcm(values):
+    """ Stereo 16-bit PCM with both channels following values, one per frame """
+    return array('h', [value for value in values for channel in range(2)]).tobytes()
+
+def render_all(player, nbytes, chunk=4410 * 4 + 12):
+    """ Render nbytes in uneven chunks, the way the feeder and SDL ask for them """
+    out = bytearray()
+    while len(out) < nbytes:
+        out += player.render(min(chunk, nbytes - len(out)))
+    return bytes(out)
+
+def frames(data):
+    """ The left channel of stereo 16-bit PCM """
+    return array('h', data)[0::2]
+
+def test_render_is_intro_then_loop(mixer):
+    intro = pcm(range(-3000, 3000))
+    loop = pcm(range(5000, -2777, -3))
+    player = MusicPlayer(mixer.Channel(0))
+    player._arrange(_pcm(intro), _pcm(loop))
+    assert render_all(player, len(intro) + 5 * len(loop)) == intro + loop * 5
+    player.close()
+
+def test_loop_without_intro(mixer):
+    loop = pcm(range(1000))
+    player = MusicPlayer(mixer.Channel(0))
+    player._arrange(None, _pcm(loop))
+    assert render_all(player, 3 * len(loop) + 4) == loop * 3 + loop[:4]
+    player.close()
+
+def test_crossfade_seam_has_no_step(mixer):
+    intro = pcm([10000] * 20000)
+    loop = pcm([-10000] * 20000)
+    player = MusicPlayer(mixer.Channel(0), crossfade_ms=10)
+    fade = player.crossfade_frames
+    player._arrange(_pcm(intro), _pcm(loop))
+    out = frames(render_all(player, len(intro) + len(loop)))
+    steps = [abs(out[i + 1] - out[i]) for i in range(len(out) - 1)]
+    # A hard cut would jump 20000 at once, the crossfade spreads it over `fade` frames
+    assert max(steps) <= 20000 // fade + 1
+    assert out[0] == 10000
+    assert out[20000] == -10000 #the loop is fully in by the end of the intro
+    assert out[20000 - fade - 1] == 10000 #and the fade starts fade frames before it
+    player.close()
+
+def test_crossfade_loop_seam_is_continuous(mixer):
+    # A ramp that doesn't end where it starts: without a crossfade, the loop seam is a step
+    loop = pcm(range(0, 16000, 2))
+    player = MusicPlayer(mixer.Channel(0), crossfade_ms=20)
+    player._arrange(None, _pcm(loop))
+    out = frames(render_all(player, 4 * len(loop)))
+    steps = [abs(out[i + 1] - out[i]) for i in range(len(out) - 1)]
+    assert max(steps) <= 16000 // player.crossfade_frames + 4
+    player.close()
+
+@pytest.mark.skipif(player_module._audioop is None, reason="needs audioop")
+def test_long_crossfade_arranges_quickly(mixer):
+    # play() blends the seams while a game is starting, so they can't take long
+    intro = pcm([10000] * FREQUENCY * 2)
+    loop = pcm([-10000] * FREQUENCY * 2)
+    player = MusicPlayer(mixer.Channel(0), crossfade_ms=1000)
+    started = time.perf_counter()
+    player._arrange(_pcm(intro), _pcm(loop))
+    assert time.perf_counter() - started < 0.05
+    out = frames(render_all(player, len(intro) + len(loop)))
+    steps = [abs(out[i + 1] - out[i]) for i in range(len(out) - 1)]
+    assert max(steps) <= 2 * 20000 // player_module.GAIN_STEPS #each gain step is tiny
+    player.close()
+
+def test_fade_out_ramps_down_over_fade_ms(mixer):
+    player = MusicPlayer(mixer.Channel(0))
+    player._arrange(None, _pcm(pcm([20000] * 44100)))
+    player.stop(500)
+    out = array('h')
+    while player.get_busy():
+        out += frames(player._next_chunk(player.chunk_size))
+    assert abs(len(out) - FREQUENCY // 2) <= player.chunk_size // player.frame_size
+    assert all(out[i + 1] <= out[i] for i in range(len(out) - 1))
+    assert out[0] >= 19900 and out[-1] <= 100
+    assert abs(out[len(out) // 2] - 10000) < 100
+    player.close()
+
+def test_fade_out_lasts_fade_ms_on_the_channel(mixer):
+    player = MusicPlayer(mixer.Channel(0))
+    player.play(None, pcm([20000] * 44100))
+    time.sleep(0.3)
+    player.stop(1000)
+    stopped = time.perf_counter()
+    while player.channel.get_busy() and time.perf_counter() - stopped < 3:
+        time.sleep(0.01)
+    faded = time.perf_counter() - stopped
+    assert 0.9 <= faded <= 1.4
+    assert not player.get_busy()
+    player.close()
+
+def test_stop_without_fade_is_immediate(mixer):
+    player = MusicPlayer(mixer.Channel(0))
+    player.play(None, pcm([20000] * 44100))
+    time.sleep(0.2)
+    player.stop()
+    assert not player.get_busy()
+    assert not player.channel.get_busy()
+    player.close()
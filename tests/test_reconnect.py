@@ -0,0 +1,71 @@
+""" Reconnecting to Slippi mid-game: the stream resumes and the music isn't restarted
+The stand-in server (melee/slippstreamserver.py) runs in a process of its own, sends
+half a game, drops the connection and sends the rest once the Console has reconnected.
+"""
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+FRAMES = 200
+DROP_AT = 100
+
+def serve(port, resume, results):
+    """ Server process: half a game, a dropped connection, then the rest of the game """
+    from melee.slippstreamserver import SlippstreamServer, synthetic_game
+    server = SlippstreamServer(port=port, resume=resume)
+    results.put("ready")
+    payloads = synthetic_game(31, FRAMES)
+    if not server.wait_for_client():
+        results.put("no client")
+        return
+    server.send_game(payloads[:DROP_AT], fps=0)
+    server.idle(0.5)
+    server.disconnect()
+    if not server.wait_for_client():
+        results.put("no reconnect")
+        return
+    server.send_game(payloads[DROP_AT:], fps=0)
+    results.put("sent")
+    server.idle(2)
+
+def wait_for(condition, timeout=15):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+@pytest.mark.parametrize("resume, port", [(True, 51531), (False, 51532)])
+def test_reconnect_mid_game(resume, port):
+    import melee
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port, resume, results), daemon=True)
+    server.start()
+    assert results.get(timeout=10) == "ready"
+
+    console = melee.Console(slippi_port=port, menu=False, cache_mb=0, pcm_cache=False, watch=False)
+    console._slippstream.backoff_min = 0.1
+    assert console.wait_ready(30)
+    plays = []
+    play = console._player.play
+    def record_play(intro, loop):
+        plays.append(time.monotonic())
+        play(intro, loop)
+    console._player.play = record_play
+    try:
+        assert console.connect()
+        def step_forever():
+            while True:
+                console.step()
+        threading.Thread(target=step_forever, daemon=True).start()
+        assert results.get(timeout=30) == "sent"
+        last_frame = FRAMES - 1 - 123 #frame numbers start at -123
+        assert wait_for(lambda: console.frames.latest == last_frame and console._stage is None)
+        # The game start is replayed from cursor 0 by a server that doesn't resume, but
+        # the song that was already playing carries on
+        assert console.cursor == (DROP_AT if resume else 0)
+        assert len(plays) == 1
+    finally:
+        console.stop()
+        server.join(timeout=10)
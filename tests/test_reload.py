@@ -0,0 +1,83 @@
+""" Reloading the music library while SlippiMusic is running: the song that's playing
+carries on unless its entry is taken out, and only the files that changed are decoded again
+"""
+import time
+import wave
+
+import melee
+from melee.library import Library
+from melee.trackcache import TrackCache
+from melee.watcher import DirectoryWatcher
+from tests.conftest import FREQUENCY
+
+def write_wav(path, seconds, value):
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(FREQUENCY)
+        wav.writeframes(value.to_bytes(2, "little", signed=True) * 2 * int(FREQUENCY * seconds))
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+def test_reload_during_a_session(mixer, tmp_path):
+    music = tmp_path / "music"
+    music.mkdir()
+    for name, value in (("a", 1000), ("b", 2000), ("c", 3000)):
+        write_wav(music / (name + ".wav"), 1, value)
+    config = music / "musicConfig.txt"
+    config.write_text("31:a.wav\n32:b.wav\n33:c.wav\n")
+
+    console = melee.Console(slippi_port=51551, menu=False, cache_mb=16, pcm_cache=False, watch=False)
+    assert console.wait_ready(30)
+    # The Console's own music folder is melee/music, swap in one that can be rewritten
+    library = Library(str(music), index_path=str(tmp_path / "library.json"))
+    library.load()
+    tracks = TrackCache(str(music), 16, None, 0)
+    tracks.preload(library)
+    tracks._thread.join()
+    console.library = library
+    console.tracks = tracks
+    plays = []
+    play = console._player.play
+    def record_play(intro, loop):
+        plays.append(loop)
+        play(intro, loop)
+    console._player.play = record_play
+    watcher = DirectoryWatcher(str(music), console._Console__reload_library, settle=0.2)
+    watcher.start()
+    try:
+        console._audio.post(console._Console__play_stage, 31)
+        assert wait_for(lambda: console._playing == (31, ["a.wav"]))
+        decoded = dict(tracks._tracks)
+        assert set(decoded) == {"a.wav", "b.wav", "c.wav"}
+
+        # A new entry and a changed file: the song keeps playing, only b.wav is dropped
+        write_wav(music / "b.wav", 2, 2500)
+        config.write_text("31:a.wav\n32:b.wav\n33:c.wav\n34:c.wav:a.wav\n")
+        assert wait_for(lambda: 34 in console.library)
+        assert console._playing == (31, ["a.wav"])
+        assert len(plays) == 1
+        assert console._player.get_busy()
+        assert tracks._tracks["a.wav"] is decoded["a.wav"]
+        assert tracks._tracks["c.wav"] is decoded["c.wav"]
+        assert tracks._tracks.get("b.wav") is not decoded["b.wav"]
+        assert console.library.info["b.wav"]["duration"] == 2.0
+
+        # The entry that's playing is replaced: the stage's new song starts
+        config.write_text("31:c.wav\n32:b.wav\n")
+        assert wait_for(lambda: console._playing == (31, ["c.wav"]))
+        assert len(plays) == 2
+        assert 34 not in console.library
+
+        # The stage is taken out altogether: the music stops
+        config.write_text("32:b.wav\n")
+        assert wait_for(lambda: 31 not in console.library and console._playing is None)
+        assert wait_for(lambda: not console._player.get_busy())
+        assert len(plays) == 2
+    finally:
+        watcher.stop()
+        console.stop()
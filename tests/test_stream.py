@@ -0,0 +1,86 @@
+""" Streamed playback: the same PCM as playing from memory, closed files, no underruns """
+import multiprocessing
+import os
+import random
+import time
+import wave
+
+from melee import stream
+from melee.player import MusicPlayer, _pcm
+from melee.stream import PCMStream, wav_source
+from tests.conftest import FREQUENCY
+
+def write_wav(path, seconds, seed):
+    """ Random 44.1kHz 16-bit stereo, already in the mixer's format so it can be streamed """
+    data = random.Random(seed).randbytes(int(FREQUENCY * seconds) * 4)
+    with wave.open(str(path), "wb") as out:
+        out.setnchannels(2)
+        out.setsampwidth(2)
+        out.setframerate(FREQUENCY)
+        out.writeframes(data)
+    return data
+
+def render_all(player, nbytes, chunk=17640):
+    out = bytearray()
+    while len(out) < nbytes:
+        out += player.render(min(chunk, nbytes - len(out)))
+    return bytes(out)
+
+def test_streamed_matches_memory(mixer, tmp_path):
+    intro = write_wav(tmp_path / "intro.wav", 3, 1)
+    loop = write_wav(tmp_path / "loop.wav", 2, 2)
+    for crossfade_ms in (0, 20):
+        streamed = MusicPlayer(mixer.Channel(0), crossfade_ms=crossfade_ms)
+        streamed._arrange(_pcm(wav_source(str(tmp_path / "intro.wav"))), _pcm(wav_source(str(tmp_path / "loop.wav"))))
+        memory = MusicPlayer(mixer.Channel(1), crossfade_ms=crossfade_ms)
+        memory._arrange(memoryview(intro), memoryview(loop))
+        nbytes = len(intro) + 3 * len(loop) + 1000
+        assert render_all(streamed, nbytes) == render_all(memory, nbytes)
+        streamed.close()
+        memory.close()
+
+def test_streams_are_closed_when_the_track_changes(mixer, tmp_path):
+    write_wav(tmp_path / "long.wav", 3, 3)
+    source = wav_source(str(tmp_path / "long.wav"))
+    player = MusicPlayer(mixer.Channel(0))
+    player._arrange(None, _pcm(source))
+    render_all(player, len(source) - 1000) #past the head, so the file is open
+    streams = [segment for segment in player._segments if isinstance(segment, PCMStream)]
+    assert streams and all(segment._file is not None for segment in streams)
+    player._arrange(None, _pcm(source))
+    assert all(segment._file is None and segment._closed for segment in streams)
+    streams = list(player._segments)
+    player.stop()
+    assert all(segment._closed for segment in streams)
+    player.close()
+
+def burn(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+def test_no_underruns_under_cpu_load(mixer, tmp_path):
+    # The intro ends at 3 s and the loop wraps every 2 s, all streamed from disk
+    write_wav(tmp_path / "intro.wav", 3, 4)
+    write_wav(tmp_path / "loop.wav", 2, 5)
+    intro = wav_source(str(tmp_path / "intro.wav"))
+    loop = wav_source(str(tmp_path / "loop.wav"))
+    assert len(intro) > stream.READ_AHEAD and len(loop) > stream.HEAD
+    seconds = 10
+    burners = [multiprocessing.Process(target=burn, args=(seconds + 2,), daemon=True)
+               for i in range((os.cpu_count() or 1) + 2)]
+    for burner in burners:
+        burner.start()
+    misses = PCMStream.misses
+    player = MusicPlayer(mixer.Channel(0))
+    try:
+        time.sleep(0.5) #let the burners get going
+        player.play(intro, loop)
+        time.sleep(seconds)
+        assert player.get_busy()
+        assert player.underruns == 0
+        assert PCMStream.misses == misses
+    finally:
+        player.close()
+        for burner in burners:
+            burner.terminate()
@@ -0,0 +1,68 @@
+""" TrackCache: shutting down cleanly before pygame quits the mixer, and tracks too long
+to keep in memory """
+import os
+import shutil
+
+from melee.library import Library
+from melee.trackcache import TrackCache
+from melee.workers import Worker
+
+MUSIC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "melee", "music")
+
+def test_worker_stop_runs_what_was_posted():
+    worker = Worker("Test")
+    done = []
+    for i in range(3):
+        worker.post(done.append, i)
+    worker.stop(timeout=5)
+    assert done == [0, 1, 2]
+    assert not worker._thread.is_alive()
+
+def test_close_waits_for_the_prefetcher(mixer):
+    tracks = TrackCache(MUSIC, budget_mb=256)
+    files = sorted(name for name in os.listdir(MUSIC) if name.endswith(".mp3"))
+    tracks.prefetch(files)
+    tracks.close()
+    # Nothing may still be decoding once close() returns, and the rest was skipped
+    assert not tracks._prefetcher._thread.is_alive()
+    assert len(tracks._prefetched) < len(files)
+
+def long_and_short(tmp_path):
+    """ A music folder with a 3.6 s intro and a 64 s loop (11MB decoded) """
+    for name in ("dreamland-intro.mp3", "dreamland-loop.mp3"):
+        shutil.copy(os.path.join(MUSIC, name), tmp_path / name)
+    (tmp_path / "musicConfig.txt").write_text("28:dreamland-intro.mp3:dreamland-loop.mp3\n")
+    library = Library(str(tmp_path))
+    library.load()
+    return library
+
+def count_decodes(tracks):
+    decoded = []
+    decode = tracks._decode
+    def counting(fileName):
+        decoded.append(fileName)
+        return decode(fileName)
+    tracks._decode = counting
+    return decoded
+
+def test_long_tracks_are_skipped_without_a_pcm_cache(mixer, tmp_path, capsys):
+    library = long_and_short(tmp_path)
+    tracks = TrackCache(str(tmp_path), budget_mb=256, cache_dir=None, stream_mb=1)
+    decoded = count_decodes(tracks)
+    tracks.update(library, []) #preloads in this thread
+    # The probed duration says the loop is too long, so it isn't even decoded
+    assert decoded == ["dreamland-intro.mp3"]
+    assert "dreamland-loop.mp3" not in tracks
+    assert tracks.get("dreamland-loop.mp3") is None
+    assert tracks.size < 1024 * 1024
+    assert capsys.readouterr().out.count("Skipping") == 1
+
+def test_long_tracks_without_a_probed_duration(mixer, tmp_path, capsys):
+    long_and_short(tmp_path)
+    tracks = TrackCache(str(tmp_path), budget_mb=256, cache_dir=None, stream_mb=1)
+    decoded = count_decodes(tracks)
+    assert tracks.get("dreamland-loop.mp3") is None #decoded, then found to be too long
+    assert tracks.get("dreamland-loop.mp3") is None
+    assert decoded == ["dreamland-loop.mp3"]
+    assert tracks.size == 0
+    assert tracks.get("dreamland-intro.mp3") is not None